@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Measure what tracer's dispatcher costs.
+
+Each workload is timed without tracing, under a bare sys.settrace()
+function, and under tracer with 0, 1, 5 and 20 hooks for several event
+sets, with the Python and, if it has been built, the compiled
+dispatcher. The cost of TraceFilter.is_excluded() over many modules and
+of tracing several threads at once is measured too.
+
+Overheads are given in nanoseconds per event, where the events are
+those that a bare sys.settrace() function sees for the workload. Run:
+
+    $ python benchmarks/bench_dispatch.py                # a table
+    $ python benchmarks/bench_dispatch.py --json out.json
+
+The JSON output has the Python version and one object per measurement,
+so runs can be compared to catch regressions in the dispatcher.
+"""
+
+import argparse
+import json
+import os.path
+import platform
+import sys
+import threading
+import time
+import types
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tracer  # noqa: E402
+import tracer.tracer as tracer_module  # noqa: E402
+from tracer.tracefilter import TraceFilter  # noqa: E402
+
+HOOK_COUNTS = (0, 1, 5, 20)
+
+EVENT_SETS = {
+    "all": tracer.ALL_EVENTS,
+    "call": frozenset(("call",)),
+    "call+return": frozenset(("call", "return")),
+    "line": frozenset(("line",)),
+}
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def calls_workload(scale: int):
+    """Many short calls."""
+    for _ in range(scale):
+        fib(15)
+    return
+
+
+def lines_workload(scale: int):
+    """Many lines in few calls."""
+    total = 0
+    for _ in range(scale):
+        for i in range(1000):
+            total += i
+    return total
+
+
+WORKLOADS = {"calls": calls_workload, "lines": lines_workload}
+
+
+def best_time(run: Callable[[], None], repeat: int) -> float:
+    """Return the shortest time, in seconds, of `repeat` runs of `run`."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def count_events(workload: Callable[[int], None], scale: int) -> int:
+    """Return the number of events a bare sys.settrace() function sees
+    while `workload` runs."""
+    count = 0
+
+    def counter(frame, event, arg):
+        nonlocal count
+        count += 1
+        return counter
+
+    sys.settrace(counter)
+    try:
+        workload(scale)
+    finally:
+        sys.settrace(None)
+    return count
+
+
+def make_hook():
+    def hook(frame, event, arg):
+        return hook
+
+    return hook
+
+
+def traced_run(workload, scale, hooks: int, event_set, native: bool) -> Callable:
+    def run():
+        tracer.clear_hooks_and_stop()
+        for _ in range(hooks):
+            tracer.add_hook(make_hook(), {"event_set": event_set, "backlevel": None})
+        tracer.start({"native": native})
+        try:
+            workload(scale)
+        finally:
+            tracer.stop()
+            tracer.clear_hooks()
+        return
+
+    return run
+
+
+def raw_settrace_run(workload, scale) -> Callable:
+    def raw(frame, event, arg):
+        return raw
+
+    def run():
+        sys.settrace(raw)
+        try:
+            workload(scale)
+        finally:
+            sys.settrace(None)
+        return
+
+    return run
+
+
+def dispatchers() -> List[str]:
+    if tracer_module.NATIVE_DISPATCHER is None:
+        return ["python"]
+    return ["python", "native"]
+
+
+def bench_dispatch(scale: int, repeat: int) -> List[dict]:
+    results = []
+    for workload_name, workload in WORKLOADS.items():
+        events = count_events(workload, scale)
+        baseline = best_time(lambda: workload(scale), repeat)
+
+        def result(name, seconds, **fields):
+            record = {
+                "benchmark": "dispatch",
+                "name": name,
+                "workload": workload_name,
+                "seconds": seconds,
+                "events": events,
+                "overhead_ns_per_event": (seconds - baseline) * 1e9 / events,
+            }
+            record.update(fields)
+            return record
+
+        results.append(result("untraced", baseline))
+        results.append(
+            result("raw_settrace", best_time(raw_settrace_run(workload, scale), repeat))
+        )
+        for dispatcher in dispatchers():
+            for event_set_name, event_set in EVENT_SETS.items():
+                for hooks in HOOK_COUNTS:
+                    if hooks == 0 and event_set_name != "all":
+                        continue
+                    run = traced_run(
+                        workload, scale, hooks, event_set, dispatcher == "native"
+                    )
+                    results.append(
+                        result(
+                            "tracer",
+                            best_time(run, repeat),
+                            dispatcher=dispatcher,
+                            hooks=hooks,
+                            event_set=event_set_name,
+                        )
+                    )
+    return results
+
+
+def make_modules(count: int) -> List[types.FrameType]:
+    """Make `count` modules, in sys.modules with a file each, that have
+    one function each; return a frame of each function, which is what
+    the dispatcher gives is_excluded()."""
+    frames = []
+    for i in range(count):
+        name = f"_bench_module_{i}"
+        filename = f"/bench/{name}.py"
+        module = types.ModuleType(name)
+        module.__file__ = filename
+        source = "import sys\ndef f():\n    return sys._getframe()\n"
+        exec(compile(source, filename, "exec"), module.__dict__)
+        sys.modules[name] = module
+        frames.append(module.f())
+    return frames
+
+
+def bench_filter(repeat: int, module_count: int = 500) -> List[dict]:
+    frames = make_modules(module_count)
+    filters = {
+        "modules": TraceFilter(
+            [sys.modules[f"_bench_module_{i}"] for i in range(0, module_count, 2)]
+        ),
+        "glob_rules": TraceFilter(),
+        "include_mode": TraceFilter(mode="include"),
+    }
+    for i in range(0, module_count, 10):
+        filters["glob_rules"].add_rule(f"/bench/_bench_module_{i}*.py")
+    filters["include_mode"].add_rule("_bench_module_1*", kind="module")
+
+    results = []
+    for filter_name, trace_filter in filters.items():
+
+        def cold():
+            # Every verdict is worked out again.
+            trace_filter._changed()
+            for frame in frames:
+                trace_filter.is_excluded(frame)
+            return
+
+        def warm():
+            for frame in frames:
+                trace_filter.is_excluded(frame)
+            return
+
+        for name, run in (("cold", cold), ("warm", warm)):
+            seconds = best_time(run, repeat)
+            results.append(
+                {
+                    "benchmark": "is_excluded",
+                    "name": name,
+                    "filter": filter_name,
+                    "modules": module_count,
+                    "seconds": seconds,
+                    "ns_per_call": seconds * 1e9 / len(frames),
+                }
+            )
+    for i in range(module_count):
+        del sys.modules[f"_bench_module_{i}"]
+    return results
+
+
+def bench_threads(scale: int, repeat: int, thread_count: int = 4) -> List[dict]:
+    workload = calls_workload
+    events = count_events(workload, scale) * thread_count
+
+    def in_threads():
+        threads = [
+            threading.Thread(target=workload, args=(scale,))
+            for _ in range(thread_count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return
+
+    def untraced():
+        in_threads()
+        return
+
+    def raw_settrace():
+        def raw(frame, event, arg):
+            return raw
+
+        threading.settrace(raw)
+        try:
+            in_threads()
+        finally:
+            threading.settrace(None)
+        return
+
+    def traced(native: bool):
+        def run():
+            tracer.clear_hooks_and_stop()
+            tracer.add_hook(make_hook(), {"backlevel": None})
+            tracer.start({"native": native, "include_threads": True})
+            try:
+                in_threads()
+            finally:
+                tracer.stop()
+                threading.settrace(None)
+                tracer.clear_hooks()
+            return
+
+        return run
+
+    runs: Dict[str, Callable] = {"untraced": untraced, "raw_settrace": raw_settrace}
+    for dispatcher in dispatchers():
+        runs[f"tracer_{dispatcher}"] = traced(dispatcher == "native")
+    results = []
+    baseline: Optional[float] = None
+    for name, run in runs.items():
+        seconds = best_time(run, repeat)
+        if baseline is None:
+            baseline = seconds
+        results.append(
+            {
+                "benchmark": "threads",
+                "name": name,
+                "threads": thread_count,
+                "hooks": 1 if name.startswith("tracer") else 0,
+                "seconds": seconds,
+                "events": events,
+                "overhead_ns_per_event": (seconds - baseline) * 1e9 / events,
+            }
+        )
+    return results
+
+
+def format_table(results: List[dict]) -> str:
+    lines = []
+    for record in results:
+        details = " ".join(
+            f"{key}={record[key]}"
+            for key in ("workload", "dispatcher", "event_set", "hooks", "filter")
+            if key in record
+        )
+        if "overhead_ns_per_event" in record:
+            cost = f"{record['overhead_ns_per_event']:10.1f} ns/event"
+        else:
+            cost = f"{record['ns_per_call']:10.1f} ns/call "
+        lines.append(
+            f"{record['benchmark']:12} {record['name']:14} "
+            f"{record['seconds']:9.4f}s {cost}  {details}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", metavar="PATH", help="write results as JSON")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per timing")
+    parser.add_argument("--scale", type=int, default=20, help="workload size")
+    parser.add_argument(
+        "--quick", action="store_true", help="small runs, to check that it works"
+    )
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.repeat, args.scale = 1, 1
+
+    results = bench_dispatch(args.scale, args.repeat)
+    results += bench_filter(args.repeat)
+    results += bench_threads(args.scale, args.repeat)
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "native_dispatcher": tracer_module.NATIVE_DISPATCHER is not None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(format_table(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,17 @@ setuptools setup (setup.py) for pytracer.
 
 This gets a bit of package info from __pkginfo__.py file
 """
+import platform
+
 # Get the required package information
-from setuptools import setup
+from setuptools import Extension, setup
+
+# The compiled dispatcher is optional: if it can't be built, tracer
+# falls back to its pure-Python dispatcher.
+ext_modules = []
+if platform.python_implementation() == "CPython":
+    ext_modules.append(
+        Extension("tracer._dispatch", sources=["tracer/_dispatch.c"], optional=True)
+    )
 
-setup(packages=["tracer"])
+setup(packages=["tracer"], ext_modules=ext_modules)
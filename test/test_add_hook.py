@@ -2,6 +2,9 @@
 # -*- Python -*-
 """Unit test for Tracer's add-hook"""
 
+import sys
+
+import pytest
 import tracer
 from tracer.tracefilter import TraceFilter
 
@@ -36,3 +39,114 @@ def test_add_hook():
     assert trace_dispatch1 == tracer.HOOKS[1][0]
     assert trace_dispatch2 == tracer.HOOKS[2][0]
     return
+
+
+def dispatch_funcs():
+    return {
+        event: [hook.trace_func for hook in hooks]
+        for event, hooks in tracer.tracer.REGISTRY.tables.dispatch_table.items()
+    }
+
+
+def test_dispatch_table():
+    """The dispatch table lists, per event, the hooks that want it."""
+    tracer.clear_hooks()
+    tracer.add_hook(trace_dispatch1, {"event_set": frozenset(("call", "line"))})
+    tracer.add_hook(trace_dispatch2, {"event_set": frozenset(("line",))})
+    assert dispatch_funcs() == {
+        "call": [trace_dispatch1],
+        "line": [trace_dispatch1, trace_dispatch2],
+    }
+    tracer.add_hook(trace_dispatch3, {"position": 0, "event_set": frozenset(("call",))})
+    assert dispatch_funcs() == {
+        "call": [trace_dispatch3, trace_dispatch1],
+        "line": [trace_dispatch1, trace_dispatch2],
+    }
+    tracer.remove_hook(trace_dispatch1)
+    assert dispatch_funcs() == {"call": [trace_dispatch3], "line": [trace_dispatch2]}
+    tracer.clear_hooks()
+    assert dispatch_funcs() == {}
+    return
+
+
+def test_registry_snapshot():
+    """Changing hooks publishes a new registry and keeps HOOKS current."""
+    import tracer.tracer as tracer_module
+
+    hooks_list = tracer_module.HOOKS
+    tracer.clear_hooks()
+    registry = tracer_module.REGISTRY
+    tracer.add_hook(trace_dispatch1)
+    assert tracer_module.REGISTRY is not registry
+    assert registry.hooks == ()
+    assert tracer_module.HOOKS is hooks_list
+    assert [hook.trace_func for hook in hooks_list] == [trace_dispatch1]
+    tracer.clear_hooks()
+    assert tracer_module.HOOKS is hooks_list
+    assert hooks_list == []
+    return
+
+
+def test_concurrent_add_remove():
+    """Hooks added and removed from several threads are all accounted for."""
+    import threading
+
+    tracer.clear_hooks()
+    funcs = []
+    for i in range(20):
+        exec(f"def hook{i}(frame, event, arg): return None", globals())
+        funcs.append(globals()[f"hook{i}"])
+
+    def add_remove(my_funcs):
+        for func in my_funcs:
+            tracer.add_hook(func, {"position": 0})
+        for func in my_funcs[::2]:
+            tracer.remove_hook(func)
+
+    threads = [
+        threading.Thread(target=add_remove, args=(funcs[i::4],)) for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    remaining = {hook.trace_func for hook in tracer.tracer.REGISTRY.hooks}
+    assert remaining == {func for i in range(4) for func in funcs[i::4][1::2]}
+    tracer.clear_hooks()
+    return
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_hooks_dont_see_registry_updates(backend, native):
+    """Adding and removing a hook while tracing doesn't give the hooks
+    events for tracer's own code."""
+    import tracer.tracer as tracer_module
+
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    events = []
+
+    def recorder(frame, event, arg):
+        events.append((frame.f_code.co_filename, frame.f_code.co_name, event))
+        return recorder
+
+    tracer.clear_hooks()
+    tracer.add_hook(recorder)
+    tracer.start({"backend": backend, "native": native})
+    tracer.add_hook(trace_dispatch1)
+    tracer.enable_stats()
+    tracer.disable_stats()
+    tracer.remove_hook(trace_dispatch1)
+    tracer.stop()
+    tracer.clear_hooks()
+
+    assert [event for event in events if event[0] == tracer_module.__file__] == []
+    # Nor for what that code calls.
+    assert {name for _, name, _ in events} == {"test_hooks_dont_see_registry_updates"}
+    return
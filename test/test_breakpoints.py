@@ -0,0 +1,80 @@
+"""Unit test for hooks limited to lines of interest"""
+
+import sys
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+from tracer.breakpoints import BreakpointIndex
+
+
+def with_breakpoint():
+    x = 1
+    return sys._getframe().f_trace, x
+
+
+def without_breakpoint():
+    x = 2
+    return sys._getframe().f_trace, x
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def test_index():
+    breakpoints = BreakpointIndex()
+    line = with_breakpoint.__code__.co_firstlineno + 1
+    breakpoints.add(with_breakpoint, line)
+    assert breakpoints.lines(with_breakpoint.__code__) == {line}
+    assert not breakpoints.lines(without_breakpoint.__code__)
+
+    # By filename, a line is in the code object it belongs to.
+    other_line = without_breakpoint.__code__.co_firstlineno + 2
+    breakpoints.add(__file__, other_line)
+    assert breakpoints.lines(without_breakpoint.__code__) == {other_line}
+    assert breakpoints.lines(with_breakpoint.__code__) == {line}
+
+    assert breakpoints.remove(__file__, other_line)
+    assert not breakpoints.remove(__file__, other_line)
+    assert not breakpoints.lines(without_breakpoint.__code__)
+    with pytest.raises(TypeError):
+        breakpoints.add(5, 1)
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_line_interest(backend, native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    lines = []
+
+    def line_hook(frame, event, arg):
+        lines.append((frame.f_code.co_name, frame.f_lineno))
+        return line_hook
+
+    breakpoints = BreakpointIndex()
+    line = with_breakpoint.__code__.co_firstlineno + 1
+    breakpoints.add(with_breakpoint, line)
+    tracer.add_hook(
+        line_hook, {"event_set": frozenset(("line",)), "lines": breakpoints}
+    )
+    tracer.start({"backend": backend, "native": native})
+    traced_f_trace, _ = with_breakpoint()
+    untraced_f_trace, _ = without_breakpoint()
+    tracer.stop()
+    assert all(not hook.disabled_frames for hook in tracer_module.HOOKS)
+    tracer.clear_hooks()
+
+    assert (with_breakpoint.__name__, line) in lines
+    assert {name for name, lineno in lines} == {"with_breakpoint"}
+    if backend == "settrace":
+        # Frames without a line of interest are not traced past "call".
+        assert traced_f_trace is not None
+        assert untraced_f_trace is None
@@ -0,0 +1,66 @@
+"""Unit test for conditions evaluated by the dispatcher"""
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+from tracer.conditions import Conditions
+
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+LOOP_BODY_LINE = loop.__code__.co_firstlineno + 3
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def run_loop(conditions, native):
+    seen = []
+
+    def line_hook(frame, event, arg):
+        if frame.f_code is loop.__code__ and frame.f_lineno == LOOP_BODY_LINE:
+            seen.append(frame.f_locals["i"])
+        return line_hook
+
+    tracer.add_hook(
+        line_hook, {"event_set": frozenset(("line",)), "conditions": conditions}
+    )
+    tracer.start({"native": native})
+    loop(10)
+    tracer.stop()
+    tracer.clear_hooks()
+    return seen
+
+
+@pytest.mark.parametrize("native", [False, True])
+def test_conditions(native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+
+    conditions = Conditions()
+    conditions.set(loop, LOOP_BODY_LINE, "i % 3 == 0")
+    assert run_loop(conditions, native) == [0, 3, 6, 9]
+    # The condition was compiled once and cached for its line.
+    assert len(conditions.compiled) == 1
+    assert conditions.code_conditions[loop.__code__][LOOP_BODY_LINE] is not None
+
+    assert conditions.remove(loop, LOOP_BODY_LINE)
+    assert not conditions.remove(loop, LOOP_BODY_LINE)
+    assert run_loop(conditions, native) == list(range(10))
+
+    # By filename; a condition that raises counts as true.
+    conditions.set(__file__, LOOP_BODY_LINE, "1 / (i - 5) > 0")
+    assert run_loop(conditions, native) == [5, 6, 7, 8, 9]
+    # A condition for the code object comes before one for its file.
+    conditions.set(loop, LOOP_BODY_LINE, "i % 3 == 0")
+    assert run_loop(conditions, native) == [0, 3, 6, 9]
+
+    with pytest.raises(SyntaxError):
+        conditions.set(loop, LOOP_BODY_LINE, "i ==")
@@ -0,0 +1,77 @@
+"""Unit test for the coverage hook"""
+
+import tracer
+import tracer.tracer as tracer_module
+from tracer.coverage import CodeLines, Coverage, executable_lines
+
+
+def branchy(x):
+    if x:
+        y = 1
+    else:
+        y = 2
+    return y
+
+
+def straight():
+    a = 1
+    return a
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def first_line(function) -> int:
+    return function.__code__.co_firstlineno
+
+
+def test_executable_lines():
+    start = first_line(branchy)
+    assert executable_lines(branchy.__code__) == {start + i for i in (1, 2, 4, 5)}
+
+    code_lines = CodeLines(branchy.__code__)
+    assert code_lines.remaining == 4
+    code_lines.add(start + 1)
+    code_lines.add(start + 1)
+    code_lines.add(start + 100)
+    assert code_lines.remaining == 3
+    assert code_lines.lines() == {start + 1}
+    assert code_lines.missing() == {start + i for i in (2, 4, 5)}
+
+
+def test_coverage():
+    coverage = Coverage()
+    coverage.start()
+    branchy(True)
+    straight()
+    coverage.stop()
+    assert not tracer.is_started()
+
+    start = first_line(branchy)
+    assert coverage.lines(branchy.__code__) == {start + i for i in (1, 2, 5)}
+    assert coverage.missing(branchy.__code__) == {start + 4}
+    assert coverage.code_lines[straight.__code__].remaining == 0
+    assert __file__ in coverage.file_lines()
+
+
+def test_self_disabling():
+    calls = []
+    coverage = Coverage()
+
+    def counting_hook(frame, event, arg):
+        if frame.f_code is straight.__code__:
+            calls.append(event)
+        return coverage.trace_hook(frame, event, arg)
+
+    tracer.add_hook(counting_hook, {"event_set": frozenset(["call", "line"])})
+    tracer.start()
+    straight()
+    straight()
+    disabled_frames = dict(tracer_module.HOOKS[0].disabled_frames)
+    tracer.stop()
+    # Once all of straight()'s lines have run, later calls see only
+    # their "call" event, and their frames are forgotten on return.
+    assert calls == ["call", "line", "line", "call"]
+    assert disabled_frames == {}
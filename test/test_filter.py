@@ -1,7 +1,20 @@
 """Unit test for TracerFilter"""
 
 import inspect
-from tracer.tracefilter import TraceFilter, add_to_code_set
+import re
+import sys
+from types import ModuleType
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+from tracer import tracefilter
+from tracer.tracefilter import (
+    TraceFilter,
+    add_to_code_set,
+    get_module_object,
+    glob_to_regex,
+)
 
 trace_lines = []
 
@@ -38,3 +51,327 @@ def test_basic():
     assert len(filter.excluded_code_objects) == 0
 
     return
+
+
+def test_module_index():
+    code = compile("x = 1", "<string>", "exec")
+    assert get_module_object(code) is None
+    assert "<string>" not in tracefilter.PATH2MODULE
+
+    module_path = "/nonexistent/pytracer_test_module.py"
+    code = compile("def f(): pass", module_path, "exec")
+    assert get_module_object(code) is None
+
+    # The index picks up newly-loaded modules...
+    module = ModuleType("pytracer_test_module")
+    module.__file__ = module_path
+    sys.modules[module.__name__] = module
+    try:
+        assert get_module_object(code) is module
+        exec(code, module.__dict__)
+        assert TraceFilter([module]).is_excluded(module.f)
+    finally:
+        del sys.modules[module.__name__]
+
+    # ... and forgets unloaded ones.
+    assert get_module_object(code) is None
+    assert get_module_object(test_module_index.__code__) is sys.modules[__name__]
+
+    # Unloading one module and loading another doesn't change the size
+    # of sys.modules, but the index still notices.
+    other = ModuleType("pytracer_other_module")
+    sys.modules[other.__name__] = other
+    try:
+        assert get_module_object(code) is None
+        del sys.modules[other.__name__]
+        sys.modules[module.__name__] = module
+        assert get_module_object(code) is module
+    finally:
+        sys.modules.pop(module.__name__, None)
+
+
+def test_verdict_cache(monkeypatch):
+    filter = TraceFilter()
+    current_frame = inspect.currentframe()
+    assert not filter.is_excluded(current_frame)
+    assert filter.code_verdicts == {test_verdict_cache.__code__: False}
+
+    # Changing the filter forgets cached verdicts.
+    assert filter.add(test_verdict_cache)
+    assert filter.is_excluded(current_frame)
+    assert filter.remove(test_verdict_cache)
+    assert not filter.is_excluded(test_verdict_cache)
+    filter.add(sys.modules[__name__])
+    assert filter.is_excluded(current_frame)
+    filter.clear()
+    assert filter.code_verdicts == {}
+    assert not filter.is_excluded(current_frame)
+
+    # A full cache is emptied, so that it doesn't keep code objects
+    # alive forever.
+    monkeypatch.setattr(tracefilter, "MAX_CACHED_CODES", 3)
+    frames = [make_frame(f"<string {i}>", "__main__") for i in range(3)]
+    for frame in frames[:2]:
+        assert not filter.is_excluded(frame)
+    assert len(filter.code_verdicts) == 3
+    assert not filter.is_excluded(frames[2])
+    assert filter.code_verdicts == {frames[2].f_code: False}
+
+
+def make_frame(filename: str, module_name: str):
+    """Return a frame of a function compiled with file name `filename`
+    in a module named `module_name`."""
+    namespace = {"__name__": module_name}
+    # Code objects that differ only in their file names compare equal,
+    # so the docstring makes them differ.
+    source = f"import sys\ndef f():\n    {filename!r}\n    return sys._getframe()\n"
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace["f"]()
+
+
+def test_rules(monkeypatch):
+    site_frame = make_frame("/usr/lib/python3/site-packages/pkg/mod.py", "pkg.mod")
+    other_frame = make_frame("/home/rocky/project/mod.py", "mod")
+
+    filter = TraceFilter()
+    filter.add_rule("site-packages/**")
+    filter.add_rule("tracer.*", kind="module")
+    filter.add_rule(r"^helper_", kind="qualname")
+
+    assert filter.is_excluded(site_frame)
+    assert not filter.is_excluded(other_frame)
+    assert filter.is_excluded(add_to_code_set)
+    assert not filter.is_excluded(test_rules)
+    assert filter.is_excluded(helper_function)
+    assert filter.is_excluded(inspect.currentframe()) is False
+
+    # include rules make exceptions to exclude rules.
+    filter.add_rule("pkg.*", kind="module", include=True)
+    assert not filter.is_excluded(site_frame)
+
+    assert filter.remove_rule("pkg.*", kind="module", include=True)
+    assert filter.remove_rule("site-packages/**")
+    assert not filter.remove_rule("site-packages/**")
+    assert not filter.is_excluded(site_frame)
+
+    with pytest.raises(ValueError):
+        filter.add_rule("x", kind="regex")
+
+    # Windows paths match patterns separated by "/" or by backslashes.
+    windows_frame = make_frame(r"C:\Python\Lib\site-packages\pkg\mod.py", "pkg.mod")
+    monkeypatch.setattr(tracefilter.os, "sep", "\\")
+    for pattern in ("site-packages/**", r"site-packages\**"):
+        filter = TraceFilter()
+        filter.add_rule(pattern)
+        assert filter.is_excluded(windows_frame)
+        assert not filter.is_excluded(other_frame)
+    return
+
+
+def helper_function():
+    pass
+
+
+def test_glob_to_regex():
+    def matches(pattern, path):
+        return re.match(glob_to_regex(pattern), path) is not None
+
+    assert matches("*.py", "/usr/lib/os.py")
+    assert not matches("*.py", "/usr/lib/os.pyc")
+    assert matches("site-packages/**", "/usr/lib/site-packages/a/b.py")
+    assert matches("/usr/**/os.py", "/usr/os.py")
+    assert matches("/usr/**/os.py", "/usr/lib/python/os.py")
+    assert not matches("/usr/*/os.py", "/usr/lib/python/os.py")
+    assert not matches("/usr/**", "/opt/usr/os.py")
+    assert matches("test_[!x]*.py", "/a/test_filter.py")
+
+
+def traced():
+    return untraced()
+
+
+def untraced():
+    return 1
+
+
+def test_include_mode():
+    filter = TraceFilter([traced], mode="include")
+    assert not filter.is_excluded(traced)
+    assert filter.is_excluded(untraced)
+    assert filter.is_excluded(inspect)
+    filter.add_rule(__name__, kind="module")
+    assert not filter.is_excluded(untraced)
+    assert filter.is_excluded(inspect.getabsfile)
+
+    with pytest.raises(ValueError):
+        TraceFilter(mode="both")
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_start_trace_filter(backend, native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    events = []
+
+    def record_hook(frame, event, arg):
+        events.append((frame.f_code.co_name, event))
+        return record_hook
+
+    tracer.clear_hooks_and_stop()
+    tracer.add_hook(record_hook)
+    tracer.start(
+        {
+            "backend": backend,
+            "native": native,
+            "trace_filter": TraceFilter([traced], mode="include"),
+        }
+    )
+    traced()
+    tracer.stop()
+    tracer.clear_hooks()
+    assert {name for name, event in events} == {"traced"}
+    assert ("traced", "call") in events
+    assert ("traced", "return") in events
+
+
+class CountingFilter(TraceFilter):
+    def __init__(self, *args, **kwargs):
+        self.calls = 0
+        super().__init__(*args, **kwargs)
+
+    def is_excluded(self, object) -> bool:
+        self.calls += 1
+        return super().is_excluded(object)
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_hook_filter(backend, native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    events1 = []
+    events2 = []
+    events3 = []
+
+    def hook1(frame, event, arg):
+        events1.append((frame.f_code.co_name, event))
+        return hook1
+
+    def hook2(frame, event, arg):
+        events2.append((frame.f_code.co_name, event))
+        return hook2
+
+    def hook3(frame, event, arg):
+        events3.append((frame.f_code.co_name, event))
+        return hook3
+    filter = CountingFilter([untraced])
+    tracer.clear_hooks_and_stop()
+    tracer.add_hook(hook1, {"filter": filter})
+    tracer.add_hook(hook2, {"filter": filter})
+    tracer.add_hook(hook3)
+    # add_hook() runs the filter on the caller frames it sets up to be
+    # traced; count only the dispatcher's calls.
+    filter.calls = 0
+    tracer.start({"backend": backend, "native": native})
+    traced()
+    tracer.stop()
+    assert all(not hook.disabled_frames for hook in tracer_module.HOOKS)
+    tracer.clear_hooks()
+
+    names1 = {name for name, event in events1}
+    assert "traced" in names1 and "untraced" not in names1
+    assert events1 == events2
+    assert ("untraced", "line") in events3
+    # One call to the shared filter for each of traced() and untraced().
+    # The dispatcher ignores stop().
+    assert filter.calls == 2
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_line_hook_filter(backend, native):
+    """The filter of a hook that doesn't get "call" events applies."""
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    line_events = []
+
+    def line_hook(frame, event, arg):
+        line_events.append((frame.f_code.co_name, event))
+        return line_hook
+
+    filter = TraceFilter([untraced])
+    tracer.add_hook(line_hook, {"event_set": frozenset(("line",)), "filter": filter})
+    tracer.start({"backend": backend, "native": native})
+    traced()
+    tracer.stop()
+    tracer.clear_hooks()
+    assert ("traced", "line") in line_events
+    assert ("untraced", "line") not in line_events
+
+
+
+def subtree_root():
+    return traced() + leaf()
+
+
+def leaf():
+    return 2
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_subtree(backend, native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    filter = TraceFilter()
+    filter.add(subtree_root, subtree=True)
+    assert filter.is_excluded(subtree_root)
+    assert filter.excludes_subtree(subtree_root)
+    assert not filter.excludes_subtree(traced)
+
+    events = []
+
+    def record_hook(frame, event, arg):
+        events.append((frame.f_code.co_name, event))
+        return record_hook
+
+    tracer.clear_hooks_and_stop()
+    tracer.add_hook(record_hook)
+    tracer.start({"backend": backend, "native": native, "trace_filter": filter})
+    subtree_root()
+    # Code called from the subtree is traced when called from elsewhere.
+    leaf()
+    roots = dict(tracer_module.EXCLUDED_SUBTREE_ROOTS)
+    tracer.stop()
+    tracer.clear_hooks()
+
+    names = {name for name, event in events}
+    assert not names & {"subtree_root", "traced", "untraced"}
+    assert ("leaf", "call") in events
+    assert roots == {}
+
+    assert filter.remove(subtree_root)
+    assert not filter.has_subtrees
+    with pytest.raises(ValueError):
+        TraceFilter(mode="include").add(leaf, subtree=True)
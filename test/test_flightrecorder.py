@@ -0,0 +1,146 @@
+"""Unit test for the flight recorder"""
+
+import mmap
+import sys
+import threading
+
+import tracer
+from tracer.flightrecorder import FlightRecorder
+from tracer.recorder import (
+    CHUNK_CODE,
+    CHUNK_EVENTS,
+    CHUNK_RECORDS,
+    RECORD,
+    read_chunks,
+    unpack_code,
+    unpack_events,
+)
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def fail():
+    raise RuntimeError("boom")
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def read_dump(path):
+    """Return the (event, code name) of each record in the dump `path`."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    names, records = {}, []
+    for kind, offset, length in read_chunks(data):
+        if kind == CHUNK_EVENTS:
+            events = unpack_events(data, offset)
+        elif kind == CHUNK_CODE:
+            index, firstlineno, filename, name = unpack_code(data, offset)
+            names[index] = name
+        elif kind == CHUNK_RECORDS:
+            for fields in RECORD.iter_unpack(data[offset : offset + length]):
+                records.append((events[fields[4]], names[fields[2]]))
+    data.close()
+    return records
+
+
+def test_keeps_last_events():
+    flight_recorder = FlightRecorder(size=64)
+    flight_recorder.start({"event_set": frozenset(("call", "return")), "start": False})
+    tracer.start({"include_threads": True})
+    thread = threading.Thread(target=lambda: [work(i) for i in range(100)])
+    thread.start()
+    thread.join()
+    flight_recorder.stop()
+    threading.settrace(None)
+    assert not tracer.is_started()
+
+    events = flight_recorder.events(thread.ident)
+    assert len(events) == 64
+    # The oldest events were overwritten, and the rest are in order.
+    timestamps = [event[0] for event in events]
+    assert timestamps == sorted(timestamps)
+    work_events = [event[4] for event in events if event[2] is work.__code__]
+    assert 0 < len(work_events) < 200
+    assert work_events[-2:] == ["call", "return"]
+
+
+def test_dump(tmp_path):
+    flight_recorder = FlightRecorder(size=1000)
+    flight_recorder.start()
+    work(3)
+    flight_recorder.stop()
+    path = str(tmp_path / "flight.bin")
+    flight_recorder.dump(path)
+
+    records = read_dump(path)
+    assert ("call", "work") in records
+    assert records.count(("line", "work")) >= 3
+
+
+def test_dump_on_uncaught_exception(tmp_path):
+    path = tmp_path / "crash.bin"
+    flight_recorder = FlightRecorder(size=100, dump_path=str(path))
+    old_hook = threading.excepthook
+    reported = []
+    threading.excepthook = lambda args: reported.append(args.exc_type)
+    try:
+        flight_recorder.start({"start": False})
+        assert sys.excepthook == flight_recorder._excepthook
+        tracer.start({"include_threads": True})
+        thread = threading.Thread(target=fail)
+        thread.start()
+        thread.join()
+        flight_recorder.stop()
+    finally:
+        threading.settrace(None)
+        threading.excepthook = old_hook
+    assert sys.excepthook == sys.__excepthook__
+    # The previous hook is still called, and the events leading up to
+    # the exception were dumped.
+    assert reported == [RuntimeError]
+    assert ("exception", "fail") in read_dump(str(path))
+
+
+def exec_functions(n):
+    for i in range(n):
+        namespace = {}
+        exec(compile(f"def f():\n    return {i}\n", "<string>", "exec"), namespace)
+        namespace["f"]()
+    return
+
+
+def test_bounded_memory(tmp_path):
+    flight_recorder = FlightRecorder(size=16, max_codes=8)
+    flight_recorder.start({"start": False})
+    tracer.start({"include_threads": True})
+    try:
+        for _ in range(20):
+            thread = threading.Thread(target=work, args=(3,))
+            thread.start()
+            thread.join()
+        # Code objects from exec'd strings are freed for reuse once no
+        # recorded event uses them.
+        thread = threading.Thread(target=exec_functions, args=(100,))
+        thread.start()
+        thread.join()
+    finally:
+        flight_recorder.stop()
+        threading.settrace(None)
+    # Rings of exited threads were taken over by new threads.
+    assert len(flight_recorder.rings) <= 3
+    assert len(flight_recorder.codes) < 100
+
+    # Events still have their code objects.
+    events = flight_recorder.events(thread.ident)
+    assert ("call", "f") in [(event[4], event[2].co_name) for event in events]
+    path = str(tmp_path / "flight.bin")
+    flight_recorder.dump(path)
+    assert ("call", "f") in read_dump(path)
@@ -0,0 +1,186 @@
+"""Unit test for the sys.monitoring backend of tracer.start()"""
+
+import asyncio
+import sys
+
+import pytest
+import tracer
+
+trace_lines = []
+
+
+def my_trace_dispatch(frame, event, arg):
+    global trace_lines
+    trace_lines.append((event, frame.f_code.co_name))
+    return my_trace_dispatch
+
+
+def setup_function():
+    global trace_lines
+    trace_lines = []
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def test_bad_backend():
+    with pytest.raises(ValueError):
+        tracer.start({"backend": "bogus"})
+    assert not tracer.is_started()
+
+
+@pytest.mark.skipif(
+    hasattr(sys, "monitoring"), reason="sys.monitoring is available"
+)
+def test_monitoring_unavailable():
+    with pytest.raises(NotImplementedError):
+        tracer.start({"backend": "monitoring"})
+    assert not tracer.is_started()
+
+
+@pytest.mark.skipif(
+    not hasattr(sys, "monitoring"), reason="needs sys.monitoring (3.12+)"
+)
+def test_monitoring_event_set():
+    def foo():
+        x = 1
+        return x
+
+    tracer.add_hook(my_trace_dispatch, {"event_set": frozenset(("call",))})
+    tracer.start({"backend": "monitoring"})
+    assert tracer.is_started()
+    foo()
+    tracer.stop()
+    assert not tracer.is_started()
+    assert ("call", "foo") in trace_lines
+    assert not [entry for entry in trace_lines if entry[0] != "call"]
+    tracer.clear_hooks()
+    return
+
+
+def gen():
+    try:
+        yield 1
+    except ValueError:
+        yield 2
+
+
+async def sleeper():
+    await asyncio.sleep(10)
+
+
+def throw_and_cancel():
+    g = gen()
+    next(g)
+    g.throw(ValueError)
+    g = gen()
+    next(g)
+    try:
+        g.throw(KeyError)
+    except KeyError:
+        pass
+
+    async def cancel_sleeper():
+        task = asyncio.ensure_future(sleeper())
+        await asyncio.sleep(0)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_sleeper())
+    return
+
+
+SETTRACE_EVENTS = frozenset(("call", "exception", "line", "return"))
+
+
+def backend_events(backend: str, event_set=SETTRACE_EVENTS) -> list:
+    tracer.add_hook(my_trace_dispatch, {"event_set": event_set, "backlevel": None})
+    tracer.start({"backend": backend})
+    throw_and_cancel()
+    tracer.stop()
+    tracer.clear_hooks()
+    return [entry for entry in trace_lines if entry[1] in ("gen", "sleeper")]
+
+
+@pytest.mark.skipif(
+    not hasattr(sys, "monitoring"), reason="needs sys.monitoring (3.12+)"
+)
+def test_monitoring_throw():
+    """Throwing into a generator and cancelling a Task give the same
+    events as under sys.settrace."""
+    global trace_lines
+    expected = backend_events("settrace")
+    trace_lines = []
+    got = backend_events("monitoring")
+    assert ("exception", "gen") in got
+    assert ("exception", "sleeper") in got
+    assert got == expected
+    return
+
+
+def raiser(n):
+    total = 0
+    for i in range(n):
+        try:
+            total += 10 // (i - 1)
+        except ZeroDivisionError:
+            total -= 1
+    return total
+
+
+@pytest.mark.skipif(
+    not hasattr(sys, "monitoring"), reason="needs sys.monitoring (3.12+)"
+)
+def test_monitoring_default_events():
+    """A hook with the default event set gets the same line, return and
+    exception events as under sys.settrace, and no "opcode" or C
+    function events."""
+    global trace_lines
+    streams = {}
+    for backend in ("settrace", "monitoring"):
+        trace_lines = []
+        tracer.add_hook(my_trace_dispatch, {"backlevel": None})
+        tracer.start({"backend": backend})
+        raiser(3)
+        throw_and_cancel()
+        tracer.stop()
+        tracer.clear_hooks()
+        streams[backend] = [
+            entry for entry in trace_lines if entry[1] in ("raiser", "gen", "sleeper")
+        ]
+    assert ("line", "raiser") in streams["monitoring"]
+    assert ("exception", "raiser") in streams["monitoring"]
+    assert ("return", "raiser") in streams["monitoring"]
+    assert not [
+        entry
+        for entry in streams["monitoring"]
+        if entry[0] not in ("call", "exception", "line", "return")
+    ]
+    assert streams["monitoring"] == streams["settrace"]
+    return
+
+
+@pytest.mark.skipif(
+    not hasattr(sys, "monitoring"), reason="needs sys.monitoring (3.12+)"
+)
+def test_monitoring_untraced_frames():
+    """Frames that a call-only hook doesn't trace aren't kept."""
+    import tracer.monitoring as monitoring
+
+    def foo():
+        return 1
+
+    def call_hook(frame, event, arg):
+        return None
+
+    tracer.add_hook(call_hook, {"event_set": frozenset(("call",))})
+    tracer.start({"backend": "monitoring"})
+    for _ in range(100):
+        foo()
+    untraced = len(monitoring.UNTRACED_FRAMES)
+    tracer.stop()
+    tracer.clear_hooks()
+    assert untraced == 0
+    return
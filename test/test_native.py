@@ -0,0 +1,98 @@
+"""Unit test for the compiled dispatcher in tracer._dispatch"""
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+
+native = pytest.mark.skipif(
+    tracer_module.NATIVE_DISPATCHER is None, reason="tracer._dispatch is not built"
+)
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def squares():
+    j = 1
+    for _ in range(3):
+        j += j + 2
+        pass
+    return j
+
+
+def bar():
+    return 1
+
+
+def foo():
+    return bar()
+
+
+def trace_run(native: bool, event_set=tracer.ALL_EVENTS) -> list:
+    """Trace squares(), foo() and bar() and return the events seen."""
+    events = []
+
+    def hook(frame, event, arg):
+        name = frame.f_code.co_name
+        if name not in ("squares", "foo", "bar"):
+            return None
+        events.append((event, name, frame.f_lineno))
+        # Turn off tracing in foo() but not in the functions it calls.
+        return name != "foo"
+
+    tracer.add_hook(hook, {"event_set": event_set})
+    tracer.start({"native": native})
+    squares()
+    foo()
+    tracer.stop()
+    tracer.clear_hooks()
+    return events
+
+
+def test_pure_python_fallback():
+    tracer.start({"native": False})
+    assert tracer_module.TRACE_DISPATCHER is tracer_module._tracer_func
+    tracer.stop()
+    return
+
+
+@native
+def test_native_selected():
+    tracer.start()
+    assert tracer_module.TRACE_DISPATCHER is tracer_module.NATIVE_DISPATCHER
+    tracer.stop()
+    return
+
+
+@native
+@pytest.mark.parametrize(
+    "event_set",
+    [tracer.ALL_EVENTS, frozenset(("call",)), frozenset(("call", "return"))],
+)
+def test_native_same_as_python(event_set):
+    expected = trace_run(False, event_set)
+    assert len(expected) > 0
+    assert trace_run(True, event_set) == expected
+    return
+
+
+@native
+def test_native_suspend():
+    events = []
+
+    def hook(frame, event, arg):
+        events.append(event)
+        return hook
+
+    tracer.add_hook(hook, {"event_set": frozenset(("call",))})
+    tracer_module.TRACE_SUSPEND = True
+    try:
+        tracer.start({"native": True})
+        squares()
+        tracer.stop()
+    finally:
+        tracer_module.TRACE_SUSPEND = False
+    assert events == []
+    return
@@ -0,0 +1,115 @@
+"""Unit test for the profiler hook"""
+
+import pstats
+import sys
+import threading
+
+import pytest
+import tracer
+from tracer.profiler import PROFILE_EVENTS, Profiler
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+def work():
+    return sorted([fib(5), fib(3)])
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def find(totals, name):
+    for label, entry in totals.items():
+        if label[2] == name:
+            return entry
+    return None
+
+
+def test_profiler():
+    events = []
+
+    def other_hook(frame, event, arg):
+        events.append(event)
+        return other_hook
+
+    tracer.add_hook(other_hook, {"start": True})
+    profiler = Profiler()
+    profiler.start()
+    work()
+    profiler.stop()
+    tracer.stop()
+    assert events, "other hooks keep running alongside the profiler"
+
+    totals = profiler.totals()
+    calls, primitive, exclusive_ns, inclusive_ns = find(totals, "fib")
+    # fib(5) makes 15 calls, fib(3) 5; only the outermost are primitive.
+    assert calls == 20
+    assert primitive == 2
+    assert 0 < exclusive_ns <= inclusive_ns
+    calls, primitive, exclusive_ns, inclusive_ns = find(totals, "work")
+    assert calls == primitive == 1
+    assert inclusive_ns >= find(totals, "fib")[3]
+
+    table = profiler.format_stats(sort="calls", limit=1)
+    assert "20/2" in table
+    assert len(table.splitlines()) == 2
+    with pytest.raises(ValueError):
+        profiler.format_stats(sort="name")
+
+
+def test_pstats(tmp_path):
+    profiler = Profiler()
+    profiler.start()
+    work()
+    profiler.stop()
+
+    stats = pstats.Stats(profiler)
+    assert stats.total_calls >= 21
+    path = str(tmp_path / "profile.out")
+    profiler.dump_stats(path)
+    stats = pstats.Stats(path)
+    assert any(label[2] == "fib" for label in stats.stats)
+
+
+def test_threads():
+    profiler = Profiler()
+    profiler.start({"thread": threading.current_thread()})
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    work()
+    profiler.stop()
+    assert len(profiler.thread_profiles) == 1
+    assert find(profiler.totals(), "fib")[0] == 20
+
+
+def test_sequential_threads():
+    profiler = Profiler()
+    profiler.start({"start": False})
+    tracer.start({"include_threads": True})
+    try:
+        # Thread ids are reused as soon as a thread has exited.
+        for _ in range(5):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+    finally:
+        profiler.stop()
+        threading.settrace(None)
+    assert find(profiler.totals(), "fib")[0] == 5 * 20
+    assert find(profiler.totals(), "work")[0] == 5
+
+
+@pytest.mark.skipif(not hasattr(sys, "monitoring"), reason="needs sys.monitoring")
+def test_c_functions():
+    profiler = Profiler()
+    tracer.add_hook(profiler.trace_hook, {"event_set": PROFILE_EVENTS})
+    tracer.start({"backend": "monitoring"})
+    work()
+    tracer.stop()
+    entry = find(profiler.totals(), "<built-in method builtins.sorted>")
+    assert entry is not None and entry[:2] == (1, 1)
@@ -0,0 +1,114 @@
+"""Unit test for the binary trace recorder"""
+
+import mmap
+import os
+import threading
+
+import tracer
+from tracer.recorder import (
+    CHUNK_CODE,
+    CHUNK_EVENTS,
+    CHUNK_RECORDS,
+    RECORD,
+    FileSink,
+    MmapRingSink,
+    Recorder,
+    read_chunks,
+    read_header,
+    unpack_code,
+    unpack_events,
+)
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def read_trace(path):
+    """Return the sequence number, code names and (event, code name,
+    line) of each record in the trace file `path`."""
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    sequence, _ = read_header(data)
+    events, names, records = [], {}, []
+    for kind, offset, length in read_chunks(data):
+        if kind == CHUNK_EVENTS:
+            events = unpack_events(data, offset)
+        elif kind == CHUNK_CODE:
+            index, firstlineno, filename, name = unpack_code(data, offset)
+            names[index] = name
+        elif kind == CHUNK_RECORDS:
+            assert length % RECORD.size == 0
+            for fields in RECORD.iter_unpack(data[offset : offset + length]):
+                timestamp, thread_id, index, lineno, event = fields
+                records.append((events[event], names[index], lineno))
+    data.close()
+    return sequence, names, records
+
+
+def test_file_recorder(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    recorder = Recorder(FileSink(path), buffer_records=4)
+    recorder.start()
+    work(3)
+    work(3)
+    recorder.stop()
+    assert not tracer.is_started()
+
+    sequence, names, records = read_trace(path)
+    assert sequence == 0
+    # Each code object is described once.
+    assert sorted(names.values()).count("work") == 1
+    work_records = [record for record in records if record[1] == "work"]
+    assert work_records[0] == ("call", "work", work.__code__.co_firstlineno)
+    assert [record[0] for record in work_records].count("call") == 2
+    assert work_records[-1][0] == "return"
+
+
+def test_mmap_ring(tmp_path):
+    prefix = str(tmp_path / "ring")
+    sink = MmapRingSink(prefix, segment_size=4096, segments=2)
+    recorder = Recorder(sink, buffer_records=16)
+    recorder.start()
+    work(200)
+    recorder.stop()
+
+    assert sorted(os.listdir(tmp_path)) == ["ring.0", "ring.1"]
+    assert sink.sequence >= 2
+    # Only the two newest segments are kept, and each can be read on
+    # its own.
+    newest, names, records = read_trace(f"{prefix}.{sink.sequence % 2}")
+    previous, names, records = read_trace(f"{prefix}.{(sink.sequence - 1) % 2}")
+    assert (previous, newest) == (sink.sequence - 1, sink.sequence)
+    assert "work" in names.values()
+
+
+def test_short_lived_threads(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    recorder = Recorder(FileSink(path), buffer_records=64)
+    recorder.start({"start": False})
+    tracer.start({"include_threads": True})
+    try:
+        for _ in range(50):
+            thread = threading.Thread(target=work, args=(3,))
+            thread.start()
+            thread.join()
+            # Buffers of exited threads are given to new threads.
+            assert len(recorder.buffers) <= 3
+    finally:
+        recorder.stop()
+        threading.settrace(None)
+    # flush() dropped the buffers of exited threads.
+    assert list(recorder.buffers) == [threading.get_ident()]
+
+    # No thread's records were lost.
+    sequence, names, records = read_trace(path)
+    assert [record[:2] for record in records].count(("call", "work")) == 50
@@ -0,0 +1,74 @@
+"""Unit test for statistically-sampled hooks"""
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+from tracer.sampling import AllSampler, EveryNthSampler, IntervalSampler, make_sampler
+
+events = []
+
+
+def record_hook(frame, event, arg):
+    if frame.f_code.co_name == "loop":
+        events.append(event)
+    return record_hook
+
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def setup_function():
+    global events
+    events = []
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def test_every_nth_sampler():
+    sampler = EveryNthSampler(3)
+    assert [sampler("line") for _ in range(6)] == [True, False, False] * 2
+    # Each event type is counted separately.
+    assert sampler("call")
+    with pytest.raises(ValueError):
+        EveryNthSampler(0)
+
+
+def test_interval_sampler():
+    sampler = IntervalSampler(60 * 1000 * 1000)
+    assert sampler("line")
+    assert not sampler("line")
+    with pytest.raises(ValueError):
+        IntervalSampler(-1)
+
+
+def test_make_sampler():
+    assert make_sampler() is None
+    assert isinstance(make_sampler(every=2), EveryNthSampler)
+    assert isinstance(make_sampler(every=2, interval=10), AllSampler)
+
+
+@pytest.mark.parametrize("native", [False, True])
+def test_sample_every(native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    tracer.add_hook(record_hook, {"event_set": {"call", "line"}})
+    tracer.start({"native": native})
+    loop(30)
+    tracer.stop()
+    all_lines = events.count("line")
+
+    setup_function()
+    tracer.add_hook(record_hook, {"sample_every": 3, "event_set": {"call", "line"}})
+    tracer.start({"native": native})
+    loop(30)
+    tracer.stop()
+    # The line events of the caller are counted too, so the sampled
+    # "loop" line events are only roughly a third of all of them.
+    assert events.count("call") == 1
+    assert all_lines // 3 - 1 <= events.count("line") <= all_lines // 3 + 1
+    # A hook skipped by sampling is still run on later events.
+    assert tracer_module.HOOKS[0].disabled_frames == {}
@@ -0,0 +1,145 @@
+"""Unit test for the "sample" backend"""
+
+import signal
+import sys
+import threading
+import time
+
+import pytest
+import tracer
+from tracer.stacksampler import StackSampler
+from tracer.tracefilter import TraceFilter
+
+samples = []
+
+
+def sample_hook(frame, event, arg):
+    samples.append((frame.f_code.co_name, event, arg))
+    return sample_hook
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return
+
+
+def busy_wrapper(seconds):
+    return busy(seconds)
+
+
+def setup_function():
+    global samples
+    samples = []
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def test_sample():
+    tracer.add_hook(sample_hook, {"event_set": frozenset(["sample"])})
+    sampler = StackSampler(1000)
+    this_frame = sys._getframe()
+    sampler.sample({threading.get_ident(): this_frame})
+    assert samples == [("test_sample", "sample", threading.get_ident())]
+
+    # Hooks that don't want "sample" events don't get them.
+    samples.clear()
+    tracer.clear_hooks()
+    tracer.add_hook(sample_hook, {"event_set": frozenset(["call"])})
+    sampler.sample({threading.get_ident(): this_frame})
+    assert samples == []
+    tracer.clear_hooks()
+    tracer.add_hook(sample_hook, {"event_set": frozenset(["sample"])})
+
+    # Excluded frames are skipped over to their callers.
+    samples.clear()
+    sampler.trace_filter = TraceFilter([test_sample])
+    sampler.sample({threading.get_ident(): this_frame})
+    assert samples and samples[0][0] != "test_sample"
+
+    with pytest.raises(ValueError):
+        StackSampler(0)
+    with pytest.raises(ValueError):
+        StackSampler(1000, "sundial")
+
+
+def test_sample_filters():
+    sampler = StackSampler(1000)
+
+    def inner():
+        sampler.sample({threading.get_ident(): sys._getframe()})
+        return
+
+    def outer():
+        inner()
+        return
+
+    def sampled_names():
+        samples.clear()
+        outer()
+        return [name for name, event, arg in samples]
+
+    def start(trace_filter):
+        # The backend's own sampler doesn't take a sample in this test.
+        tracer.start(
+            {
+                "backend": "sample",
+                "sample_interval": 10**9,
+                "trace_filter": trace_filter,
+            }
+        )
+        return
+
+    # A hook isn't given samples of frames that its filter excludes.
+    tracer.add_hook(
+        sample_hook,
+        {"event_set": frozenset(["sample"]), "filter": TraceFilter([inner])},
+    )
+    assert sampled_names() == []
+    tracer.clear_hooks()
+
+    tracer.add_hook(sample_hook, {"event_set": frozenset(["sample"])})
+    assert sampled_names() == ["inner"]
+
+    # Frames that the start() trace filter excludes are skipped over.
+    start(TraceFilter([inner]))
+    assert sampled_names() == ["outer"]
+    tracer.stop()
+
+    # So are the frames in a subtree it excludes.
+    trace_filter = TraceFilter()
+    trace_filter.add(outer, subtree=True)
+    start(trace_filter)
+    assert sampled_names() == ["sampled_names"]
+    tracer.stop()
+
+    return
+
+
+@pytest.mark.parametrize("timer", ["thread", "signal"])
+def test_sample_backend(timer):
+    if timer == "signal" and not hasattr(signal, "setitimer"):
+        pytest.skip("signal.setitimer() not available")
+    tracer.add_hook(sample_hook, {"event_set": frozenset(["sample"])})
+    tracer.start(
+        {
+            "backend": "sample",
+            "sample_interval": 1000,
+            "sample_timer": timer,
+            "sample_filter": TraceFilter([busy]),
+        }
+    )
+    busy_wrapper(0.1)
+    tracer.stop()
+    assert not tracer.is_started()
+    count = len(samples)
+    assert count > 0
+    names = {name for name, event, arg in samples if arg == threading.get_ident()}
+    assert "busy_wrapper" in names
+    assert "busy" not in names
+    assert {event for name, event, arg in samples} == {"sample"}
+
+    # No samples are taken after stopping.
+    busy(0.01)
+    assert len(samples) == count
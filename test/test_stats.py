@@ -0,0 +1,95 @@
+"""Unit test for dispatcher statistics"""
+
+import threading
+import time
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+
+
+def work():
+    x = 1
+    return x
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    tracer.disable_stats()
+    return
+
+
+@pytest.mark.parametrize("native", [False, True])
+def test_stats(native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+
+    def fast_hook(frame, event, arg):
+        return fast_hook
+
+    def slow_hook(frame, event, arg):
+        if frame.f_code is work.__code__:
+            time.sleep(0.001)
+        return slow_hook
+
+    tracer.add_hook(fast_hook)
+    tracer.add_hook(slow_hook, {"event_set": frozenset(("call",))})
+    tracer.enable_stats()
+    tracer.start({"native": native, "include_threads": True})
+    work()
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    tracer.stop()
+    threading.settrace(None)
+    tracer.disable_stats()
+    tracer.clear_hooks()
+
+    stats = tracer.stats()
+    assert stats["events"]["call"] >= 2
+    assert stats["events"]["line"] >= 2
+    fast, slow = stats["hooks"][fast_hook], stats["hooks"][slow_hook]
+    # Both threads are counted.
+    assert slow["calls"] >= 2
+    assert slow["calls"] == stats["events"]["call"]
+    assert fast["calls"] > slow["calls"]
+    assert slow["time_ns"] >= 2_000_000 > fast["time_ns"]
+
+    # Counting has stopped, and stopping again keeps the counts.
+    work()
+    assert tracer.stats() == stats
+    tracer.disable_stats()
+    assert tracer.stats() == stats
+
+    # Enabling again starts from zero.
+    tracer.enable_stats()
+    assert tracer.stats() == {"events": {}, "hooks": {}}
+    tracer.disable_stats()
+
+
+@pytest.mark.parametrize("native", [False, True])
+def test_sequential_threads(native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+
+    calls = []
+
+    def hook(frame, event, arg):
+        calls.append(event)
+        return hook
+
+    tracer.add_hook(hook, {"event_set": frozenset(("call",))})
+    tracer.enable_stats()
+    tracer.start({"native": native, "include_threads": True})
+    # Thread ids are reused as soon as a thread has exited.
+    for _ in range(5):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    tracer.stop()
+    threading.settrace(None)
+    tracer.disable_stats()
+    tracer.clear_hooks()
+
+    # Every thread's calls are counted.
+    assert tracer.stats()["hooks"][hook]["calls"] == len(calls)
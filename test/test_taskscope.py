@@ -0,0 +1,90 @@
+"""Unit test for hooks limited to a contextvars scope"""
+
+import asyncio
+import sys
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+from tracer.taskscope import TraceScope
+
+
+async def handler(n):
+    for _ in range(n):
+        await asyncio.sleep(0)
+    return n
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def record_scoped_events(scope, main, backend="settrace", native=False):
+    events = []
+
+    def scoped_hook(frame, event, arg):
+        if frame.f_code is handler.__code__:
+            events.append((asyncio.current_task().get_name(), event))
+        return scoped_hook
+
+    tracer.add_hook(
+        scoped_hook,
+        {"scope": scope, "event_set": frozenset(("call", "return", "line"))},
+    )
+    tracer.start({"backend": backend, "native": native})
+    asyncio.run(main())
+    tracer.stop()
+    assert all(not hook.disabled_frames for hook in tracer_module.HOOKS)
+    tracer.clear_hooks()
+    return events
+
+
+@pytest.mark.parametrize(
+    "backend, native",
+    [("settrace", False), ("settrace", True), ("monitoring", False)],
+)
+def test_activate(backend, native):
+    if native and tracer_module.NATIVE_DISPATCHER is None:
+        pytest.skip("compiled dispatcher not available")
+    if backend == "monitoring" and not hasattr(sys, "monitoring"):
+        pytest.skip("sys.monitoring not available")
+
+    scope = TraceScope("traced request")
+
+    async def main():
+        with scope.activate():
+            traced = asyncio.create_task(handler(3), name="traced")
+        untraced = asyncio.create_task(handler(3), name="untraced")
+        assert not scope.is_current()
+        await asyncio.gather(traced, untraced)
+
+    events = record_scoped_events(scope, main, backend, native)
+    assert {name for name, event in events} == {"traced"}
+    # handler() is resumed after each of its 3 awaits, and each
+    # resumption and suspension is seen.
+    assert [event for name, event in events].count("call") == 4
+    assert [event for name, event in events].count("return") == 4
+
+
+def test_bind():
+    scope = TraceScope()
+    assert repr(scope) == "TraceScope(None)"
+    with pytest.raises(TypeError):
+        scope.bind("request")
+
+    async def main():
+        first = asyncio.create_task(handler(2), name="first")
+        second = asyncio.create_task(handler(2), name="second")
+        if sys.version_info >= (3, 12):
+            scope.bind(second)
+        else:
+            with pytest.raises(NotImplementedError):
+                scope.bind(second)
+        await asyncio.gather(first, second)
+
+    events = record_scoped_events(scope, main)
+    if sys.version_info >= (3, 12):
+        assert {name for name, event in events} == {"second"}
+    else:
+        assert events == []
@@ -0,0 +1,112 @@
+"""Unit test for thread-specific hooks and thread-scoped tracing"""
+
+import sys
+import threading
+
+import pytest
+import tracer
+import tracer.tracer as tracer_module
+
+events = []
+
+
+def record_hook(frame, event, arg):
+    if frame.f_code.co_name == "work":
+        events.append((threading.get_ident(), event))
+    return record_hook
+
+
+def work():
+    return 1
+
+
+def setup_function():
+    global events
+    events = []
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def run_in_thread(func) -> threading.Thread:
+    thread = threading.Thread(target=func)
+    thread.start()
+    thread.join()
+    return thread
+
+
+def test_get_thread_id():
+    assert tracer_module.get_thread_id(5) == 5
+    assert tracer_module.get_thread_id(threading.current_thread()) == threading.get_ident()
+    with pytest.raises(ValueError):
+        tracer_module.get_thread_id(threading.Thread(target=work))
+    with pytest.raises(TypeError):
+        tracer_module.get_thread_id("main")
+    return
+
+
+def test_thread_hook():
+    """A hook bound to a thread only sees events from that thread."""
+    main_id = threading.get_ident()
+    tracer.add_hook(record_hook, {"thread": main_id, "event_set": frozenset(("call",))})
+    assert tracer_module.REGISTRY.thread_scoped
+    tracer.start({"include_threads": True})
+    work()
+    thread = run_in_thread(work)
+    tracer.stop()
+    threading.settrace(None)
+    tracer.clear_hooks()
+    assert not tracer_module.REGISTRY.thread_scoped
+    assert events == [(main_id, "call")]
+    assert thread.ident != main_id
+    return
+
+
+def test_thread_scoped_start():
+    """Only the threads given in the "threads" start option are traced."""
+    ready = threading.Event()
+    go = threading.Event()
+    done = threading.Event()
+
+    def worker():
+        ready.set()
+        go.wait()
+        work()
+        done.set()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    ready.wait()
+
+    tracer.add_hook(record_hook, {"event_set": frozenset(("call",))})
+    tracer.start({"threads": [thread]})
+    assert tracer_module.REGISTRY.traced_threads == frozenset((thread.ident,))
+    work()  # The current thread isn't traced.
+    go.set()
+    done.wait()
+    thread.join()
+    tracer.stop()
+    tracer.clear_hooks()
+
+    main_id = threading.get_ident()
+    assert (main_id, "call") not in events
+    if hasattr(threading, "settrace_all_threads"):
+        assert events == [(thread.ident, "call")]
+    return
+
+
+def test_thread_scoped_stop():
+    """Stopping tracing in one thread leaves it on in the others."""
+    main_id = threading.get_ident()
+    tracer.add_hook(record_hook, {"event_set": frozenset(("call",))})
+    tracer.start({"threads": [main_id, main_id + 1]})
+    work()
+    assert tracer.stop({"threads": [main_id]}) == 1
+    assert tracer.is_started()
+    assert tracer_module.REGISTRY.traced_threads == frozenset((main_id + 1,))
+    assert sys.gettrace() is None
+    work()
+    tracer.stop({"threads": [main_id + 1]})
+    assert not tracer.is_started()
+    tracer.clear_hooks()
+    assert events == [(main_id, "call")]
+    return
@@ -176,17 +176,11 @@ def test_trace_filtering():
 
     #  for entry in trace_lines:
     #    print entry.event, entry.filename, entry.lineno, entry.name
-    assert len(trace_lines) >= 2, "Should have captured some trace output"
+    assert len(trace_lines) >= 1, "Should have captured some trace output"
+    # The hooks don't see stop(), which changes the registry.
     for i, right in [
         (
             -1,
-            (
-                "call",
-                "stop",
-            ),
-        ),
-        (
-            -2,
             (
                 "call",
                 "foo",
@@ -195,3 +189,72 @@ def test_trace_filtering():
     ]:
         assert trace_lines[i].event, trace_lines[i].name == right
     return
+
+
+def test_local_trace_pruning():
+    """Test that frames aren't locally traced when no hook wants local events."""
+    import sys
+
+    tracer.clear_hooks_and_stop()
+    f_traces = []
+
+    def foo():
+        f_traces.append(sys._getframe().f_trace)
+        return
+
+    tracer.add_hook(my_trace_dispatch, {"start": True, "event_set": frozenset(("call",))})
+    assert tracer.tracer.REGISTRY.tables.local_event_set == frozenset()
+    foo()
+    tracer.clear_hooks()
+    tracer.add_hook(my_trace_dispatch, {"event_set": frozenset(("call", "return"))})
+    assert tracer.tracer.REGISTRY.tables.local_event_set == frozenset(("return",))
+    foo()
+    tracer.clear_hooks_and_stop()
+
+    assert f_traces[0] is None
+    assert f_traces[1] is not None
+    assert [entry.event for entry in trace_lines if entry.name == "foo"] == [
+        "call",
+        "call",
+        "return",
+    ]
+    return
+
+
+def test_disabled_frames():
+    """Test that a hook returning a false value stops tracing just that frame."""
+    import sys
+
+    tracer.clear_hooks_and_stop()
+    events = []
+    f_traces = []
+
+    def picky_hook(frame, event, arg):
+        if frame.f_code.co_name not in ("foo", "bar"):
+            return None
+        events.append((event, frame.f_code.co_name))
+        # Turn off tracing in "foo", but not in "bar".
+        return frame.f_code.co_name == "bar"
+
+    def bar():
+        f_traces.append(sys._getframe().f_trace)
+        return
+
+    def foo():
+        f_traces.append(sys._getframe().f_trace)
+        bar()
+        return
+
+    tracer.add_hook(picky_hook, {"start": True})
+    foo()
+    tracer.stop()
+    hook = tracer.tracer.HOOKS[tracer.find_hook(picky_hook)]
+    tracer.clear_hooks()
+
+    assert f_traces[0] is None, "foo() should not be locally traced"
+    assert f_traces[1] is not None, "bar() should be locally traced"
+    assert [event for event in events if event[1] == "foo"] == [("call", "foo")]
+    assert ("line", "bar") in events
+    assert ("return", "bar") in events
+    assert len(hook.disabled_frames) == 0
+    return
@@ -0,0 +1,78 @@
+"""Unit test for reading and querying recorded traces"""
+
+import os
+import threading
+
+import tracer
+from tracer.recorder import FileSink, Recorder
+from tracer.tracereader import TraceReader, main
+
+
+def work(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def setup_function():
+    tracer.clear_hooks_and_stop()
+    return
+
+
+def record(path):
+    recorder = Recorder(FileSink(path), buffer_records=16)
+    recorder.start({"start": False})
+    tracer.start({"include_threads": True})
+    work(10)
+    thread = threading.Thread(target=work, args=(5,))
+    thread.start()
+    thread.join()
+    recorder.stop()
+    threading.settrace(None)
+    return thread.ident
+
+
+def test_queries(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    thread_id = record(path)
+    main_id = threading.get_ident()
+
+    with TraceReader(path) as reader:
+        assert os.path.exists(path + ".idx")
+        assert {main_id, thread_id} <= reader.thread_ids()
+        # Records are written in chunks of at most 16.
+        assert len(reader.chunks) > 1
+        assert reader.record_count() == len(list(reader.events()))
+
+        events = list(reader.events(thread_id=thread_id, code="work"))
+        assert [event.event for event in events].count("line") >= 5
+        assert events[0].event == "call"
+        assert events[-1].event == "return"
+        assert {event.thread_id for event in events} == {thread_id}
+
+        first, last = reader.time_range()
+        middle = events[len(events) // 2].timestamp
+        later = list(reader.events(code="work", start_ns=middle, end_ns=last))
+        assert later and all(middle <= event.timestamp <= last for event in later)
+        assert not list(reader.events(code="no such function"))
+        chunks = reader.chunks
+
+    # A second reader uses the saved index.
+    with TraceReader(path) as reader:
+        assert reader.chunks == chunks
+        assert len(list(reader.events(thread_id=thread_id, code="work"))) == len(
+            events
+        )
+
+
+def test_cli(tmp_path, capsys):
+    path = str(tmp_path / "trace.bin")
+    thread_id = record(path)
+    assert main(["info", path]) == 0
+    assert str(thread_id) in capsys.readouterr().out
+    assert main(["events", path, "--thread", str(thread_id), "--limit", "3"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    assert main(["index", path]) == 0
+    assert os.path.exists(path + ".idx")
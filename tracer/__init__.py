@@ -16,6 +16,8 @@ from tracer.tracer import (
     add_hook,
     clear_hooks,
     clear_hooks_and_stop,
+    disable_stats,
+    enable_stats,
     find_hook,
     is_started,
     null_trace_hook,
@@ -23,6 +25,7 @@ from tracer.tracer import (
     remove_hook,
     size,
     start,
+    stats,
     stop,
 )
 from tracer.version import __version__
@@ -37,6 +40,8 @@ __all__ = [
     "add_hook",
     "clear_hooks",
     "clear_hooks_and_stop",
+    "disable_stats",
+    "enable_stats",
     "find_hook",
     "get_code_object",
     "get_module_object",
@@ -46,5 +51,6 @@ __all__ = [
     "remove_hook",
     "size",
     "start",
+    "stats",
     "stop",
 ]
@@ -0,0 +1,731 @@
+/*
+   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+
+   This program is free software: you can redistribute it and/or modify
+   it under the terms of the GNU General Public License as published by
+   the Free Software Foundation, either version 3 of the License, or
+   (at your option) any later version.
+
+   This program is distributed in the hope that it will be useful,
+   but WITHOUT ANY WARRANTY; without even the implied warranty of
+   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+   GNU General Public License for more details.
+
+   You should have received a copy of the GNU General Public License
+   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+*/
+
+/*
+   A compiled version of tracer.tracer._tracer_func().
+
+   A Dispatcher object is given the tracer.tracer module dictionary and
+   reads the dispatcher state (REGISTRY_UPDATES, TRACE_SUSPEND,
+   REGISTRY, ...) from it
+   on each event, so it behaves exactly like
+   the pure-Python _tracer_func() and sees registry changes right away.
+   When the module's "debug" flag is set, events are passed on to the
+   pure-Python fallback.
+*/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stddef.h>
+
+#ifndef Py_TPFLAGS_HAVE_VECTORCALL
+#define Py_TPFLAGS_HAVE_VECTORCALL _Py_TPFLAGS_HAVE_VECTORCALL
+#endif
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *globals;  /* tracer.tracer.__dict__ */
+    PyObject *fallback; /* tracer.tracer._tracer_func */
+    vectorcallfunc vectorcall;
+} DispatcherObject;
+
+static PyObject *str_REGISTRY_UPDATES;
+static PyObject *str_REGISTRY_UPDATE;
+static PyObject *str_REGISTRY_UPDATE_CODES;
+static PyObject *str_depth;
+static PyObject *str_TRACE_SUSPEND;
+static PyObject *str_debug;
+static PyObject *str_inspect;
+static PyObject *str_REGISTRY;
+static PyObject *str__current_thread_tables;
+static PyObject *str_call;
+static PyObject *str_return;
+static PyObject *str_line;
+static PyObject *str_f_trace_lines;
+static PyObject *str_is_excluded;
+static PyObject *str_has_subtrees;
+static PyObject *str__excluded_subtree_call;
+static PyObject *str_count_event;
+static PyObject *str_call_hook;
+
+/* Field positions in a tracer.tracer.TraceEntry. */
+#define ENTRY_TRACE_FUNC 0
+#define ENTRY_DISABLED_FRAMES 2
+#define ENTRY_SAMPLER 4
+#define ENTRY_CONDITIONS 7
+#define ENTRY_SIZE 8
+
+/* Field positions in a tracer.tracer.HookRegistry. */
+#define REGISTRY_HOOKS 0
+#define REGISTRY_TABLES 1
+#define REGISTRY_THREAD_SCOPED 4
+#define REGISTRY_TRACE_FILTER 5
+#define REGISTRY_STATS 6
+#define REGISTRY_SIZE 7
+
+/* Field positions in a tracer.tracer.HookTables. */
+#define TABLES_DISPATCH_TABLE 0
+#define TABLES_LOCAL_HOOKS 1
+#define TABLES_LOCAL_EVENT_SET 2
+#define TABLES_FILTERED_HOOKS 3
+#define TABLES_SIZE 4
+
+/* Return a new reference to globals[name], or NULL with no exception
+   set if it isn't there. */
+static PyObject *
+get_global(DispatcherObject *self, PyObject *name)
+{
+    PyObject *value = PyDict_GetItemWithError(self->globals, name);
+    Py_XINCREF(value);
+    return value;
+}
+
+/* Return 1 if globals[name] is true, 0 if it is false or missing, and
+   -1 on error. */
+static int
+global_is_true(DispatcherObject *self, PyObject *name)
+{
+    int result;
+    PyObject *value = get_global(self, name);
+    if (value == NULL)
+        return PyErr_Occurred() ? -1 : 0;
+    result = PyObject_IsTrue(value);
+    Py_DECREF(value);
+    return result;
+}
+
+static int
+event_is(PyObject *event, PyObject *name)
+{
+    return event == name ||
+           (PyUnicode_Check(event) && PyUnicode_Compare(event, name) == 0);
+}
+
+static int
+check_entry(PyObject *entry)
+{
+    if (!PyTuple_Check(entry) || PyTuple_GET_SIZE(entry) < ENTRY_SIZE ||
+        !PyDict_Check(PyTuple_GET_ITEM(entry, ENTRY_DISABLED_FRAMES))) {
+        PyErr_SetString(PyExc_TypeError, "hook entries should be TraceEntry tuples");
+        return -1;
+    }
+    return 0;
+}
+
+/* Set *frame_id to id(frame) if it hasn't been computed yet. */
+static int
+get_frame_id(PyObject *frame, PyObject **frame_id)
+{
+    if (*frame_id == NULL) {
+        *frame_id = PyLong_FromVoidPtr(frame);
+        if (*frame_id == NULL)
+            return -1;
+    }
+    return 0;
+}
+
+/* Return 1 if the hook `entry` has turned off tracing for `frame`, 0 if
+   not and -1 on error. */
+static int
+is_disabled(PyObject *entry, PyObject *frame, PyObject **frame_id)
+{
+    PyObject *disabled_frames, *value;
+
+    if (check_entry(entry) < 0)
+        return -1;
+    disabled_frames = PyTuple_GET_ITEM(entry, ENTRY_DISABLED_FRAMES);
+    if (PyDict_GET_SIZE(disabled_frames) == 0)
+        return 0;
+    if (get_frame_id(frame, frame_id) < 0)
+        return -1;
+    value = PyDict_GetItemWithError(disabled_frames, *frame_id);
+    if (value == NULL)
+        return PyErr_Occurred() ? -1 : 0;
+    return value == frame;
+}
+
+/* The same as tracer.tracer._enable_frame(). */
+static int
+enable_frame(PyObject *registry, PyObject *frame, PyObject **frame_id)
+{
+    Py_ssize_t i;
+    PyObject *entries = PyTuple_GET_ITEM(registry, REGISTRY_HOOKS);
+
+    if (!PyTuple_Check(entries)) {
+        PyErr_SetString(PyExc_TypeError, "registry hooks should be a tuple");
+        return -1;
+    }
+    for (i = 0; i < PyTuple_GET_SIZE(entries); i++) {
+        PyObject *entry = PyTuple_GET_ITEM(entries, i);
+        PyObject *disabled_frames;
+        if (check_entry(entry) < 0)
+            return -1;
+        disabled_frames = PyTuple_GET_ITEM(entry, ENTRY_DISABLED_FRAMES);
+        if (PyDict_GET_SIZE(disabled_frames) == 0)
+            continue;
+        if (get_frame_id(frame, frame_id) < 0)
+            return -1;
+        if (PyDict_DelItem(disabled_frames, *frame_id) < 0) {
+            if (!PyErr_ExceptionMatches(PyExc_KeyError))
+                return -1;
+            PyErr_Clear();
+        }
+    }
+    return 0;
+}
+
+/* Run the hooks in the tuple `hooks` on (frame, event, arg). If
+   `stats` is not None, a hook is run by stats.call_hook(). */
+static int
+run_hooks(PyObject *hooks, PyObject *const *args, PyObject **frame_id,
+          PyObject *stats)
+{
+    Py_ssize_t i;
+    PyObject *frame = args[0];
+
+    for (i = 0; i < PyTuple_GET_SIZE(hooks); i++) {
+        PyObject *entry = PyTuple_GET_ITEM(hooks, i);
+        PyObject *sampler, *conditions, *result;
+        int disabled, keep_tracing;
+
+        disabled = is_disabled(entry, frame, frame_id);
+        if (disabled < 0)
+            return -1;
+        if (disabled)
+            continue;
+
+        sampler = PyTuple_GET_ITEM(entry, ENTRY_SAMPLER);
+        if (sampler != Py_None) {
+            int sampled;
+            result = PyObject_CallOneArg(sampler, args[1]);
+            if (result == NULL)
+                return -1;
+            sampled = PyObject_IsTrue(result);
+            Py_DECREF(result);
+            if (sampled < 0)
+                return -1;
+            if (!sampled)
+                continue;
+        }
+
+        conditions = PyTuple_GET_ITEM(entry, ENTRY_CONDITIONS);
+        if (conditions != Py_None) {
+            int satisfied;
+            result = PyObject_Vectorcall(conditions, args, 2, NULL);
+            if (result == NULL)
+                return -1;
+            satisfied = PyObject_IsTrue(result);
+            Py_DECREF(result);
+            if (satisfied < 0)
+                return -1;
+            if (!satisfied)
+                continue;
+        }
+
+        if (stats == Py_None) {
+            result = PyObject_Vectorcall(PyTuple_GET_ITEM(entry, ENTRY_TRACE_FUNC),
+                                         args, 3, NULL);
+        } else {
+            PyObject *method_args[5] = {
+                stats, PyTuple_GET_ITEM(entry, ENTRY_TRACE_FUNC), args[0], args[1],
+                args[2]};
+            result = PyObject_VectorcallMethod(str_call_hook, method_args, 5, NULL);
+        }
+        if (result == NULL)
+            return -1;
+        keep_tracing = PyObject_IsTrue(result);
+        Py_DECREF(result);
+        if (keep_tracing < 0)
+            return -1;
+        if (!keep_tracing) {
+            /* sys.settrace's semantics provide that a if trace hook
+               returns None or False, it should turn off tracing for
+               that frame. */
+            if (get_frame_id(frame, frame_id) < 0)
+                return -1;
+            if (PyDict_SetItem(PyTuple_GET_ITEM(entry, ENTRY_DISABLED_FRAMES),
+                               *frame_id, frame) < 0)
+                return -1;
+        }
+    }
+    return 0;
+}
+
+/* The same as tracer.tracer._filter_hooks(). Return 0, or -1 on
+   error. */
+static int
+filter_hooks(PyObject *filtered_hooks, PyObject *frame, PyObject **frame_id)
+{
+    Py_ssize_t i, j;
+
+    if (!PyTuple_Check(filtered_hooks)) {
+        PyErr_SetString(PyExc_TypeError, "filtered_hooks should be a tuple");
+        return -1;
+    }
+    for (i = 0; i < PyTuple_GET_SIZE(filtered_hooks); i++) {
+        PyObject *pair = PyTuple_GET_ITEM(filtered_hooks, i);
+        PyObject *hooks, *excluded;
+        int flag;
+
+        if (!PyTuple_Check(pair) || PyTuple_GET_SIZE(pair) != 2 ||
+            !PyTuple_Check(PyTuple_GET_ITEM(pair, 1))) {
+            PyErr_SetString(PyExc_TypeError,
+                            "filtered_hooks should contain (filter, hooks) pairs");
+            return -1;
+        }
+        excluded = PyObject_CallMethodOneArg(PyTuple_GET_ITEM(pair, 0),
+                                             str_is_excluded, frame);
+        if (excluded == NULL)
+            return -1;
+        flag = PyObject_IsTrue(excluded);
+        Py_DECREF(excluded);
+        if (flag < 0)
+            return -1;
+        if (!flag)
+            continue;
+        if (get_frame_id(frame, frame_id) < 0)
+            return -1;
+        hooks = PyTuple_GET_ITEM(pair, 1);
+        for (j = 0; j < PyTuple_GET_SIZE(hooks); j++) {
+            PyObject *entry = PyTuple_GET_ITEM(hooks, j);
+            if (check_entry(entry) < 0)
+                return -1;
+            if (PyDict_SetItem(PyTuple_GET_ITEM(entry, ENTRY_DISABLED_FRAMES),
+                               *frame_id, frame) < 0)
+                return -1;
+        }
+    }
+    return 0;
+}
+
+/* Return 1 if every hook wanting local events has turned off tracing
+   for `frame`, 0 if not, and -1 on error. */
+static int
+all_local_hooks_disabled(PyObject *local_hooks, PyObject *frame, PyObject **frame_id)
+{
+    Py_ssize_t i;
+
+    if (!PyTuple_Check(local_hooks)) {
+        PyErr_SetString(PyExc_TypeError, "local_hooks should be a tuple");
+        return -1;
+    }
+    for (i = 0; i < PyTuple_GET_SIZE(local_hooks); i++) {
+        int disabled = is_disabled(PyTuple_GET_ITEM(local_hooks, i), frame, frame_id);
+        if (disabled <= 0)
+            return disabled;
+    }
+    return 1;
+}
+
+/* If `trace_filter` excludes some subtrees, return
+   tracer.tracer._excluded_subtree_call(trace_filter, frame); otherwise
+   return False. */
+static PyObject *
+excluded_subtree_call(DispatcherObject *self, PyObject *trace_filter, PyObject *frame)
+{
+    PyObject *func, *result;
+    PyObject *value = PyObject_GetAttr(trace_filter, str_has_subtrees);
+    int flag;
+
+    if (value == NULL)
+        return NULL;
+    flag = PyObject_IsTrue(value);
+    Py_DECREF(value);
+    if (flag < 0)
+        return NULL;
+    if (!flag)
+        Py_RETURN_FALSE;
+
+    func = get_global(self, str__excluded_subtree_call);
+    if (func == NULL) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_NameError, "_excluded_subtree_call");
+        return NULL;
+    }
+    {
+        PyObject *args[2] = {trace_filter, frame};
+        result = PyObject_Vectorcall(func, args, 2, NULL);
+    }
+    Py_DECREF(func);
+    return result;
+}
+
+/* Return 1 if the dispatcher should ignore `event` for `frame` because
+   the current thread is changing the registry, 0 if not, and -1 on
+   error. */
+static int
+in_registry_update(DispatcherObject *self, PyObject *frame, PyObject *event)
+{
+    int flag = global_is_true(self, str_REGISTRY_UPDATES);
+
+    if (flag > 0) {
+        PyObject *update = get_global(self, str_REGISTRY_UPDATE);
+        PyObject *depth;
+        if (update == NULL)
+            return PyErr_Occurred() ? -1 : 0;
+        depth = PyObject_GetAttr(update, str_depth);
+        Py_DECREF(update);
+        if (depth == NULL)
+            return -1;
+        flag = PyObject_IsTrue(depth);
+        Py_DECREF(depth);
+    }
+    if (flag != 0)
+        return flag;
+
+    /* The "call" of a function that enters REGISTRY_UPDATE comes before
+       it does. */
+    if (event_is(event, str_call) && PyFrame_Check(frame)) {
+        PyObject *codes = get_global(self, str_REGISTRY_UPDATE_CODES);
+        PyCodeObject *code;
+        PyObject *code_id;
+        if (codes == NULL)
+            return PyErr_Occurred() ? -1 : 0;
+        code = PyFrame_GetCode((PyFrameObject *)frame);
+        code_id = PyLong_FromVoidPtr(code);
+        Py_DECREF(code);
+        if (code_id == NULL) {
+            Py_DECREF(codes);
+            return -1;
+        }
+        flag = PySequence_Contains(codes, code_id);
+        Py_DECREF(code_id);
+        Py_DECREF(codes);
+    }
+    return flag;
+}
+
+/* Return a new reference to the current HookRegistry. */
+static PyObject *
+get_registry(DispatcherObject *self)
+{
+    PyObject *registry = get_global(self, str_REGISTRY);
+
+    if (registry == NULL) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_NameError, "REGISTRY");
+        return NULL;
+    }
+    if (!PyTuple_Check(registry) || PyTuple_GET_SIZE(registry) < REGISTRY_SIZE) {
+        Py_DECREF(registry);
+        PyErr_SetString(PyExc_TypeError, "REGISTRY should be a HookRegistry tuple");
+        return NULL;
+    }
+    return registry;
+}
+
+/* Return a new reference to the HookTables in `registry` to use in the
+   current thread. NULL with no exception set means the current thread
+   isn't traced. */
+static PyObject *
+get_tables(DispatcherObject *self, PyObject *registry)
+{
+    PyObject *tables;
+    int flag = PyObject_IsTrue(PyTuple_GET_ITEM(registry, REGISTRY_THREAD_SCOPED));
+
+    if (flag < 0)
+        return NULL;
+    if (flag) {
+        PyObject *func = get_global(self, str__current_thread_tables);
+        if (func == NULL) {
+            if (!PyErr_Occurred())
+                PyErr_SetString(PyExc_NameError, "_current_thread_tables");
+            return NULL;
+        }
+        tables = PyObject_CallOneArg(func, registry);
+        Py_DECREF(func);
+        if (tables == NULL)
+            return NULL;
+        if (tables == Py_None) {
+            Py_DECREF(tables);
+            return NULL;
+        }
+    } else {
+        tables = PyTuple_GET_ITEM(registry, REGISTRY_TABLES);
+        Py_INCREF(tables);
+    }
+    if (!PyTuple_Check(tables) || PyTuple_GET_SIZE(tables) < TABLES_SIZE) {
+        Py_DECREF(tables);
+        PyErr_SetString(PyExc_TypeError, "hook tables should be a HookTables tuple");
+        return NULL;
+    }
+    return tables;
+}
+
+static PyObject *
+dispatcher_vectorcall(PyObject *callable, PyObject *const *args, size_t nargsf,
+                      PyObject *kwnames)
+{
+    DispatcherObject *self = (DispatcherObject *)callable;
+    PyObject *frame, *event;
+    PyObject *frame_id = NULL;
+    PyObject *result = NULL;
+    PyObject *registry, *tables, *stats;
+    int flag;
+
+    if (PyVectorcall_NARGS(nargsf) != 3 || (kwnames && PyTuple_GET_SIZE(kwnames))) {
+        PyErr_SetString(PyExc_TypeError,
+                        "Dispatcher takes exactly 3 positional arguments");
+        return NULL;
+    }
+    frame = args[0];
+    event = args[1];
+
+    flag = in_registry_update(self, frame, event);
+    if (flag < 0)
+        return NULL;
+    if (flag) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+
+    flag = global_is_true(self, str_debug);
+    if (flag < 0)
+        return NULL;
+    if (flag)
+        return PyObject_Vectorcall(self->fallback, args, 3, NULL);
+
+    flag = global_is_true(self, str_TRACE_SUSPEND);
+    if (flag < 0)
+        return NULL;
+    if (flag) {
+        Py_INCREF(self);
+        return (PyObject *)self;
+    }
+
+    /* Everything below uses this one snapshot of the registry. */
+    registry = get_registry(self);
+    if (registry == NULL)
+        return NULL;
+    tables = get_tables(self, registry);
+    if (tables == NULL) {
+        Py_DECREF(registry);
+        if (PyErr_Occurred())
+            return NULL;
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    stats = PyTuple_GET_ITEM(registry, REGISTRY_STATS);
+    if (stats != Py_None) {
+        PyObject *counted = PyObject_CallMethodOneArg(stats, str_count_event, event);
+        if (counted == NULL)
+            goto done;
+        Py_DECREF(counted);
+    }
+
+    if (event_is(event, str_call)) {
+        PyObject *trace_filter = PyTuple_GET_ITEM(registry, REGISTRY_TRACE_FILTER);
+        if (trace_filter != Py_None) {
+            PyObject *excluded;
+
+            result = excluded_subtree_call(self, trace_filter, frame);
+            if (result == NULL)
+                goto done;
+            if (result != Py_False)
+                goto done;
+            Py_DECREF(result);
+            result = NULL;
+
+            excluded = PyObject_CallMethodOneArg(trace_filter, str_is_excluded, frame);
+            if (excluded == NULL)
+                goto done;
+            flag = PyObject_IsTrue(excluded);
+            Py_DECREF(excluded);
+            if (flag < 0)
+                goto done;
+            if (flag) {
+                /* Neither the hooks nor we see anything more of this
+                   frame. */
+                Py_INCREF(Py_None);
+                result = Py_None;
+                goto done;
+            }
+        }
+        if (filter_hooks(PyTuple_GET_ITEM(tables, TABLES_FILTERED_HOOKS), frame,
+                         &frame_id) < 0)
+            goto done;
+    }
+
+    /* HACK ALERT: "inspect" can get deleted exit cleanup! */
+    flag = global_is_true(self, str_inspect);
+    if (flag < 0)
+        goto done;
+    if (flag) {
+        PyObject *table = PyTuple_GET_ITEM(tables, TABLES_DISPATCH_TABLE);
+        PyObject *hooks = NULL;
+        if (PyDict_Check(table)) {
+            hooks = PyDict_GetItemWithError(table, event);
+            if (hooks == NULL && PyErr_Occurred())
+                goto done;
+        }
+        if (hooks != NULL && PyTuple_Check(hooks) &&
+            run_hooks(hooks, args, &frame_id, stats) < 0)
+            goto done;
+    }
+
+    if (event_is(event, str_call)) {
+        /* Prune local tracing for this frame down to what the
+           registered hooks need. */
+        flag = all_local_hooks_disabled(PyTuple_GET_ITEM(tables, TABLES_LOCAL_HOOKS),
+                                        frame, &frame_id);
+        if (flag < 0)
+            goto done;
+        if (flag) {
+            if (enable_frame(registry, frame, &frame_id) < 0)
+                goto done;
+            Py_INCREF(Py_None);
+            result = Py_None;
+            goto done;
+        }
+        flag = PySequence_Contains(PyTuple_GET_ITEM(tables, TABLES_LOCAL_EVENT_SET),
+                                   str_line);
+        if (flag < 0)
+            goto done;
+        if (!flag && PyObject_SetAttr(frame, str_f_trace_lines, Py_False) < 0)
+            goto done;
+    } else if (event_is(event, str_return)) {
+        if (enable_frame(registry, frame, &frame_id) < 0)
+            goto done;
+    }
+
+    Py_INCREF(self);
+    result = (PyObject *)self;
+
+done:
+    Py_DECREF(tables);
+    Py_DECREF(registry);
+    Py_XDECREF(frame_id);
+    return result;
+}
+
+static PyObject *
+dispatcher_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    DispatcherObject *self;
+    PyObject *globals, *fallback;
+    static char *kwlist[] = {"globals", "fallback", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O:Dispatcher", kwlist,
+                                     &PyDict_Type, &globals, &fallback))
+        return NULL;
+    if (!PyCallable_Check(fallback)) {
+        PyErr_SetString(PyExc_TypeError, "fallback should be callable");
+        return NULL;
+    }
+    self = (DispatcherObject *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    Py_INCREF(globals);
+    self->globals = globals;
+    Py_INCREF(fallback);
+    self->fallback = fallback;
+    self->vectorcall = dispatcher_vectorcall;
+    return (PyObject *)self;
+}
+
+static int
+dispatcher_traverse(DispatcherObject *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->globals);
+    Py_VISIT(self->fallback);
+    return 0;
+}
+
+static int
+dispatcher_clear(DispatcherObject *self)
+{
+    Py_CLEAR(self->globals);
+    Py_CLEAR(self->fallback);
+    return 0;
+}
+
+static void
+dispatcher_dealloc(DispatcherObject *self)
+{
+    PyObject_GC_UnTrack(self);
+    dispatcher_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+PyDoc_STRVAR(dispatcher_doc,
+"Dispatcher(globals, fallback)\n\
+\n\
+A compiled sys.settrace function which runs the trace hooks registered\n\
+in the tracer.tracer module whose dictionary is `globals`. `fallback` is\n\
+the pure-Python dispatcher, used when the module's debug flag is set.");
+
+static PyTypeObject DispatcherType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "tracer._dispatch.Dispatcher",
+    .tp_basicsize = sizeof(DispatcherObject),
+    .tp_dealloc = (destructor)dispatcher_dealloc,
+    .tp_vectorcall_offset = offsetof(DispatcherObject, vectorcall),
+    .tp_call = PyVectorcall_Call,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC | Py_TPFLAGS_HAVE_VECTORCALL,
+    .tp_doc = dispatcher_doc,
+    .tp_traverse = (traverseproc)dispatcher_traverse,
+    .tp_clear = (inquiry)dispatcher_clear,
+    .tp_new = dispatcher_new,
+};
+
+static struct PyModuleDef dispatch_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "tracer._dispatch",
+    .m_doc = "Compiled trace-hook dispatcher for tracer.",
+    .m_size = -1,
+};
+
+#define INTERN(var, s)                                   \
+    if ((var = PyUnicode_InternFromString(s)) == NULL)   \
+        return NULL
+
+PyMODINIT_FUNC
+PyInit__dispatch(void)
+{
+    PyObject *module;
+
+    INTERN(str_REGISTRY_UPDATES, "REGISTRY_UPDATES");
+    INTERN(str_REGISTRY_UPDATE, "REGISTRY_UPDATE");
+    INTERN(str_REGISTRY_UPDATE_CODES, "REGISTRY_UPDATE_CODES");
+    INTERN(str_depth, "depth");
+    INTERN(str_TRACE_SUSPEND, "TRACE_SUSPEND");
+    INTERN(str_debug, "debug");
+    INTERN(str_inspect, "inspect");
+    INTERN(str_REGISTRY, "REGISTRY");
+    INTERN(str__current_thread_tables, "_current_thread_tables");
+    INTERN(str_call, "call");
+    INTERN(str_return, "return");
+    INTERN(str_line, "line");
+    INTERN(str_f_trace_lines, "f_trace_lines");
+    INTERN(str_is_excluded, "is_excluded");
+    INTERN(str_has_subtrees, "has_subtrees");
+    INTERN(str__excluded_subtree_call, "_excluded_subtree_call");
+    INTERN(str_count_event, "count_event");
+    INTERN(str_call_hook, "call_hook");
+
+    if (PyType_Ready(&DispatcherType) < 0)
+        return NULL;
+    module = PyModule_Create(&dispatch_module);
+    if (module == NULL)
+        return NULL;
+    Py_INCREF(&DispatcherType);
+    if (PyModule_AddObject(module, "Dispatcher", (PyObject *)&DispatcherType) < 0) {
+        Py_DECREF(&DispatcherType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
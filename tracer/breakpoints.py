@@ -0,0 +1,119 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""The lines a hook is interested in, such as a debugger's breakpoints.
+
+A BreakpointIndex given as the "lines" option of add_hook() limits the
+hook to frames whose code object has a line of interest. On the "call"
+event of any other frame, the dispatcher turns the hook off for that
+frame, in the same way as for the "filter" option; if no other hook
+wants the frame's local events, the frame isn't traced any further. So
+code without breakpoints runs at the cost of its "call" events only.
+For example:
+
+    breakpoints = BreakpointIndex()
+    breakpoints.add("/src/service/handler.py", 42)
+    breakpoints.add(some_function, 10)
+    tracer.add_hook(debugger_hook, {"event_set": frozenset(("line",)),
+                                    "lines": breakpoints})
+
+Which frames are traced is decided when they are called, so lines
+added while a frame is running are seen in later calls of its code.
+"""
+
+import os.path
+from types import CodeType, FrameType
+from typing import Any, Dict, Set
+
+from tracer.tracefilter import MAX_CACHED_CODES, get_code_object
+
+
+def _code_lines(code: CodeType) -> Set[int]:
+    """Return the line numbers of `code`, not including nested code
+    objects."""
+    return {line for _, _, line in code.co_lines() if line is not None}
+
+
+class BreakpointIndex:
+    """A set of (code object or filename, line number) lines of
+    interest."""
+
+    def __init__(self):
+        self.clear()
+        return
+
+    def clear(self):
+        # Map from a code object to its lines of interest.
+        self.code_lines: Dict[CodeType, Set[int]] = {}
+        # Map from a real path to the lines of interest in that file.
+        self.file_lines: Dict[str, Set[int]] = {}
+        # Map from a code object to whether it has no line of interest.
+        # This is emptied whenever the lines of interest change, and
+        # when it holds MAX_CACHED_CODES code objects.
+        self.code_verdicts: Dict[CodeType, bool] = {}
+        return
+
+    def _key(self, target: Any):
+        """Return the code object or real path that `target`, a
+        filename or something with a code object, refers to."""
+        if isinstance(target, str):
+            return os.path.realpath(target)
+        code = get_code_object(target)
+        if code is None:
+            raise TypeError(f"{target!r} should be a filename or have a code object")
+        return code
+
+    def add(self, target: Any, line: int):
+        """Add line `line` of `target`, a filename, or a function, code
+        object or anything else with a code object."""
+        key = self._key(target)
+        lines_map = self.file_lines if isinstance(key, str) else self.code_lines
+        lines_map.setdefault(key, set()).add(line)
+        self.code_verdicts.clear()
+        return
+
+    def remove(self, target: Any, line: int) -> bool:
+        """Remove a line added by add(). Return True if it was removed
+        or False otherwise."""
+        key = self._key(target)
+        lines_map = self.file_lines if isinstance(key, str) else self.code_lines
+        lines = lines_map.get(key)
+        if lines is None or line not in lines:
+            return False
+        lines.remove(line)
+        if not lines:
+            del lines_map[key]
+        self.code_verdicts.clear()
+        return True
+
+    def lines(self, code: CodeType) -> Set[int]:
+        """Return the lines of interest in `code`."""
+        lines = self.code_lines.get(code, set()) & _code_lines(code)
+        file_lines = self.file_lines.get(os.path.realpath(code.co_filename))
+        if file_lines:
+            lines |= file_lines & _code_lines(code)
+        return lines
+
+    def is_excluded(self, frame: FrameType) -> bool:
+        """Return True if the code of `frame` has no line of interest.
+        This is what the dispatcher calls on the "call" event of a
+        frame."""
+        code = frame.f_code
+        verdict = self.code_verdicts.get(code)
+        if verdict is None:
+            verdict = not self.lines(code)
+            if len(self.code_verdicts) >= MAX_CACHED_CODES:
+                self.code_verdicts.clear()
+            self.code_verdicts[code] = verdict
+        return verdict
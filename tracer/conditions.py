@@ -0,0 +1,131 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Conditions on the lines a hook runs for, such as the conditions of
+conditional breakpoints.
+
+A Conditions given as the "conditions" option of add_hook() holds
+Python expressions for lines of code. On a "line" event for a line that
+has a condition, the dispatcher evaluates it in the frame's globals and
+locals before running the hook, and runs the hook only if it is true.
+Other events, and lines without a condition, are not affected. For
+example:
+
+    conditions = Conditions()
+    conditions.set(handler, 42, "request.user == 'rocky'")
+    tracer.add_hook(debugger_hook, {"event_set": frozenset(("line",)),
+                                    "conditions": conditions})
+
+Each expression is compiled once, and the compiled expression for a
+(code object, line) is cached, so an event costs two dictionary
+lookups and the evaluation. A condition that raises an exception counts
+as true, as a condition in pdb does, so that the hook can report it.
+"""
+
+import os.path
+from types import CodeType, FrameType
+from typing import Any, Dict, Optional
+
+from tracer.tracefilter import MAX_CACHED_CODES, get_code_object
+
+
+class Conditions:
+    """Python expressions for (code object or filename, line number)
+    lines."""
+
+    def __init__(self):
+        self.clear()
+        return
+
+    def clear(self):
+        # Map from a code object or real path to a map from a line
+        # number to its expression.
+        self.expressions: Dict[Any, Dict[int, str]] = {}
+        # Map from an expression to its compiled code.
+        self.compiled: Dict[str, CodeType] = {}
+        # Map from a code object to a map from a line number to the
+        # compiled condition for that line, or None if it has none.
+        # This is emptied whenever the conditions change, and when it
+        # holds MAX_CACHED_CODES code objects.
+        self.code_conditions: Dict[CodeType, Dict[int, Optional[CodeType]]] = {}
+        return
+
+    def _key(self, target: Any):
+        """Return the code object or real path that `target`, a
+        filename or something with a code object, refers to."""
+        if isinstance(target, str):
+            return os.path.realpath(target)
+        code = get_code_object(target)
+        if code is None:
+            raise TypeError(f"{target!r} should be a filename or have a code object")
+        return code
+
+    def set(self, target: Any, line: int, expression: str):
+        """Make `expression` the condition for line `line` of `target`,
+        a filename, or a function, code object or anything else with a
+        code object. SyntaxError is raised if it doesn't compile."""
+        if expression not in self.compiled:
+            self.compiled[expression] = compile(expression, "<condition>", "eval")
+        self.expressions.setdefault(self._key(target), {})[line] = expression
+        self.code_conditions.clear()
+        return
+
+    def remove(self, target: Any, line: int) -> bool:
+        """Remove the condition for line `line` of `target`. Return True
+        if there was one or False otherwise."""
+        key = self._key(target)
+        line2expression = self.expressions.get(key)
+        if line2expression is None or line not in line2expression:
+            return False
+        del line2expression[line]
+        if not line2expression:
+            del self.expressions[key]
+        self.code_conditions.clear()
+        return True
+
+    def condition(self, code: CodeType, line: int) -> Optional[CodeType]:
+        """Return the compiled condition for line `line` of `code`, or
+        None if it has none. A condition set for the code object comes
+        before one set for its file."""
+        line2condition = self.code_conditions.get(code)
+        if line2condition is None:
+            if len(self.code_conditions) >= MAX_CACHED_CODES:
+                self.code_conditions.clear()
+            line2condition = self.code_conditions.setdefault(code, {})
+        if line in line2condition:
+            return line2condition[line]
+        expression = self.expressions.get(code, {}).get(line)
+        if expression is None:
+            path = os.path.realpath(code.co_filename)
+            expression = self.expressions.get(path, {}).get(line)
+        condition = None if expression is None else self.compiled[expression]
+        line2condition[line] = condition
+        return condition
+
+    def __call__(self, frame: FrameType, event: str) -> bool:
+        """Return whether the hook should run for `event` in `frame`.
+        This is what the dispatcher calls before running the hook."""
+        if event != "line":
+            return True
+        line2condition = self.code_conditions.get(frame.f_code)
+        if line2condition is not None and frame.f_lineno in line2condition:
+            condition = line2condition[frame.f_lineno]
+        else:
+            condition = self.condition(frame.f_code, frame.f_lineno)
+        if condition is None:
+            return True
+        try:
+            return bool(eval(condition, frame.f_globals, frame.f_locals))
+        except Exception:
+            return True
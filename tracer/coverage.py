@@ -0,0 +1,168 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A line-coverage collector that runs as a trace hook.
+
+The lines run in each code object are recorded in a bitset sized from
+the code object's co_lines(), so memory per function is fixed no
+matter how often its lines run. Once every line of a code object has
+run, the hook returns None for its frames, which turns it off for
+them; if no other hook wants their local events, the dispatcher stops
+tracing them altogether. For example:
+
+    coverage = Coverage()
+    coverage.start()
+    ...
+    coverage.stop()
+    print(coverage.file_lines())
+"""
+
+import dis
+from types import CodeType
+from typing import Dict, Optional, Set
+
+import tracer
+
+COVERAGE_EVENTS = frozenset(("call", "line"))
+
+
+def _prologue_end(code: CodeType) -> int:
+    """Return the offset just after the RESUME instruction that starts
+    `code`. The lines of the instructions before it, like the "def"
+    line of a function, never get "line" events."""
+    for instruction in dis.get_instructions(code):
+        if instruction.opname == "RESUME":
+            return instruction.offset + 2
+    return 0
+
+
+def executable_lines(code: CodeType) -> Set[int]:
+    """Return the line numbers in `code`, not including nested code
+    objects, that can get "line" events."""
+    prologue_end = _prologue_end(code)
+    return {
+        line
+        for start, end, line in code.co_lines()
+        if line is not None and end > prologue_end
+    }
+
+
+class CodeLines:
+    """The lines of one code object that have run, as a bitset with
+    one bit per line from its first to its last executable line."""
+
+    __slots__ = ("first_line", "expected", "bits", "remaining")
+
+    def __init__(self, code: CodeType):
+        lines = executable_lines(code)
+        self.first_line = min(lines) if lines else code.co_firstlineno
+        size = (max(lines) - self.first_line) // 8 + 1 if lines else 0
+        # The executable lines, and the lines that have run.
+        self.expected = bytearray(size)
+        self.bits = bytearray(size)
+        for line in lines:
+            index = line - self.first_line
+            self.expected[index >> 3] |= 1 << (index & 7)
+        # The number of executable lines that haven't run yet.
+        self.remaining = len(lines)
+        return
+
+    def add(self, line: int):
+        """Record that `line` has run."""
+        index = line - self.first_line
+        byte = index >> 3
+        if 0 <= index and byte < len(self.bits):
+            bit = 1 << (index & 7)
+            if not self.bits[byte] & bit:
+                self.bits[byte] |= bit
+                if self.expected[byte] & bit:
+                    self.remaining -= 1
+        return
+
+    def _lines(self, bits: bytearray) -> Set[int]:
+        return {
+            self.first_line + (byte << 3) + i
+            for byte, value in enumerate(bits)
+            if value
+            for i in range(8)
+            if value & (1 << i)
+        }
+
+    def lines(self) -> Set[int]:
+        """Return the set of executable lines that have run."""
+        return self._lines(bytearray(a & b for a, b in zip(self.bits, self.expected)))
+
+    def missing(self) -> Set[int]:
+        """Return the set of executable lines that haven't run."""
+        return self._lines(
+            bytearray(~a & b & 0xFF for a, b in zip(self.bits, self.expected))
+        )
+
+
+class Coverage:
+    """Record the lines run in each code object."""
+
+    def __init__(self):
+        self.clear()
+        return
+
+    def clear(self):
+        """Forget the lines recorded so far."""
+        self.code_lines: Dict[CodeType, CodeLines] = {}
+        return
+
+    def trace_hook(self, frame, event: str, arg):
+        """The trace hook that records lines."""
+        code = frame.f_code
+        code_lines = self.code_lines.get(code)
+        if code_lines is None:
+            code_lines = self.code_lines.setdefault(code, CodeLines(code))
+        if event == "line":
+            code_lines.add(frame.f_lineno)
+        if code_lines.remaining <= 0:
+            # All lines have run, so stop tracing this frame.
+            return None
+        return self.trace_hook
+
+    def start(self, options: Optional[dict] = None):
+        """Add the coverage hook with add_hook() `options`, and start
+        tracing if it hasn't been started."""
+        options = dict(options or {})
+        options.setdefault("event_set", COVERAGE_EVENTS)
+        options.setdefault("start", not tracer.is_started())
+        tracer.add_hook(self.trace_hook, options)
+        return
+
+    def stop(self):
+        """Remove the coverage hook, and stop tracing if no other hooks
+        are left."""
+        tracer.remove_hook(self.trace_hook, stop_if_empty=True)
+        return
+
+    def lines(self, code: CodeType) -> Set[int]:
+        """Return the lines of `code` that have run."""
+        code_lines = self.code_lines.get(code)
+        return set() if code_lines is None else code_lines.lines()
+
+    def missing(self, code: CodeType) -> Set[int]:
+        """Return the executable lines of `code` that haven't run."""
+        code_lines = self.code_lines.get(code)
+        return executable_lines(code) if code_lines is None else code_lines.missing()
+
+    def file_lines(self) -> Dict[str, Set[int]]:
+        """Return a map from a file name to the lines run in it."""
+        result: Dict[str, Set[int]] = {}
+        for code, code_lines in list(self.code_lines.items()):
+            result.setdefault(code.co_filename, set()).update(code_lines.lines())
+        return result
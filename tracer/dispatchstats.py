@@ -0,0 +1,105 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Statistics on what the dispatcher does and what each hook costs.
+
+When statistics are turned on with tracer.enable_stats(), the
+dispatcher counts the events it gets and runs each hook through
+DispatchStats.call_hook(), which counts the hook's calls and the time
+spent in it. Each thread counts in its own ThreadStats, without
+locking, and tracer.stats() adds them up.
+"""
+
+import threading
+from time import perf_counter_ns
+from typing import Any, Callable, Dict, List
+
+
+class ThreadStats:
+    """The counts of one thread."""
+
+    __slots__ = ("events", "hooks")
+
+    def __init__(self):
+        # Map from an event name to the number of events of that kind.
+        self.events: Dict[str, int] = {}
+        # Map from a trace function to [calls, nanoseconds spent in it].
+        self.hooks: Dict[Callable, List[int]] = {}
+        return
+
+
+class DispatchStats:
+    """Counts of events and of hook calls and times, kept per thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # The ThreadStats of each thread that has counted. This isn't
+        # keyed by thread id, since the id of a thread that has exited
+        # is soon given to a new one.
+        self.thread_stats: List[ThreadStats] = []
+        return
+
+    def _new_thread_stats(self) -> ThreadStats:
+        thread_stats = ThreadStats()
+        self._local.stats = thread_stats
+        with self._lock:
+            self.thread_stats.append(thread_stats)
+        return thread_stats
+
+    def count_event(self, event: str):
+        """Count an event that the dispatcher got."""
+        thread_stats = getattr(self._local, "stats", None)
+        if thread_stats is None:
+            thread_stats = self._new_thread_stats()
+        events = thread_stats.events
+        events[event] = events.get(event, 0) + 1
+        return
+
+    def call_hook(self, trace_func: Callable, frame, event: str, arg) -> Any:
+        """Run trace_func(frame, event, arg), counting the call and the
+        time it takes, and return what it returns."""
+        start_ns = perf_counter_ns()
+        try:
+            return trace_func(frame, event, arg)
+        finally:
+            elapsed_ns = perf_counter_ns() - start_ns
+            thread_stats = getattr(self._local, "stats", None)
+            if thread_stats is None:
+                thread_stats = self._new_thread_stats()
+            counts = thread_stats.hooks.get(trace_func)
+            if counts is None:
+                thread_stats.hooks[trace_func] = [1, elapsed_ns]
+            else:
+                counts[0] += 1
+                counts[1] += elapsed_ns
+
+    def summary(self) -> dict:
+        """Return the counts of all threads added up: a dict with
+        "events", a map from an event name to its count, and "hooks", a
+        map from a trace function to a dict of its "calls" and "time_ns".
+        Other threads may still be counting, so a summary taken while
+        tracing is only approximate."""
+        events: Dict[str, int] = {}
+        hooks: Dict[Callable, Dict[str, int]] = {}
+        with self._lock:
+            all_thread_stats = list(self.thread_stats)
+        for thread_stats in all_thread_stats:
+            for event, count in list(thread_stats.events.items()):
+                events[event] = events.get(event, 0) + count
+            for trace_func, (calls, time_ns) in list(thread_stats.hooks.items()):
+                totals = hooks.setdefault(trace_func, {"calls": 0, "time_ns": 0})
+                totals["calls"] += calls
+                totals["time_ns"] += time_ns
+        return {"events": events, "hooks": hooks}
@@ -0,0 +1,272 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A trace hook that keeps the most recent events of each thread.
+
+Each thread gets a ring of `size` RECORD slots, preallocated as one
+bytearray, and each event overwrites the oldest slot. So memory use is
+fixed however long the recorder runs, and recording an event allocates
+no objects. For example:
+
+    flight_recorder = FlightRecorder(size=1000, dump_path="crash.bin")
+    flight_recorder.start({"event_set": frozenset(("call", "return"))})
+    ...
+    flight_recorder.dump("now.bin")
+
+A thread's ring is kept after the thread exits, until a new thread
+takes it over, so there are never more rings than threads that have
+been running at once. The code objects that events refer to are kept
+in a table of at most about `max_codes` entries; when it is full, the
+entries no recorded event or running frame uses are freed for reuse.
+
+dump() writes the events in the file format of tracer.recorder, so
+they can be read back with read_chunks(). When `dump_path` is given,
+the events are also dumped there when an exception isn't caught, from
+sys.excepthook or threading.excepthook.
+"""
+
+import sys
+import threading
+from time import perf_counter_ns
+from types import CodeType
+from typing import Dict, List, Optional, Tuple
+
+import tracer
+from tracer.recorder import (
+    CHUNK_HEADER,
+    CHUNK_RECORDS,
+    EVENT2INDEX,
+    RECORD,
+    pack_code,
+    pack_header,
+)
+from tracer.tracer import ALL_EVENT_NAMES
+
+
+class _ThreadRing:
+    __slots__ = ("data", "count", "thread_id")
+
+    def __init__(self, size: int, thread_id: int):
+        self.data = bytearray(size * RECORD.size)
+        # The number of events recorded so far; the next one goes in
+        # slot count % size.
+        self.count = 0
+        self.thread_id = thread_id
+        return
+
+
+class FlightRecorder:
+    """Keep the last `size` events of each thread, and dump them on
+    request or, if `dump_path` is given, to it when an exception isn't
+    caught."""
+
+    def __init__(
+        self,
+        size: int = 4096,
+        dump_path: Optional[str] = None,
+        max_codes: int = 65536,
+    ):
+        if not isinstance(size, int) or size <= 0:
+            raise ValueError(f"size should be a positive integer, is {size}")
+        if not isinstance(max_codes, int) or max_codes <= 0:
+            raise ValueError(f"max_codes should be a positive integer, is {max_codes}")
+        self.size = size
+        self.dump_path = dump_path
+        self.max_codes = max_codes
+        self._lock = threading.Lock()
+        # Map from a code object to its code index, and the reverse,
+        # where freed indexes are None and listed in _free_indexes.
+        self.code2index: Dict[CodeType, int] = {}
+        self.codes: List[Optional[CodeType]] = []
+        self._free_indexes: List[int] = []
+        # The table size at which unused indexes are next freed. This
+        # grows if most of the table is in use.
+        self._codes_limit = max_codes
+        # Map from a thread id to its ring.
+        self.rings: Dict[int, _ThreadRing] = {}
+        self._local = threading.local()
+        self._old_excepthook = None
+        self._old_threading_excepthook = None
+        return
+
+    def _code_index(self, code: CodeType) -> int:
+        with self._lock:
+            index = self.code2index.get(code)
+            if index is None:
+                if not self._free_indexes and len(self.codes) >= self._codes_limit:
+                    self._free_unused_codes()
+                if self._free_indexes:
+                    index = self._free_indexes.pop()
+                    self.codes[index] = code
+                else:
+                    index = len(self.codes)
+                    self.codes.append(code)
+                self.code2index[code] = index
+        return index
+
+    def _free_unused_codes(self):
+        """Free the code indexes that no recorded event uses, and that
+        no running frame uses, since a hook may be about to record an
+        event with it. Called with _lock held."""
+        used = set()
+        for ring in list(self.rings.values()):
+            records = bytes(ring.data[: min(ring.count, self.size) * RECORD.size])
+            used.update(fields[2] for fields in RECORD.iter_unpack(records))
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                index = self.code2index.get(frame.f_code)
+                if index is not None:
+                    used.add(index)
+                frame = frame.f_back
+        for index, code in enumerate(self.codes):
+            if code is not None and index not in used:
+                del self.code2index[code]
+                self.codes[index] = None
+                self._free_indexes.append(index)
+        self._codes_limit = max(self.max_codes, 2 * len(used))
+        return
+
+    def _new_ring(self) -> _ThreadRing:
+        thread_id = threading.get_ident()
+        with self._lock:
+            ring = self.rings.get(thread_id)
+            if ring is None:
+                # Take over the ring of a thread that has exited, if
+                # there is one.
+                running = sys._current_frames()
+                for old_thread_id, old_ring in self.rings.items():
+                    if old_thread_id not in running:
+                        del self.rings[old_thread_id]
+                        ring = old_ring
+                        ring.count = 0
+                        ring.thread_id = thread_id
+                        break
+                else:
+                    ring = _ThreadRing(self.size, thread_id)
+                self.rings[thread_id] = ring
+        self._local.ring = ring
+        return ring
+
+    def trace_hook(self, frame, event: str, arg):
+        """The trace hook that records events."""
+        ring = getattr(self._local, "ring", None)
+        if ring is None:
+            ring = self._new_ring()
+        code = frame.f_code
+        index = self.code2index.get(code)
+        if index is None:
+            index = self._code_index(code)
+        RECORD.pack_into(
+            ring.data,
+            ring.count % self.size * RECORD.size,
+            perf_counter_ns(),
+            ring.thread_id,
+            index,
+            frame.f_lineno or 0,
+            EVENT2INDEX[event],
+        )
+        ring.count += 1
+        return self.trace_hook
+
+    def _ordered_records(self, ring: _ThreadRing) -> bytes:
+        """Return the records of `ring`, oldest first."""
+        # Copy first, since this thread may record more while we look.
+        count = ring.count
+        data = bytes(ring.data)
+        if count <= self.size:
+            return data[: count * RECORD.size]
+        split = count % self.size * RECORD.size
+        return data[split:] + data[:split]
+
+    def records(self, thread_id: Optional[int] = None) -> Dict[int, bytes]:
+        """Return a map from a thread id to its recorded RECORDs, oldest
+        first, for all threads or just `thread_id`."""
+        return {
+            ring.thread_id: self._ordered_records(ring)
+            for ring in list(self.rings.values())
+            if thread_id is None or ring.thread_id == thread_id
+        }
+
+    def events(
+        self, thread_id: Optional[int] = None
+    ) -> List[Tuple[int, int, CodeType, int, str]]:
+        """Return the recorded (timestamp, thread id, code object, line
+        number, event) tuples, oldest first, of all threads or just
+        `thread_id`."""
+        result = []
+        for records in self.records(thread_id).values():
+            for fields in RECORD.iter_unpack(records):
+                timestamp, thread, index, lineno, event = fields
+                code = self.codes[index]
+                result.append(
+                    (timestamp, thread, code, lineno, ALL_EVENT_NAMES[event])
+                )
+        result.sort(key=lambda event: event[0])
+        return result
+
+    def dump(self, file):
+        """Write the recorded events to `file`, a path or a binary file
+        object, in the tracer.recorder file format."""
+        if isinstance(file, str):
+            with open(file, "wb") as f:
+                self.dump(f)
+            return
+        records = self.records()
+        codes = list(self.codes)
+        file.write(pack_header())
+        for index, code in enumerate(codes):
+            if code is not None:
+                file.write(pack_code(index, code))
+        for data in records.values():
+            if data:
+                file.write(CHUNK_HEADER.pack(CHUNK_RECORDS, len(data)))
+                file.write(data)
+        file.flush()
+        return
+
+    def _excepthook(self, exc_type, exc_value, exc_traceback):
+        self.dump(self.dump_path)
+        self._old_excepthook(exc_type, exc_value, exc_traceback)
+        return
+
+    def _threading_excepthook(self, args):
+        self.dump(self.dump_path)
+        self._old_threading_excepthook(args)
+        return
+
+    def start(self, options: Optional[dict] = None):
+        """Add the flight recorder hook with add_hook() `options`, and
+        start tracing if it hasn't been started."""
+        options = dict(options or {})
+        options.setdefault("start", not tracer.is_started())
+        if self.dump_path is not None and self._old_excepthook is None:
+            self._old_excepthook = sys.excepthook
+            sys.excepthook = self._excepthook
+            self._old_threading_excepthook = threading.excepthook
+            threading.excepthook = self._threading_excepthook
+        tracer.add_hook(self.trace_hook, options)
+        return
+
+    def stop(self):
+        """Remove the flight recorder hook, and stop tracing if no other
+        hooks are left. The recorded events are kept."""
+        tracer.remove_hook(self.trace_hook, stop_if_empty=True)
+        if self._old_excepthook is not None:
+            if sys.excepthook == self._excepthook:
+                sys.excepthook = self._old_excepthook
+            if threading.excepthook == self._threading_excepthook:
+                threading.excepthook = self._old_threading_excepthook
+            self._old_excepthook = None
+            self._old_threading_excepthook = None
+        return
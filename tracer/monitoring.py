@@ -0,0 +1,352 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A sys.monitoring (PEP 669) backend for running the registered trace
+hooks. This is available in Python 3.12 and later.
+
+Instead of having every event of every frame go through sys.settrace,
+we ask the interpreter only for the events in the union of the
+registered hooks' event sets. Monitoring events are translated into
+the sys.settrace event names and arguments, so hooks see the same
+(frame, event, arg) triples they would get under sys.settrace.
+
+Note that sys.monitoring is process-wide, so all threads are traced
+regardless of the "include_threads" start option. The "threads" start
+option still limits which threads the hooks are run in, but the other
+threads pay for the event callbacks.
+
+sys.settrace never gives "c_call", "c_return" or "c_exception" events,
+and gives "opcode" events only to frames that ask for them. So these
+events are turned on only for hooks whose event set names them; a hook
+with the default event set, ALL_EVENTS, gets the events it would get
+under sys.settrace.
+"""
+
+import sys
+import threading
+from types import FrameType, FunctionType, MethodType
+from typing import Dict, Optional
+
+import tracer.tracer as _tracer
+
+TOOL_NAME = "pytracer"
+
+# The sys.monitoring tool id we have claimed, or None if we haven't
+# claimed one.
+TOOL_ID: Optional[int] = None
+
+if hasattr(sys, "monitoring"):
+    _events = sys.monitoring.events
+
+    # Map from a sys.settrace event name to the sys.monitoring events
+    # that we translate into that name.
+    EVENT2MONITORING = {
+        "c_call": _events.CALL,
+        "c_exception": _events.C_RAISE,
+        "c_return": _events.C_RETURN,
+        "call": _events.PY_START | _events.PY_RESUME | _events.PY_THROW,
+        "exception": _events.RAISE,
+        "line": _events.LINE,
+        "opcode": _events.INSTRUCTION,
+        "return": _events.PY_RETURN | _events.PY_YIELD | _events.PY_UNWIND,
+    }
+else:
+    EVENT2MONITORING = {}
+
+# The events that a hook with an event set of None or ALL_EVENTS is
+# given.
+SETTRACE_EVENTS = frozenset(("call", "exception", "line", "return"))
+
+
+def is_available() -> bool:
+    """Return True if this Python has sys.monitoring."""
+    return hasattr(sys, "monitoring")
+
+
+def _is_python_callable(callable) -> bool:
+    """Return True if `callable` runs Python bytecode, so that
+    sys.monitoring won't give a C_RETURN or C_RAISE event for it."""
+    if isinstance(callable, MethodType):
+        callable = callable.__func__
+    return isinstance(callable, FunctionType)
+
+
+# The callbacks below are called directly from the frame that
+# generated the event, so sys._getframe(1) is the frame that a
+# sys.settrace hook would be given.
+#
+# Code that the start() "trace_filter" option excludes gets no events.
+# Where the interpreter allows it, the callbacks return
+# sys.monitoring.DISABLE for such code, so that they aren't called for
+# that event at that place in the code again; start_monitoring() turns
+# these events back on. That can't be done for frames in an excluded
+# subtree, since the same code may be traced when called from
+# elsewhere.
+
+NOT_EXCLUDED = 0
+EXCLUDED = 1
+IN_EXCLUDED_SUBTREE = 2
+
+# Frames for which the dispatcher returned None from the "call" event.
+# Under sys.settrace they would get no more local events, so we drop
+# their local events until they return. The key is id(frame) and the
+# value the frame itself.
+UNTRACED_FRAMES: Dict[int, FrameType] = {}
+
+# True if "return" events are monitored, so that frames put in
+# UNTRACED_FRAMES are taken out again when they return. Without them no
+# local events are monitored either, so there is nothing to drop.
+RETURN_MONITORED = False
+
+
+def _is_untraced(frame) -> bool:
+    return bool(UNTRACED_FRAMES) and UNTRACED_FRAMES.get(id(frame)) is frame
+
+
+def _forget_untraced(frame) -> bool:
+    """If `frame` is in UNTRACED_FRAMES, remove it and return True."""
+    if _is_untraced(frame):
+        del UNTRACED_FRAMES[id(frame)]
+        return True
+    return False
+
+
+def _exclusion(frame) -> int:
+    """Return whether the start() trace filter excludes `frame`:
+    NOT_EXCLUDED, EXCLUDED, or IN_EXCLUDED_SUBTREE if `frame` is in or
+    at the root of a subtree that the filter excludes."""
+    trace_filter = _tracer.REGISTRY.trace_filter
+    if trace_filter is None:
+        return NOT_EXCLUDED
+    if trace_filter.has_subtrees:
+        if threading.get_ident() in _tracer.EXCLUDED_SUBTREE_ROOTS:
+            return IN_EXCLUDED_SUBTREE
+        if trace_filter.excludes_subtree(frame):
+            return IN_EXCLUDED_SUBTREE
+    return EXCLUDED if trace_filter.is_excluded(frame) else NOT_EXCLUDED
+
+
+def _start_frame(frame):
+    """Give the "call" event for `frame`, which is starting or
+    resuming."""
+    exclusion = _exclusion(frame)
+    if exclusion == EXCLUDED:
+        return sys.monitoring.DISABLE
+    # For frames in an excluded subtree, this notes the root of the
+    # subtree and runs no hooks.
+    if _tracer._tracer_func(frame, "call", None) is None and RETURN_MONITORED:
+        UNTRACED_FRAMES[id(frame)] = frame
+
+
+def _py_start(code, instruction_offset):
+    return _start_frame(sys._getframe(1))
+
+
+def _py_throw(code, instruction_offset, exception):
+    # sys.settrace gives a "call" event when an exception is thrown into
+    # a generator or coroutine, and then an "exception" event for it
+    # from the RAISE event, if the frame doesn't handle it first.
+    _start_frame(sys._getframe(1))
+
+
+def _py_return(code, instruction_offset, retval):
+    frame = sys._getframe(1)
+    if _forget_untraced(frame):
+        return
+    exclusion = _exclusion(frame)
+    if exclusion == EXCLUDED:
+        return sys.monitoring.DISABLE
+    if exclusion == IN_EXCLUDED_SUBTREE:
+        _tracer._subtree_root_tracer(frame, "return", retval)
+    else:
+        _tracer._tracer_func(frame, "return", retval)
+
+
+def _py_unwind(code, instruction_offset, exception):
+    frame = sys._getframe(1)
+    if _forget_untraced(frame):
+        return
+    exclusion = _exclusion(frame)
+    if exclusion == IN_EXCLUDED_SUBTREE:
+        _tracer._subtree_root_tracer(frame, "return", None)
+    elif exclusion == NOT_EXCLUDED:
+        # sys.settrace reports a "return" with a None argument when a
+        # frame is exited because of an exception.
+        _tracer._tracer_func(frame, "return", None)
+
+
+def _line(code, line_number):
+    frame = sys._getframe(1)
+    if _is_untraced(frame):
+        return
+    exclusion = _exclusion(frame)
+    if exclusion == NOT_EXCLUDED:
+        _tracer._tracer_func(frame, "line", None)
+    elif exclusion == EXCLUDED:
+        return sys.monitoring.DISABLE
+
+
+def _instruction(code, instruction_offset):
+    frame = sys._getframe(1)
+    if _is_untraced(frame):
+        return
+    exclusion = _exclusion(frame)
+    if exclusion == NOT_EXCLUDED:
+        _tracer._tracer_func(frame, "opcode", None)
+    elif exclusion == EXCLUDED:
+        return sys.monitoring.DISABLE
+
+
+def _raise(code, instruction_offset, exception):
+    frame = sys._getframe(1)
+    if not _is_untraced(frame) and _exclusion(frame) == NOT_EXCLUDED:
+        _tracer._tracer_func(
+            frame,
+            "exception",
+            (type(exception), exception, exception.__traceback__),
+        )
+
+
+def _c_call(code, instruction_offset, callable, arg0):
+    frame = sys._getframe(1)
+    exclusion = _exclusion(frame)
+    if exclusion == EXCLUDED:
+        # This also turns off C_RETURN and C_RAISE here.
+        return sys.monitoring.DISABLE
+    if exclusion == NOT_EXCLUDED and not _is_python_callable(callable):
+        _tracer._tracer_func(frame, "c_call", callable)
+
+
+def _c_return(code, instruction_offset, callable, arg0):
+    frame = sys._getframe(1)
+    if _exclusion(frame) == NOT_EXCLUDED:
+        _tracer._tracer_func(frame, "c_return", callable)
+
+
+def _c_raise(code, instruction_offset, callable, arg0):
+    frame = sys._getframe(1)
+    if _exclusion(frame) == NOT_EXCLUDED:
+        _tracer._tracer_func(frame, "c_exception", callable)
+
+
+def _callbacks() -> dict:
+    events = sys.monitoring.events
+    return {
+        events.PY_START: _py_start,
+        events.PY_RESUME: _py_start,
+        events.PY_THROW: _py_throw,
+        events.PY_RETURN: _py_return,
+        events.PY_YIELD: _py_return,
+        events.PY_UNWIND: _py_unwind,
+        events.LINE: _line,
+        events.INSTRUCTION: _instruction,
+        events.RAISE: _raise,
+        events.CALL: _c_call,
+        events.C_RETURN: _c_return,
+        events.C_RAISE: _c_raise,
+    }
+
+
+def events_mask(event_sets) -> int:
+    """Return the sys.monitoring event mask covering the union of the
+    sys.settrace event names in `event_sets`. An event set of None or
+    ALL_EVENTS means the events in SETTRACE_EVENTS."""
+    mask = 0
+    for event_set in event_sets:
+        if event_set is None or event_set == _tracer.ALL_EVENTS:
+            event_set = SETTRACE_EVENTS
+        for event in event_set:
+            mask |= EVENT2MONITORING.get(event, 0)
+    return mask
+
+
+def update_events(untrace_running: bool = False):
+    """Set the monitored events from the currently-registered hooks.
+    If `untrace_running` is True, or if no local events were monitored
+    before, the frames running in this thread whose trace function isn't
+    set get no local events, as under sys.settrace."""
+    global RETURN_MONITORED
+    if TOOL_ID is not None:
+        hooks = _tracer.REGISTRY.hooks
+        mask = events_mask(hook.event_set for hook in hooks)
+        if any(
+            hook.trace_filter is not None
+            or hook.line_interest is not None
+            or hook.scope is not None
+            for hook in hooks
+        ):
+            # The dispatcher checks the "filter", "lines" and "scope"
+            # options on "call" events, even for hooks whose event set
+            # has no "call", and forgets the frames they turn a hook off
+            # for on "return" events.
+            mask |= EVENT2MONITORING["call"] | EVENT2MONITORING["return"]
+        elif mask & ~EVENT2MONITORING["call"]:
+            # The dispatcher needs "return" events to forget frames
+            # that hooks have turned off tracing for.
+            mask |= EVENT2MONITORING["return"]
+        was_monitored = RETURN_MONITORED
+        RETURN_MONITORED = bool(mask & EVENT2MONITORING["return"])
+        if not RETURN_MONITORED:
+            UNTRACED_FRAMES.clear()
+        elif untrace_running or not was_monitored:
+            # add_hook() sets the trace function of the frames that its
+            # "backlevel" option covers. Others, like ours, have had no
+            # "call" event, or one for which the dispatcher returned
+            # None without our noting it.
+            frame = sys._getframe()
+            while frame is not None:
+                if frame.f_trace is None:
+                    UNTRACED_FRAMES[id(frame)] = frame
+                frame = frame.f_back
+        sys.monitoring.set_events(TOOL_ID, mask)
+    return
+
+
+def start_monitoring():
+    """Claim a sys.monitoring tool id, register our callbacks and turn
+    on the events the registered hooks need."""
+    global TOOL_ID
+    if not is_available():
+        raise NotImplementedError("sys.monitoring requires Python 3.12 or later")
+    if TOOL_ID is None:
+        monitoring = sys.monitoring
+        for tool_id in (monitoring.DEBUGGER_ID,) + tuple(range(6)):
+            if monitoring.get_tool(tool_id) is None:
+                break
+        else:
+            raise RuntimeError("no free sys.monitoring tool id available")
+        monitoring.use_tool_id(tool_id, TOOL_NAME)
+        for event, callback in _callbacks().items():
+            monitoring.register_callback(tool_id, event, callback)
+        TOOL_ID = tool_id
+    # Turn back on events that were disabled for code that an earlier
+    # trace filter excluded.
+    sys.monitoring.restart_events()
+    update_events(untrace_running=True)
+    return
+
+
+def stop_monitoring():
+    """Turn off all events and release our sys.monitoring tool id."""
+    global RETURN_MONITORED, TOOL_ID
+    if TOOL_ID is not None:
+        monitoring = sys.monitoring
+        monitoring.set_events(TOOL_ID, 0)
+        for event in _callbacks():
+            monitoring.register_callback(TOOL_ID, event, None)
+        monitoring.free_tool_id(TOOL_ID)
+        TOOL_ID = None
+    RETURN_MONITORED = False
+    UNTRACED_FRAMES.clear()
+    return
@@ -0,0 +1,262 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A call-count and timing profiler that runs as a trace hook.
+
+Since the profiler is just another hook, it can run alongside other
+hooks, in selected threads only, or with a TraceFilter, using the
+usual add_hook() options. For example:
+
+    profiler = Profiler()
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.print_stats(sort="tottime", limit=20)
+
+Functions are given an index the first time they are seen, and each
+thread accumulates its counts and times in arrays indexed by it.
+Under sys.settrace, C functions are not seen; with the "monitoring"
+backend of tracer.start() they are.
+
+A Profiler can be given to pstats.Stats(), and dump_stats() writes a
+file that pstats can read.
+"""
+
+import marshal
+import sys
+import threading
+from array import array
+from time import perf_counter_ns
+from typing import Any, Dict, List, Optional, Tuple
+
+import tracer
+
+PROFILE_EVENTS = frozenset(("call", "return", "c_call", "c_return", "c_exception"))
+
+# Columns that print_stats() can sort on.
+SORT_KEYS = ("calls", "tottime", "cumtime")
+
+
+def _new_array(size: int) -> array:
+    return array("q", bytes(8 * size))
+
+
+class ThreadProfile:
+    """The counts and times of one thread. Each array is indexed by the
+    Profiler's function index."""
+
+    __slots__ = (
+        "calls",
+        "primitive_calls",
+        "inclusive_ns",
+        "exclusive_ns",
+        "active",
+        "stack",
+    )
+
+    def __init__(self, size: int):
+        self.calls = _new_array(size)
+        # Calls that weren't made while the function was already active.
+        self.primitive_calls = _new_array(size)
+        self.inclusive_ns = _new_array(size)
+        self.exclusive_ns = _new_array(size)
+        # How many activations of each function are on the stack.
+        self.active = _new_array(size)
+        # A list of [function index, start time, time in callees, id of
+        # the frame, True for C functions] for the active calls,
+        # innermost last. For C functions, the frame is the calling
+        # frame.
+        self.stack: List[list] = []
+        return
+
+    def grow(self, size: int):
+        """Make the arrays hold at least `size` functions."""
+        extra = size - len(self.calls)
+        if extra > 0:
+            for name in ThreadProfile.__slots__[:-1]:
+                getattr(self, name).extend(_new_array(extra))
+        return
+
+
+class Profiler:
+    """Count calls of, and time spent in, each function."""
+
+    def __init__(self):
+        self.clear()
+        return
+
+    def clear(self):
+        """Forget everything profiled so far."""
+        self._lock = threading.Lock()
+        # Map from a code object, or for C functions the callable, to
+        # its index in the ThreadProfile arrays, and the reverse.
+        self.key2index: Dict[Any, int] = {}
+        self.keys: List[Any] = []
+        # The ThreadProfile of each thread that has been profiled. This
+        # isn't keyed by thread id, since the id of a thread that has
+        # exited is soon given to a new one.
+        self.thread_profiles: List[ThreadProfile] = []
+        self._local = threading.local()
+        return
+
+    def _index(self, key) -> int:
+        with self._lock:
+            index = self.key2index.get(key)
+            if index is None:
+                index = len(self.keys)
+                self.keys.append(key)
+                self.key2index[key] = index
+        return index
+
+    def _thread_profile(self) -> ThreadProfile:
+        profile = ThreadProfile(len(self.keys))
+        self._local.profile = profile
+        with self._lock:
+            self.thread_profiles.append(profile)
+        return profile
+
+    def trace_hook(self, frame, event: str, arg):
+        """The trace hook that does the profiling."""
+        now = perf_counter_ns()
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            profile = self._thread_profile()
+
+        if event == "call" or event == "c_call":
+            key = frame.f_code if event == "call" else arg
+            index = self.key2index.get(key)
+            if index is None:
+                index = self._index(key)
+            if index >= len(profile.calls):
+                profile.grow(len(self.keys))
+            profile.calls[index] += 1
+            if not profile.active[index]:
+                profile.primitive_calls[index] += 1
+            profile.active[index] += 1
+            profile.stack.append([index, now, 0, id(frame), event == "c_call"])
+        else:
+            stack = profile.stack
+            frame_id = id(frame)
+            is_c = event != "return"
+            while stack and stack[-1][3] == frame_id:
+                index, start_ns, callees_ns, _, entry_is_c = stack.pop()
+                elapsed_ns = now - start_ns
+                profile.exclusive_ns[index] += elapsed_ns - callees_ns
+                profile.active[index] -= 1
+                if not profile.active[index]:
+                    # Time in recursive calls is already included in
+                    # the outermost one.
+                    profile.inclusive_ns[index] += elapsed_ns
+                if stack:
+                    stack[-1][2] += elapsed_ns
+                # A "return" also ends C calls of the frame that we
+                # didn't see the end of.
+                if entry_is_c == is_c:
+                    break
+        return self.trace_hook
+
+    def start(self, options: Optional[dict] = None):
+        """Add the profiler hook with add_hook() `options`, and start
+        tracing if it hasn't been started."""
+        options = dict(options or {})
+        options.setdefault("event_set", PROFILE_EVENTS)
+        options.setdefault("start", not tracer.is_started())
+        tracer.add_hook(self.trace_hook, options)
+        return
+
+    def stop(self):
+        """Remove the profiler hook, and stop tracing if no other hooks
+        are left."""
+        tracer.remove_hook(self.trace_hook, stop_if_empty=True)
+        return
+
+    def label(self, index: int) -> Tuple[str, int, str]:
+        """Return the pstats (filename, line number, function name)
+        for the function with index `index`."""
+        key = self.keys[index]
+        if hasattr(key, "co_filename"):
+            return (key.co_filename, key.co_firstlineno, key.co_qualname)
+        # A C function, named the way cProfile names them.
+        module = getattr(key, "__module__", None)
+        name = getattr(key, "__qualname__", None) or repr(key)
+        if module:
+            return ("~", 0, f"<built-in method {module}.{name}>")
+        return ("~", 0, f"<built-in method {name}>")
+
+    def totals(self) -> Dict[Tuple[str, int, str], Tuple[int, int, int, int]]:
+        """Return a map from each function's label to its call count,
+        primitive call count, exclusive time and inclusive time, in
+        nanoseconds, summed over all threads."""
+        totals: Dict[Tuple[str, int, str], List[int]] = {}
+        for profile in list(self.thread_profiles):
+            for index in range(len(profile.calls)):
+                calls = profile.calls[index]
+                if not calls:
+                    continue
+                entry = totals.setdefault(self.label(index), [0, 0, 0, 0])
+                entry[0] += calls
+                entry[1] += profile.primitive_calls[index]
+                entry[2] += profile.exclusive_ns[index]
+                entry[3] += profile.inclusive_ns[index]
+        return {label: tuple(entry) for label, entry in totals.items()}
+
+    def create_stats(self):
+        """Set self.stats in the format of cProfile.Profile.stats, so
+        that pstats.Stats(profiler) works."""
+        self.stats = {}
+        for label, (calls, primitive, tt_ns, ct_ns) in self.totals().items():
+            self.stats[label] = (primitive, calls, tt_ns / 1e9, ct_ns / 1e9, {})
+        return
+
+    def dump_stats(self, path: str):
+        """Write the profile to `path` in the format pstats reads."""
+        self.create_stats()
+        with open(path, "wb") as f:
+            marshal.dump(self.stats, f)
+        return
+
+    def format_stats(
+        self, sort: str = "cumtime", limit: Optional[int] = None
+    ) -> str:
+        """Return the profile as a table sorted on column `sort`, which
+        is one of SORT_KEYS, with at most `limit` rows."""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort should be one of {SORT_KEYS}, is {sort}")
+        column = {"calls": 0, "tottime": 2, "cumtime": 3}[sort]
+        rows = sorted(
+            self.totals().items(), key=lambda item: item[1][column], reverse=True
+        )
+        if limit is not None:
+            rows = rows[:limit]
+
+        lines = [
+            "   ncalls  tottime  percall  cumtime  percall filename:lineno(function)"
+        ]
+        for (filename, lineno, name), (calls, primitive, tt_ns, ct_ns) in rows:
+            ncalls = str(calls) if calls == primitive else f"{calls}/{primitive}"
+            tottime = tt_ns / 1e9
+            cumtime = ct_ns / 1e9
+            lines.append(
+                f"{ncalls:>9} {tottime:8.3f} {tottime / calls:8.3f} "
+                f"{cumtime:8.3f} {cumtime / primitive if primitive else 0:8.3f} "
+                f"{filename}:{lineno}({name})"
+            )
+        return "\n".join(lines) + "\n"
+
+    def print_stats(
+        self, sort: str = "cumtime", limit: Optional[int] = None, file=None
+    ):
+        """Print the table of format_stats()."""
+        print(self.format_stats(sort, limit), end="", file=file or sys.stdout)
+        return
@@ -0,0 +1,384 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A trace hook that records events in a compact binary format.
+
+Each event is packed as a fixed-width RECORD (timestamp, thread id,
+code index, line number, event index) into a preallocated per-thread
+buffer. Full buffers are written to a sink in bulk: a FileSink writes a
+single file, and an MmapRingSink writes a ring of memory-mapped
+segment files, overwriting the oldest segment when all are full. For
+example:
+
+    recorder = Recorder(FileSink("trace.bin"))
+    recorder.start()
+    ...
+    recorder.stop()
+
+A file or segment is a header followed by chunks. Each chunk is a kind
+byte and a payload length, followed by the payload:
+
+  CHUNK_EVENTS:  the event names, which RECORD event indexes refer to
+  CHUNK_CODE:    a code index, first line number, filename and name;
+                 a code object is described once, before the first
+                 records that refer to it
+  CHUNK_RECORDS: a run of RECORDs
+
+A kind byte of CHUNK_END, or the end of the file, ends the chunks.
+read_chunks() reads them back.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import threading
+from time import perf_counter_ns
+from types import CodeType
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import tracer
+from tracer.tracer import ALL_EVENT_NAMES
+
+MAGIC = b"PYTRACE\0"
+VERSION = 1
+
+# Magic, version, record size and the sequence number of the segment.
+HEADER = struct.Struct("<8sHHQ")
+
+# Timestamp in nanoseconds, thread id, code index, line number and
+# event index.
+RECORD = struct.Struct("<QQIIB7x")
+
+# Chunk kind and payload length.
+CHUNK_HEADER = struct.Struct("<BI")
+CHUNK_END = 0
+CHUNK_EVENTS = 1
+CHUNK_CODE = 2
+CHUNK_RECORDS = 3
+
+# Code index and first line number, followed by the filename and name.
+CODE_HEADER = struct.Struct("<II")
+STRING_LENGTH = struct.Struct("<H")
+
+EVENT2INDEX = {event: i for i, event in enumerate(ALL_EVENT_NAMES)}
+
+
+def _pack_string(value: str) -> bytes:
+    data = value.encode("utf-8", "surrogateescape")[:0xFFFF]
+    return STRING_LENGTH.pack(len(data)) + data
+
+
+def _unpack_string(data, offset: int) -> Tuple[str, int]:
+    (length,) = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    end = offset + length
+    return bytes(data[offset:end]).decode("utf-8", "surrogateescape"), end
+
+
+def pack_chunk(kind: int, payload: bytes) -> bytes:
+    return CHUNK_HEADER.pack(kind, len(payload)) + payload
+
+
+def pack_header(sequence: int = 0) -> bytes:
+    """Return the header of a file or segment, followed by the
+    CHUNK_EVENTS chunk."""
+    names = b"".join(_pack_string(event) for event in ALL_EVENT_NAMES)
+    return HEADER.pack(MAGIC, VERSION, RECORD.size, sequence) + pack_chunk(
+        CHUNK_EVENTS, STRING_LENGTH.pack(len(ALL_EVENT_NAMES)) + names
+    )
+
+
+def pack_code(index: int, code: CodeType) -> bytes:
+    """Return the CHUNK_CODE chunk for `code` with code index `index`."""
+    return pack_chunk(
+        CHUNK_CODE,
+        CODE_HEADER.pack(index, code.co_firstlineno)
+        + _pack_string(code.co_filename)
+        + _pack_string(code.co_qualname),
+    )
+
+
+def read_header(data) -> Tuple[int, int]:
+    """Check the header at the start of `data`, and return the segment
+    sequence number and the offset of the first chunk."""
+    magic, version, record_size, sequence = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("not a trace file")
+    if version != VERSION or record_size != RECORD.size:
+        raise ValueError(f"unsupported trace file version {version}")
+    return sequence, HEADER.size
+
+
+def read_chunks(data, offset: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+    """Generate (kind, payload offset, payload length) for the chunks
+    in `data`, a bytes-like object such as an mmap, starting at
+    `offset` or else after the header."""
+    if offset is None:
+        offset = read_header(data)[1]
+    end = len(data)
+    while offset + CHUNK_HEADER.size <= end:
+        kind, length = CHUNK_HEADER.unpack_from(data, offset)
+        if kind == CHUNK_END:
+            return
+        offset += CHUNK_HEADER.size
+        if offset + length > end:
+            return
+        yield kind, offset, length
+        offset += length
+    return
+
+
+def unpack_events(data, offset: int) -> List[str]:
+    """Return the event names of the CHUNK_EVENTS payload at `offset`."""
+    (count,) = STRING_LENGTH.unpack_from(data, offset)
+    offset += STRING_LENGTH.size
+    names = []
+    for _ in range(count):
+        name, offset = _unpack_string(data, offset)
+        names.append(name)
+    return names
+
+
+def unpack_code(data, offset: int) -> Tuple[int, int, str, str]:
+    """Return the code index, first line number, filename and name of
+    the CHUNK_CODE payload at `offset`."""
+    index, firstlineno = CODE_HEADER.unpack_from(data, offset)
+    filename, offset = _unpack_string(data, offset + CODE_HEADER.size)
+    name, offset = _unpack_string(data, offset)
+    return index, firstlineno, filename, name
+
+
+class FileSink:
+    """Write recorded chunks to the file `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(pack_header())
+        return
+
+    def write_code(self, chunk: bytes):
+        self.file.write(chunk)
+        return
+
+    def write_records(self, records):
+        self.file.write(CHUNK_HEADER.pack(CHUNK_RECORDS, len(records)))
+        self.file.write(records)
+        return
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        return
+
+
+class MmapRingSink:
+    """Write recorded chunks to `segments` memory-mapped files of
+    `segment_size` bytes each, named `prefix`.0, `prefix`.1, ... When
+    the last is full, the first is overwritten. Each segment starts with
+    all of the code chunks written so far, so it can be read on its own;
+    the segment sequence numbers in the headers give their order."""
+
+    def __init__(self, prefix: str, segment_size: int = 64 << 20, segments: int = 4):
+        if segments < 1:
+            raise ValueError(f"segments should be at least 1, is {segments}")
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.segments = segments
+        self.code_chunks: List[bytes] = []
+        self.sequence = -1
+        self.map: Optional[mmap.mmap] = None
+        self.offset = 0
+        self._next_segment()
+        return
+
+    def _next_segment(self):
+        self._close_map()
+        self.sequence += 1
+        path = f"{self.prefix}.{self.sequence % self.segments}"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.segment_size)
+            self.map = mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+        header = pack_header(self.sequence) + b"".join(self.code_chunks)
+        if len(header) + CHUNK_HEADER.size + RECORD.size > self.segment_size:
+            raise ValueError("segment_size is too small for the code table")
+        self.map[: len(header)] = header
+        self.offset = len(header)
+        return
+
+    def _room(self) -> int:
+        return self.segment_size - self.offset
+
+    def write_code(self, chunk: bytes):
+        self.code_chunks.append(chunk)
+        if len(chunk) > self._room():
+            self._next_segment()
+        else:
+            self.map[self.offset : self.offset + len(chunk)] = chunk
+            self.offset += len(chunk)
+        return
+
+    def write_records(self, records):
+        records = memoryview(records)
+        while len(records):
+            room = (self._room() - CHUNK_HEADER.size) // RECORD.size * RECORD.size
+            if room <= 0:
+                self._next_segment()
+                continue
+            part = records[:room]
+            end = self.offset + CHUNK_HEADER.size + len(part)
+            self.map[self.offset : end] = (
+                CHUNK_HEADER.pack(CHUNK_RECORDS, len(part)) + part
+            )
+            self.offset = end
+            records = records[room:]
+        return
+
+    def _close_map(self):
+        # Segments are zero-filled when created, so the unused rest of
+        # a segment reads as CHUNK_END.
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        return
+
+    def close(self):
+        self._close_map()
+        return
+
+
+class _ThreadBuffer:
+    __slots__ = ("data", "offset", "thread_id")
+
+    def __init__(self, size: int, thread_id: int):
+        self.data = bytearray(size)
+        self.offset = 0
+        self.thread_id = thread_id
+        return
+
+
+class Recorder:
+    """Record trace events into buffers of `buffer_records` records
+    per thread, which are written to `sink` when full and by flush().
+    The buffer of a thread that has exited is written out and given to
+    the next new thread, or dropped by flush()."""
+
+    def __init__(self, sink, buffer_records: int = 8192):
+        self.sink = sink
+        self.buffer_size = buffer_records * RECORD.size
+        self._lock = threading.Lock()
+        # Map from a code object to its code index.
+        self.code2index: Dict[CodeType, int] = {}
+        # Map from a thread id to its buffer.
+        self.buffers: Dict[int, _ThreadBuffer] = {}
+        self._local = threading.local()
+        return
+
+    def _code_index(self, code: CodeType) -> int:
+        with self._lock:
+            index = self.code2index.get(code)
+            if index is None:
+                index = len(self.code2index)
+                self.sink.write_code(pack_code(index, code))
+                self.code2index[code] = index
+        return index
+
+    def _new_buffer(self) -> _ThreadBuffer:
+        thread_id = threading.get_ident()
+        with self._lock:
+            buffer = self.buffers.get(thread_id)
+            if buffer is None:
+                # Take over the buffer of a thread that has exited, if
+                # there is one, after writing out its records.
+                running = sys._current_frames()
+                for old_thread_id, old_buffer in self.buffers.items():
+                    if old_thread_id not in running:
+                        self._write_locked(old_buffer)
+                        del self.buffers[old_thread_id]
+                        buffer = old_buffer
+                        buffer.thread_id = thread_id
+                        break
+                else:
+                    buffer = _ThreadBuffer(self.buffer_size, thread_id)
+                self.buffers[thread_id] = buffer
+        self._local.buffer = buffer
+        return buffer
+
+    def _write_locked(self, buffer: _ThreadBuffer):
+        """Write the records in `buffer` to the sink. Called with _lock
+        held."""
+        if buffer.offset:
+            self.sink.write_records(memoryview(buffer.data)[: buffer.offset])
+            buffer.offset = 0
+        return
+
+    def _write(self, buffer: _ThreadBuffer):
+        with self._lock:
+            self._write_locked(buffer)
+        return
+
+    def trace_hook(self, frame, event: str, arg):
+        """The trace hook that records events."""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._new_buffer()
+        code = frame.f_code
+        index = self.code2index.get(code)
+        if index is None:
+            index = self._code_index(code)
+        RECORD.pack_into(
+            buffer.data,
+            buffer.offset,
+            perf_counter_ns(),
+            buffer.thread_id,
+            index,
+            frame.f_lineno or 0,
+            EVENT2INDEX[event],
+        )
+        buffer.offset += RECORD.size
+        if buffer.offset == self.buffer_size:
+            self._write(buffer)
+        return self.trace_hook
+
+    def flush(self):
+        """Write out the buffered records of all threads, and drop the
+        buffers of threads that have exited. Other threads should not be
+        recording while this runs."""
+        with self._lock:
+            running = sys._current_frames()
+            for thread_id, buffer in list(self.buffers.items()):
+                self._write_locked(buffer)
+                if thread_id not in running:
+                    del self.buffers[thread_id]
+        return
+
+    def start(self, options: Optional[dict] = None):
+        """Add the recorder hook with add_hook() `options`, and start
+        tracing if it hasn't been started."""
+        options = dict(options or {})
+        options.setdefault("start", not tracer.is_started())
+        tracer.add_hook(self.trace_hook, options)
+        return
+
+    def stop(self):
+        """Remove the recorder hook, stopping tracing if no other hooks
+        are left, and flush and close the sink."""
+        tracer.remove_hook(self.trace_hook, stop_if_empty=True)
+        self.flush()
+        self.sink.close()
+        return
@@ -0,0 +1,103 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Statistical sampling of trace events.
+
+A sampler is called by the dispatcher with the event name before a
+hook is run, and the hook is run only if the sampler returns True.
+This bounds the cost of a hook to a fraction of the events while still
+giving useful call and line distributions.
+"""
+
+import threading
+from itertools import count
+from time import perf_counter_ns
+from typing import Callable, Dict, Optional
+
+
+class EveryNthSampler:
+    """Accept the first and then every `n`th event of each event type."""
+
+    __slots__ = ("n", "counters")
+
+    def __init__(self, n: int):
+        if not isinstance(n, int) or n < 1:
+            raise ValueError(f"sample_every should be a positive integer, is {n}")
+        self.n = n
+        # itertools.count() is advanced atomically, so threads don't
+        # need a lock to share these counters.
+        self.counters: Dict[str, count] = {}
+
+    def __call__(self, event: str) -> bool:
+        counter = self.counters.get(event)
+        if counter is None:
+            counter = self.counters.setdefault(event, count())
+        return next(counter) % self.n == 0
+
+
+class IntervalSampler:
+    """Accept at most one event every `interval` microseconds in each
+    thread."""
+
+    __slots__ = ("interval_ns", "last_ns")
+
+    def __init__(self, interval: float):
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            raise ValueError(
+                f"sample_interval should be a positive number, is {interval}"
+            )
+        self.interval_ns = int(interval * 1000)
+        # Map from a thread id to the time of its last accepted event.
+        self.last_ns: Dict[int, int] = {}
+
+    def __call__(self, event: str) -> bool:
+        now = perf_counter_ns()
+        thread_id = threading.get_ident()
+        last_ns = self.last_ns.get(thread_id)
+        if last_ns is not None and now - last_ns < self.interval_ns:
+            return False
+        self.last_ns[thread_id] = now
+        return True
+
+
+class AllSampler:
+    """Accept an event only if all of `samplers` accept it."""
+
+    __slots__ = ("samplers",)
+
+    def __init__(self, *samplers: Callable[[str], bool]):
+        self.samplers = samplers
+
+    def __call__(self, event: str) -> bool:
+        for sampler in self.samplers:
+            if not sampler(event):
+                return False
+        return True
+
+
+def make_sampler(
+    every: Optional[int] = None, interval: Optional[float] = None
+) -> Optional[Callable[[str], bool]]:
+    """Return a sampler for the add_hook() options _sample_every_ and
+    _sample_interval_, or None if neither is given."""
+    samplers = []
+    if every is not None:
+        samplers.append(EveryNthSampler(every))
+    if interval is not None:
+        samplers.append(IntervalSampler(interval))
+    if not samplers:
+        return None
+    if len(samplers) == 1:
+        return samplers[0]
+    return AllSampler(*samplers)
@@ -0,0 +1,211 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A "sample" backend for running the registered trace hooks.
+
+Instead of having the interpreter call us on every event, we look at
+the stacks of all threads on a timer, using sys._current_frames(), and
+give each hook that wants "sample" events the innermost frame of each
+thread as a "sample" event. The argument of the event is the id of the
+thread the frame belongs to. The cost is then proportional to the
+number of samples rather than to how much code is run.
+
+The timer is either a background thread ("thread") or, on Unix, the
+SIGPROF interval timer ("signal"), which counts process CPU time and
+runs the sampling in the main thread between bytecodes.
+
+Frames are taken from running threads, so hooks should only look at
+them and at what they refer to. Frames that the sampler's TraceFilter
+or the start() "trace_filter" option excludes are skipped over, so that
+a sample is attributed to the innermost frame not excluded. A hook's
+"filter" and "lines" options are applied to that frame: the hook isn't
+given samples of frames they exclude. The "scope" option doesn't apply,
+since the sampler can't see which scope is current in another thread,
+and the "conditions" option applies only to "line" events.
+"""
+
+import signal
+import sys
+import threading
+from types import FrameType
+from typing import Dict, Optional
+
+import tracer.tracer as _tracer
+from tracer.tracefilter import TraceFilter
+
+TIMERS = ("thread", "signal")
+
+# The StackSampler used by the "sample" backend, or None if it isn't
+# running.
+SAMPLER: Optional["StackSampler"] = None
+
+
+class StackSampler:
+    """Give the innermost frame of every thread to the registered hooks
+    as a "sample" event, every `interval` microseconds."""
+
+    def __init__(
+        self,
+        interval: float,
+        timer: str = "thread",
+        trace_filter: Optional[TraceFilter] = None,
+    ):
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            raise ValueError(
+                f"sample_interval should be a positive number, is {interval}"
+            )
+        if timer not in TIMERS:
+            raise ValueError(f"sample_timer should be one of {TIMERS}, is {timer}")
+        if timer == "signal" and not hasattr(signal, "setitimer"):
+            raise NotImplementedError("signal.setitimer() is not available")
+        self.interval = interval
+        self.timer = timer
+        if trace_filter is None:
+            trace_filter = TraceFilter([sys.modules[__name__]])
+        self.trace_filter = trace_filter
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._old_handler = None
+        return
+
+    def _visible_frame(
+        self, frame: Optional[FrameType], trace_filter: Optional[TraceFilter]
+    ) -> Optional[FrameType]:
+        """Return the innermost frame starting at `frame` that neither
+        self.trace_filter nor `trace_filter`, the start() trace filter,
+        excludes, or None if there is none. Frames in a subtree that
+        `trace_filter` excludes are skipped up to the caller of its
+        root."""
+        if trace_filter is not None and trace_filter.has_subtrees:
+            root = None
+            caller = frame
+            while caller is not None:
+                if trace_filter.excludes_subtree(caller):
+                    root = caller
+                caller = caller.f_back
+            if root is not None:
+                frame = root.f_back
+        is_excluded = self.trace_filter.is_excluded
+        while frame is not None and (
+            is_excluded(frame)
+            or (trace_filter is not None and trace_filter.is_excluded(frame))
+        ):
+            frame = frame.f_back
+        return frame
+
+    def sample(self, frames: Dict[int, FrameType]):
+        """Run the hooks that want "sample" events on `frames`, a map
+        from a thread id to the innermost frame of that thread, as
+        sys._current_frames() returns. See the module docstring for
+        which frame is given to which hooks."""
+        if _tracer.TRACE_SUSPEND:
+            return
+        registry = _tracer.REGISTRY
+        traced_threads = registry.traced_threads
+        sampler_thread = self._thread
+        sampler_thread_id = None if sampler_thread is None else sampler_thread.ident
+        for thread_id, frame in frames.items():
+            if thread_id == sampler_thread_id:
+                continue
+            if traced_threads is not None and thread_id not in traced_threads:
+                continue
+            tables = registry.thread_tables.get(thread_id, registry.tables)
+            hooks = tables.dispatch_table.get("sample")
+            if not hooks:
+                continue
+            frame = self._visible_frame(frame, registry.trace_filter)
+            if frame is None:
+                continue
+            stats = registry.stats
+            if stats is not None:
+                stats.count_event("sample")
+            for hook in hooks:
+                sampler = hook.sampler
+                if sampler is not None and not sampler("sample"):
+                    continue
+                hook_filter = hook.trace_filter
+                if hook_filter is not None and hook_filter.is_excluded(frame):
+                    continue
+                line_interest = hook.line_interest
+                if line_interest is not None and line_interest.is_excluded(frame):
+                    continue
+                if stats is None:
+                    hook.trace_func(frame, "sample", thread_id)
+                else:
+                    stats.call_hook(hook.trace_func, frame, "sample", thread_id)
+        return
+
+    def _run(self):
+        interval = self.interval / 1e6
+        while not self._stop_event.wait(interval):
+            self.sample(sys._current_frames())
+        return
+
+    def _signal_handler(self, signum, frame):
+        frames = sys._current_frames()
+        # Our own frame is the innermost one of this thread; use the
+        # frame that the signal interrupted instead.
+        frames[threading.get_ident()] = frame
+        self.sample(frames)
+        return
+
+    def start(self):
+        """Start sampling. With the "signal" timer, this has to be
+        called from the main thread."""
+        if self.timer == "signal":
+            interval = self.interval / 1e6
+            self._old_handler = signal.signal(signal.SIGPROF, self._signal_handler)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        else:
+            self._stop_event.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="pytracer-sampler", daemon=True
+            )
+            self._thread.start()
+        return
+
+    def stop(self):
+        """Stop sampling. Samples are not taken after this returns."""
+        if self.timer == "signal":
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+            self._old_handler = None
+        elif self._thread is not None:
+            self._stop_event.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+        return
+
+
+def start_sampling(
+    interval: float, timer: str = "thread", trace_filter: Optional[TraceFilter] = None
+):
+    """Start the sampler of the "sample" backend, replacing any that
+    is already running."""
+    global SAMPLER
+    sampler = StackSampler(interval, timer, trace_filter)
+    stop_sampling()
+    sampler.start()
+    SAMPLER = sampler
+    return
+
+
+def stop_sampling():
+    """Stop the sampler of the "sample" backend if it is running."""
+    global SAMPLER
+    if SAMPLER is not None:
+        SAMPLER.stop()
+        SAMPLER = None
+    return
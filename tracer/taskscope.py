@@ -0,0 +1,101 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Limit hooks to code running in a contextvars context, such as one
+asyncio Task or one request.
+
+A TraceScope given as the "scope" option of add_hook() limits the hook
+to frames that run while the scope is current, that is, while the
+context variable CURRENT_SCOPE is set to it. The variable is set with
+activate(), which also covers asyncio Tasks created inside it, since
+they copy the context, or with bind() for a Task or Context that
+already exists. For example:
+
+    scope = TraceScope("slow request")
+    tracer.add_hook(request_hook, {"scope": scope})
+
+    async def handle(request):
+        with scope.activate():
+            ...
+
+On the "call" event of a frame, the dispatcher turns the hook off for
+the frame if the scope isn't current, in the same way as for the
+"filter" option, so other frames cost little. A coroutine gets a "call"
+event each time it resumes and a "return" event each time it is
+suspended, so this is decided again, in the context of the Task
+resuming it, each time it runs.
+"""
+
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from types import FrameType
+from typing import Optional
+
+# The TraceScope that is current in this context, if any.
+CURRENT_SCOPE: contextvars.ContextVar = contextvars.ContextVar(
+    "tracer_scope", default=None
+)
+
+
+class TraceScope:
+    """A scope that hooks can be limited to. Scopes compare by
+    identity; `name` is only for showing them."""
+
+    def __init__(self, name: Optional[str] = None):
+        self.name = name
+        return
+
+    def __repr__(self) -> str:
+        return f"TraceScope({self.name!r})"
+
+    def is_excluded(self, frame: FrameType) -> bool:
+        """Return True if this scope isn't current. This is what the
+        dispatcher calls on the "call" event of a frame."""
+        return CURRENT_SCOPE.get() is not self
+
+    def is_current(self) -> bool:
+        return CURRENT_SCOPE.get() is self
+
+    @contextmanager
+    def activate(self):
+        """Make this scope current in the current context while the
+        with-statement runs."""
+        token = CURRENT_SCOPE.set(self)
+        try:
+            yield self
+        finally:
+            CURRENT_SCOPE.reset(token)
+
+    def bind(self, target):
+        """Make this scope current in `target`, a contextvars.Context
+        or an asyncio Task, from now on. Binding a Task needs Python
+        3.12 or later, for Task.get_context()."""
+        if isinstance(target, asyncio.Task):
+            get_context = getattr(target, "get_context", None)
+            if get_context is None:
+                raise NotImplementedError(
+                    "binding a Task needs Task.get_context(), in Python 3.12"
+                )
+            target = get_context()
+        elif not isinstance(target, contextvars.Context):
+            raise TypeError(
+                f"target should be a contextvars.Context or asyncio.Task, is {target}"
+            )
+        try:
+            target.run(CURRENT_SCOPE.set, self)
+        except RuntimeError:
+            # `target` is the context we are running in.
+            CURRENT_SCOPE.set(self)
+        return
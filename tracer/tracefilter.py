@@ -16,19 +16,11 @@
 
 import inspect
 import os
+import re
 import sys
 
-try:
-    from functools import cache
-except ImportError:
-    # Compatibility to allow running this code from older Python
-    from functools import lru_cache
-    def cache(user_function, /):
-        'Simple lightweight unbounded cache.  Sometimes called "memoize".'
-        return lru_cache(maxsize=None)(user_function)
-
-from types import CodeType, ModuleType
-from typing import Any, Dict, Iterable, Optional, Set
+from types import CodeType, FrameType, ModuleType
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 
 def add_to_code_set(object: Any, code_set: Set[CodeType]) -> bool:
@@ -44,6 +36,14 @@ def add_to_code_set(object: Any, code_set: Set[CodeType]) -> bool:
     return False
 
 
+# The most code objects that a cache of per-code-object results, like
+# TraceFilter.code_verdicts, holds. A cache that is full is emptied
+# before the next result is added, so that code that is no longer used,
+# like that of exec'd strings and reloaded modules, is eventually freed,
+# while a lookup stays a single dictionary lookup.
+MAX_CACHED_CODES = 10000
+
+
 def get_code_object(object: Any) -> Optional[CodeType]:
     """
     Try to find a Python code object in ``object`` and if we
@@ -68,15 +68,58 @@ def get_code_object(object: Any) -> Optional[CodeType]:
         return None
     return code if isinstance(code, CodeType) else None
 
-PATH2MODULE: Dict[str, ModuleType] = {}
+# Map from a file path to the key in sys.modules and the module that
+# was loaded from that path. This is rebuilt from sys.modules when
+# sys.modules changes, and a module found here is checked to still be
+# in sys.modules before it is used. While sys.modules doesn't change, a
+# path that is not here, like "<string>" for exec'd code, has no module;
+# so misses are cached too.
+PATH2MODULE: Dict[str, Tuple[str, ModuleType]] = {}
+
+# The size of sys.modules and its last entry, the name and module,
+# when PATH2MODULE was last rebuilt. A module that is imported goes at
+# the end of sys.modules, so when one module is unloaded and another is
+# imported, the size stays the same but the last entry changes. Unlike
+# comparing all the names, checking this takes constant time.
+_indexed_modules_size = -1
+_indexed_last_module: Tuple[Optional[str], Optional[ModuleType]] = (None, None)
+
+
+def index_modules():
+    """Rebuild PATH2MODULE from sys.modules."""
+    global PATH2MODULE, _indexed_modules_size, _indexed_last_module
+    path2module = {}
+    # Copy sys.modules, since another thread may be importing.
+    items = list(sys.modules.items())
+    for name, module in items:
+        module_path = getattr(module, "__file__", None)
+        if isinstance(module_path, str) and module_path not in path2module:
+            path2module[module_path] = (name, module)
+    PATH2MODULE = path2module
+    _indexed_modules_size = len(items)
+    _indexed_last_module = items[-1] if items else (None, None)
+    return
+
+
+def get_module_for_path(module_path: str) -> Optional[ModuleType]:
+    """Return the module in sys.modules loaded from `module_path`, or
+    None if there is none. Unless sys.modules has changed, this takes
+    constant time."""
+    modules = sys.modules
+    name_and_module = PATH2MODULE.get(module_path)
+    if name_and_module is not None:
+        name, module = name_and_module
+        if modules.get(name) is module:
+            return module
+        # The module has been unloaded or replaced.
+    elif len(modules) == _indexed_modules_size:
+        name, module = _indexed_last_module
+        if next(reversed(modules)) == name and modules.get(name) is module:
+            return None
+    index_modules()
+    name_and_module = PATH2MODULE.get(module_path)
+    return None if name_and_module is None else name_and_module[1]
 
-@cache
-def get_modules_for_path(module_values, module_path: str) -> tuple:
-    return tuple(
-        module
-        for module in module_values
-        if hasattr(module, "__file__") and module.__file__ == module_path
-        )
 
 def get_module_object(object: Any) -> Optional[ModuleType]:
     """Given a module name, frame, or code object, return the
@@ -95,30 +138,131 @@ def get_module_object(object: Any) -> Optional[ModuleType]:
         module_name = object.__module__
 
     if isinstance(module_path, str):
-        module_found = PATH2MODULE.get(module_path)
+        module_found = get_module_for_path(module_path)
         if module_found is not None:
             return module_found
-        if os.path.exists(module_path):
-            # from sys.modules, pick out those modules whose filename is "module_path".
-
-            ## FIXME: the below is too slow. Cache sys.modules and
-            ## sys.modules.values using lru_cache!
-            modules = get_modules_for_path(sys.modules.values(), module_path)
-            if len(modules):
-                # There is at least one matching module. (They all
-                # should be the same.)
-                PATH2MODULE[module_path] = modules[0]
-                return modules[0]
 
     return sys.modules.get(module_name) if module_name is not None else None
 
 
+# The kinds of rules that TraceFilter.add_rule() accepts:
+#   "glob": a filename glob, like "site-packages/**"
+#   "module": a module name or module-name prefix, like "django.*"
+#   "qualname": a regular expression searched for in a code object's
+#               qualified name, like r"^Test.*\.setUp$"
+RULE_KINDS = ("glob", "module", "qualname")
+
+
+def glob_to_regex(pattern: str) -> str:
+    """Translate the filename glob `pattern` into a regular expression.
+    "**" matches any number of directories, "*" and "?" match within a
+    single path component, and "[...]" is a character class. A pattern
+    that doesn't start with "/" matches at any directory, so "*.pyx"
+    matches any .pyx file and "site-packages/**" matches everything under
+    any site-packages directory. On Windows, "\\" separates directories
+    as well as "/"."""
+    pattern = pattern.replace(os.sep, "/")
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 1)
+            if j < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1 : j]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append(f"[{body}]")
+                i = j
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    regex = "".join(parts)
+    if not pattern.startswith("/"):
+        regex = "(?:.*/)?" + regex
+    return regex + r"\Z"
+
+
+def module_prefix_to_regex(prefix: str) -> str:
+    """Translate the module name `prefix` into a regular expression.
+    Both "django" and "django.*" match the module django and all of
+    its submodules."""
+    if prefix.endswith(".*"):
+        prefix = prefix[:-2]
+    return re.escape(prefix) + r"(?:\..*)?\Z"
+
+
+class RuleMatcher:
+    """A list of (kind, pattern) rules compiled into one regular
+    expression per kind, so that matching a code object takes at most
+    three regular-expression matches however many rules there are."""
+
+    def __init__(self, rules: Iterable[Tuple[str, str]]):
+        regexes: Dict[str, List[str]] = {kind: [] for kind in RULE_KINDS}
+        for kind, pattern in rules:
+            if kind == "glob":
+                regexes[kind].append(glob_to_regex(pattern))
+            elif kind == "module":
+                regexes[kind].append(module_prefix_to_regex(pattern))
+            else:
+                regexes[kind].append(pattern)
+        self.filename_re, self.module_re, self.qualname_re = (
+            re.compile("|".join(f"(?:{regex})" for regex in regexes[kind]))
+            if regexes[kind]
+            else None
+            for kind in RULE_KINDS
+        )
+        return
+
+    def matches(self, code_object: CodeType, module_name: Optional[str]) -> bool:
+        """Return True if a rule matches `code_object`, whose module is
+        named `module_name`."""
+        if self.filename_re and self.filename_re.match(
+            code_object.co_filename.replace(os.sep, "/")
+        ):
+            return True
+        if module_name and self.module_re and self.module_re.match(module_name):
+            return True
+        return bool(
+            self.qualname_re and self.qualname_re.search(code_object.co_qualname)
+        )
+
+
+FILTER_MODES = ("exclude", "include")
+
+
 class TraceFilter:
     """A class that can be used to test whether
     certain frames, functions, classes, or modules should be skipped/included in tracing.
+
+    In "exclude" mode, the default, what is added with add() and
+    add_rule() is excluded. In "include" mode it is an allow-list:
+    everything else is excluded.
+
+    In "exclude" mode, functions and modules can also be added with
+    subtree=True, which excludes everything they call as well. That
+    is handled by the dispatcher for the filter given in the start()
+    "trace_filter" option; see excludes_subtree().
     """
 
-    def __init__(self, exclude_items: Iterable = list()):
+    def __init__(self, exclude_items: Iterable = list(), mode: str = "exclude"):
+        if mode not in FILTER_MODES:
+            raise ValueError(f"mode should be one of {FILTER_MODES}, is {mode}")
+        self.mode = mode
         self.clear()
         for item in exclude_items:
             self.add(item)
@@ -126,40 +270,167 @@ class TraceFilter:
 
     def is_excluded(self, object) -> bool:
         """Return True if `object', a frame or function, is in the
-        list of functions to exclude"""
+        list of functions to exclude, or in "include" mode, if it is
+        not in the list of functions to include."""
 
         if isinstance(object, ModuleType):
-            return object in self.excluded_modules
-        code_object = get_code_object(object)
-        if code_object is None:
-            return False
+            return (object in self.excluded_modules) != (self.mode == "include")
+        module_name = None
+        if isinstance(object, FrameType):
+            code_object = object.f_code
+            module_name = object.f_globals.get("__name__")
+        else:
+            code_object = get_code_object(object)
+            if code_object is None:
+                return False
+
+        verdict = self.code_verdicts.get(code_object)
+        if verdict is None:
+            verdict = self._is_code_listed(code_object, module_name) != (
+                self.mode == "include"
+            )
+            if len(self.code_verdicts) >= MAX_CACHED_CODES:
+                self.code_verdicts.clear()
+            self.code_verdicts[code_object] = verdict
+        return verdict
+
+    def _is_code_listed(
+        self, code_object: CodeType, module_name: Optional[str] = None
+    ) -> bool:
+        """Work out whether `code_object` was added to this filter, by
+        add() or by add_rule(). is_excluded() caches the result."""
         if code_object in self.excluded_code_objects:
             return True
 
         module_object = get_module_object(code_object)
-        if module_object is None:
+        if module_object is not None:
+            if module_object in self.excluded_modules:
+                return True
+            if module_name is None:
+                module_name = module_object.__name__
+
+        if not self.rules:
             return False
+        if self.rule_matchers is None:
+            self.rule_matchers = (
+                RuleMatcher(
+                    (kind, pattern) for kind, pattern, include in self.rules if include
+                ),
+                RuleMatcher(
+                    (kind, pattern)
+                    for kind, pattern, include in self.rules
+                    if not include
+                ),
+            )
+        exception_matcher, rule_matcher = self.rule_matchers
+        if exception_matcher.matches(code_object, module_name):
+            return False
+        return rule_matcher.matches(code_object, module_name)
 
-        return module_object in self.excluded_modules
+    def excludes_subtree(self, object) -> bool:
+        """Return True if `object', a frame or function, was added with
+        subtree=True, so that everything it calls is excluded too."""
+        if not self.has_subtrees:
+            return False
+        if isinstance(object, FrameType):
+            code_object = object.f_code
+        else:
+            code_object = get_code_object(object)
+            if code_object is None:
+                return False
+
+        verdict = self.subtree_verdicts.get(code_object)
+        if verdict is None:
+            verdict = code_object in self.subtree_code_objects or (
+                bool(self.subtree_modules)
+                and get_module_object(code_object) in self.subtree_modules
+            )
+            if len(self.subtree_verdicts) >= MAX_CACHED_CODES:
+                self.subtree_verdicts.clear()
+            self.subtree_verdicts[code_object] = verdict
+        return verdict
+
+    def _changed(self):
+        """Forget cached verdicts after what is excluded has changed."""
+        self.code_verdicts.clear()
+        self.subtree_verdicts.clear()
+        self.has_subtrees = bool(self.subtree_code_objects or self.subtree_modules)
+        return
 
     def clear(self):
         self.excluded_code_objects: Set[CodeType] = set()
         self.excluded_modules: Set[ModuleType] = set()
+        # Map from a code object to whether it is excluded. This is
+        # emptied whenever what is excluded changes, and when it holds
+        # MAX_CACHED_CODES code objects.
+        self.code_verdicts: Dict[CodeType, bool] = {}
+        # (kind, pattern, include) rules added by add_rule(), and the
+        # RuleMatchers for the exceptions (include is True) and for the
+        # other rules, compiled when first needed.
+        self.rules: List[Tuple[str, str, bool]] = []
+        self.rule_matchers: Optional[Tuple[RuleMatcher, RuleMatcher]] = None
+        # The code objects and modules added with subtree=True, and a
+        # map, like code_verdicts, from a code object to whether it is
+        # one of those or in one of those modules.
+        self.subtree_code_objects: Set[CodeType] = set()
+        self.subtree_modules: Set[ModuleType] = set()
+        self.subtree_verdicts: Dict[CodeType, bool] = {}
+        self.has_subtrees = False
         return
 
-    def add(self, object: Any) -> bool:
-        """Remove `frame_or_fn' from the list of functions to include"""
-        if isinstance(object, ModuleType):
-            self.excluded_modules.add(object)
-            return True
+    def add_rule(self, pattern: str, kind: str = "glob", include: bool = False):
+        """Exclude code matching `pattern`, or in "include" mode
+        include it, where `pattern` is a rule of kind `kind`; see
+        RULE_KINDS. Unlike add(), this doesn't need the code's module
+        to have been imported. If `include` is True, code matching
+        `pattern` is instead taken out of what the other rules match,
+        which makes exceptions to them; code objects and modules given
+        to add() are not affected."""
+        if kind not in RULE_KINDS:
+            raise ValueError(f"rule kind should be one of {RULE_KINDS}, is {kind}")
+        if kind == "qualname":
+            # Report bad regular expressions now rather than when
+            # the rules are compiled on some trace event.
+            re.compile(pattern)
+        self.rules.append((kind, pattern, include))
+        self.rule_matchers = None
+        self._changed()
+        return
+
+    def remove_rule(
+        self, pattern: str, kind: str = "glob", include: bool = False
+    ) -> bool:
+        """Remove a rule added by add_rule(). Return True if a rule was
+        removed or False otherwise."""
+        try:
+            self.rules.remove((kind, pattern, include))
+        except ValueError:
+            return False
+        self.rule_matchers = None
+        self._changed()
+        return True
+
+    def add(self, object: Any, subtree: bool = False) -> bool:
+        """Remove `frame_or_fn' from the list of functions to include.
+        If `subtree` is True, everything that it calls is excluded
+        too."""
+        if subtree and self.mode != "exclude":
+            raise ValueError('subtree exclusion needs an "exclude" mode filter')
         if inspect.isclass(object):
-            module_object = get_module_object(object)
-            if isinstance(module_object, ModuleType):
-                self.excluded_modules.add(module_object)
-                return True
-            else:
+            object = get_module_object(object)
+            if not isinstance(object, ModuleType):
                 return False
-        return add_to_code_set(object, self.excluded_code_objects)
+        if isinstance(object, ModuleType):
+            self.excluded_modules.add(object)
+            if subtree:
+                self.subtree_modules.add(object)
+            added = True
+        elif subtree and not add_to_code_set(object, self.subtree_code_objects):
+            added = False
+        else:
+            added = add_to_code_set(object, self.excluded_code_objects)
+        self._changed()
+        return added
 
     def remove(self, object: Any) -> bool:
         """Remove `object' from the list of functions to include.
@@ -167,11 +438,15 @@ class TraceFilter:
         """
         if isinstance(object, ModuleType):
             self.excluded_modules.remove(object)
+            self.subtree_modules.discard(object)
+            self._changed()
             return True
         code_object = get_code_object(object)
         if code_object is None or code_object not in self.excluded_code_objects:
             return False
         self.excluded_code_objects.remove(code_object)
+        self.subtree_code_objects.discard(code_object)
+        self._changed()
         return True
 
 
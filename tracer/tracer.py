@@ -25,18 +25,60 @@ import sys
 import threading
 
 from enum import Enum
-from typing import Any, Callable, NamedTuple, Optional
+from types import FrameType
+from typing import TYPE_CHECKING, Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+# The other tracer modules are imported where they are needed, so that
+# this file can still be run on its own to demo it.
+if TYPE_CHECKING:
+    from tracer.dispatchstats import DispatchStats
+    from tracer.tracefilter import TraceFilter
+
+try:
+    from tracer._dispatch import Dispatcher as _NativeDispatcher
+except ImportError:
+    # The C extension hasn't been built; use _tracer_func() only.
+    _NativeDispatcher = None
 
 
 class TraceEntry(NamedTuple):
     trace_func: Callable
     event_set: frozenset
-    ignore_frameid: int
-
-
-HOOKS = []  # List of Bunch(trace_func, event_set)
-# We run trace_func if the event is in event_set.
+    # Frames for which trace_func has turned off tracing by returning
+    # a false value. The key is id(frame) and the value the frame
+    # itself, so that a reused id() can't match a different frame.
+    # Entries are removed when the frame returns.
+    disabled_frames: Dict[int, FrameType]
+    # If not None, the threading.get_ident() of the only thread that
+    # trace_func is run in.
+    thread_id: Optional[int] = None
+    # If not None, a function called with the event name before
+    # trace_func is run; trace_func is run only if it returns True.
+    # See tracer.sampling.
+    sampler: Optional[Callable[[str], bool]] = None
+    # If not None, a tracefilter.TraceFilter: trace_func is not run
+    # for frames that it excludes.
+    trace_filter: Optional["TraceFilter"] = None
+    # If not None, a breakpoints.BreakpointIndex: trace_func is run only
+    # for frames whose code has a line in it.
+    line_interest: Optional[Any] = None
+    # If not None, a conditions.Conditions, called with the frame and
+    # event name after the sampler; trace_func is run only if it
+    # returns True.
+    conditions: Optional[Callable[[FrameType, str], bool]] = None
+    # If not None, a taskscope.TraceScope: trace_func is run only for
+    # frames that run while it is current.
+    scope: Optional[Any] = None
+
+
+# List of TraceEntry's. We run trace_func if the event is in
+# event_set. This mirrors REGISTRY.hooks below and is updated in place,
+# never rebound, so references to it stay current. Use add_hook(),
+# remove_hook() and clear_hooks() to change it.
+HOOKS = []
 STARTED_STATE = False  # True if we are tracing.
+# "settrace", "monitoring" or "sample" when started
+STARTED_BACKEND: Optional[str] = None
 # FIXME: in 2.6 we can use sys.gettrace
 
 ALL_EVENT_NAMES = (
@@ -48,6 +90,7 @@ ALL_EVENT_NAMES = (
     "line",
     "opcode",
     "return",
+    "sample",
 )
 
 # If you want short strings for the above event names
@@ -60,11 +103,114 @@ EVENT2SHORT = {
     "line": "--",
     "opcode": "..",
     "return": "<-",
+    "sample": "##",
 }
 
 ALL_EVENTS = frozenset(ALL_EVENT_NAMES)
+
 TraceEvent = Enum("TraceEvent", ALL_EVENT_NAMES)
 
+# Events that go to the local trace function of a frame, that is, the
+# function returned from the "call" event for that frame.
+LOCAL_EVENTS = frozenset(("exception", "line", "opcode", "return"))
+
+
+class HookTables(NamedTuple):
+    """The registered hooks arranged the way the dispatcher uses
+    them. These are rebuilt whenever the hooks change, so that dispatching
+    an event is a single dictionary lookup followed by a loop over only
+    the hooks interested in it."""
+
+    # Map from an event name to the hooks that want that event, in
+    # HOOKS order.
+    dispatch_table: Dict[str, Tuple[TraceEntry, ...]]
+    # The hooks that want some local event.
+    local_hooks: Tuple[TraceEntry, ...]
+    # The local events that some hook wants. When this is empty, we
+    # don't need local tracing at all and can return None from the
+    # "call" event.
+    local_event_set: frozenset
+    # Pairs of a TraceEntry.trace_filter, line_interest or scope and the
+    # hooks that have it, one pair for each distinct one. On the "call" event
+    # of a frame, each is run once, and the hooks for which it excludes
+    # the frame are turned off for it.
+    filtered_hooks: Tuple[Tuple["TraceFilter", Tuple[TraceEntry, ...]], ...] = ()
+
+
+EMPTY_HOOK_TABLES = HookTables({}, (), frozenset(), ())
+
+
+class HookRegistry(NamedTuple):
+    """An immutable snapshot of the registered hooks and of everything
+    the dispatcher derives from them. Changes build a new snapshot and
+    publish it with a single assignment to REGISTRY, so the dispatcher
+    reads REGISTRY once per event without locking and never sees a
+    partly-updated registry."""
+
+    # All the registered hooks, in order.
+    hooks: Tuple[TraceEntry, ...]
+    # The tables used in threads that have no thread-specific hooks.
+    tables: HookTables
+    # Map from a thread id to the tables for that thread, for threads
+    # that have thread-specific hooks. These tables include the hooks
+    # that run in all threads.
+    thread_tables: Dict[int, HookTables]
+    # If not None, the ids of the only threads that are traced. Other
+    # threads turn off tracing for themselves on their next event.
+    traced_threads: Optional[frozenset]
+    # True if the dispatcher needs to look at the current thread, that
+    # is if there are thread-specific hooks or traced_threads is not
+    # None.
+    thread_scoped: bool
+    # If not None, a tracefilter.TraceFilter: frames it excludes are
+    # not traced at all.
+    trace_filter: Optional["TraceFilter"] = None
+    # If not None, a dispatchstats.DispatchStats that counts events and
+    # runs the hooks, timing them. See enable_stats().
+    stats: Optional["DispatchStats"] = None
+
+
+REGISTRY = HookRegistry((), EMPTY_HOOK_TABLES, {}, None, False, None, None)
+
+# Serializes changes to REGISTRY. The dispatcher doesn't take it. This
+# is reentrant since a change can run trace hooks which may change the
+# registry themselves.
+REGISTRY_LOCK = threading.RLock()
+
+
+class _RegistryUpdate(threading.local):
+    """Entered with "with" by the functions that change the registry.
+    It holds REGISTRY_LOCK, and while a thread is inside it the
+    dispatcher ignores that thread's events, so that the hooks don't see
+    the registry being rebuilt."""
+
+    depth = 0
+
+    def __enter__(self):
+        global REGISTRY_UPDATES
+        REGISTRY_LOCK.acquire()
+        REGISTRY_UPDATES += 1
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        global REGISTRY_UPDATES
+        self.depth -= 1
+        REGISTRY_UPDATES -= 1
+        REGISTRY_LOCK.release()
+        return False
+
+
+REGISTRY_UPDATE = _RegistryUpdate()
+
+# The number of threads inside REGISTRY_UPDATE, counting nested entries.
+# The dispatcher looks at REGISTRY_UPDATE only when this isn't 0.
+REGISTRY_UPDATES = 0
+
+# Map from a thread id to the frame at the root of the subtree, excluded
+# by the start() trace filter, that the thread is running in.
+EXCLUDED_SUBTREE_ROOTS: Dict[int, FrameType] = {}
+
 TRACE_SUSPEND = False
 debug = False  # Setting true
 
@@ -88,12 +234,24 @@ def find_hook(trace_func) -> Optional[int]:
     """Find `trace_func` in `hooks`, and return the index of it, or
     None if it is not found."""
     try:
-        i = [entry.trace_func for entry in HOOKS].index(trace_func)
+        i = [entry.trace_func for entry in REGISTRY.hooks].index(trace_func)
     except ValueError:
         return None
     return i
 
 
+def get_thread_id(thread) -> int:
+    """Return the thread id for `thread`, which is either a
+    threading.Thread or already a thread id."""
+    if isinstance(thread, threading.Thread):
+        if thread.ident is None:
+            raise ValueError(f"thread {thread.name} has not been started")
+        return thread.ident
+    if isinstance(thread, int):
+        return thread
+    raise TypeError(f"thread should be a threading.Thread or an int, is {thread}")
+
+
 def option_set(options, value, default_options):
     if not options:
         return default_options.get(value)
@@ -103,17 +261,110 @@ def option_set(options, value, default_options):
         return default_options.get(value)
 
 
+def _enable_frame(hooks: Tuple[TraceEntry, ...], frame_id: int):
+    """Forget that any hook in `hooks` has turned off tracing for the
+    frame with id `frame_id`."""
+    for hook in hooks:
+        disabled_frames = hook.disabled_frames
+        if disabled_frames:
+            disabled_frames.pop(frame_id, None)
+    return
+
+
+def _filter_hooks(filtered_hooks, frame: FrameType, frame_id: int):
+    """Turn off tracing `frame`, whose id is `frame_id`, for the hooks
+    in HookTables.filtered_hooks `filtered_hooks` whose filter excludes
+    it."""
+    for trace_filter, hooks in filtered_hooks:
+        if trace_filter.is_excluded(frame):
+            for hook in hooks:
+                hook.disabled_frames[frame_id] = frame
+    return
+
+
+def _subtree_root_tracer(frame, event, arg):
+    """The local trace function of a frame at the root of a subtree
+    that the start() trace filter excludes. It only waits for that frame
+    to return."""
+    if event == "return":
+        thread_id = threading.get_ident()
+        if EXCLUDED_SUBTREE_ROOTS.get(thread_id) is frame:
+            del EXCLUDED_SUBTREE_ROOTS[thread_id]
+        return None
+    return _subtree_root_tracer
+
+
+def _excluded_subtree_call(trace_filter: "TraceFilter", frame: FrameType):
+    """Handle the "call" event of `frame` for a `trace_filter` that
+    excludes some subtrees. Return False if `frame` is not in an
+    excluded subtree, or else its local trace function."""
+    thread_id = threading.get_ident()
+    if thread_id in EXCLUDED_SUBTREE_ROOTS:
+        return None
+    if trace_filter.excludes_subtree(frame):
+        # Nothing is traced in this thread until this frame returns.
+        EXCLUDED_SUBTREE_ROOTS[thread_id] = frame
+        frame.f_trace_lines = False
+        return _subtree_root_tracer
+    return False
+
+
+def _current_thread_tables(registry: HookRegistry) -> Optional[HookTables]:
+    """Return the hook tables in `registry` for the current thread. If
+    the current thread is not one that we trace, turn off tracing in it
+    and return None."""
+    thread_id = threading.get_ident()
+    traced_threads = registry.traced_threads
+    if traced_threads is not None and thread_id not in traced_threads:
+        sys.settrace(None)
+        return None
+    return registry.thread_tables.get(thread_id, registry.tables)
+
+
 def _tracer_func(frame, event, arg):
     """The internal function set by sys.settrace which runs
     all of the user-registered trace hook functions."""
 
-    global TRACE_SUSPEND, HOOKS, debug
+    global TRACE_SUSPEND, debug
+    if REGISTRY_UPDATES and REGISTRY_UPDATE.depth:
+        return None
+    if event == "call" and id(frame.f_code) in REGISTRY_UPDATE_CODES:
+        # The "call" of a function that enters REGISTRY_UPDATE comes
+        # before it does.
+        return None
+
     if debug:
         print(f"{event} -- {frame.f_code.co_filename}:{frame.f_lineno}")
 
     if TRACE_SUSPEND:
         return _tracer_func
 
+    # Everything below uses this one snapshot of the registry.
+    registry = REGISTRY
+    tables = registry.tables
+    if registry.thread_scoped:
+        tables = _current_thread_tables(registry)
+        if tables is None:
+            return None
+    stats = registry.stats
+    if stats is not None:
+        stats.count_event(event)
+
+    frame_id = id(frame)
+
+    if event == "call":
+        trace_filter = registry.trace_filter
+        if trace_filter is not None:
+            if trace_filter.has_subtrees:
+                local_trace_func = _excluded_subtree_call(trace_filter, frame)
+                if local_trace_func is not False:
+                    return local_trace_func
+            if trace_filter.is_excluded(frame):
+                # Neither the hooks nor we see anything more of this frame.
+                return None
+        if tables.filtered_hooks:
+            _filter_hooks(tables.filtered_hooks, frame, frame_id)
+
     # Leave a breadcrumb for this routine so we can know by
     # frame inspection where the debugger ends. "info threads"
     # by default for example wants to also not show the trace_hook
@@ -121,28 +372,49 @@ def _tracer_func(frame, event, arg):
     # HACK ALERT: "inspect" can get deleted exit cleanup!
     if inspect:
 
-        # Go over all registered hooks
-        for i in range(len(HOOKS)):
-
-            # This is weird:
-            #   HOOK[i] can get deleted
-            try:
-                hook = HOOKS[i]
-            except IndexError:
-                continue
-
-            if hook.ignore_frameid == id(frame):
-                continue
-            if hook.event_set is None or event in hook.event_set:
-                if not hook.trace_func(frame, event, arg):
+        # Go over the registered hooks that want this event.
+        hooks = tables.dispatch_table.get(event)
+        if hooks:
+            for hook in hooks:
+                disabled_frames = hook.disabled_frames
+                if disabled_frames and disabled_frames.get(frame_id) is frame:
+                    continue
+                sampler = hook.sampler
+                if sampler is not None and not sampler(event):
+                    continue
+                conditions = hook.conditions
+                if conditions is not None and not conditions(frame, event):
+                    continue
+                if stats is None:
+                    keep_tracing = hook.trace_func(frame, event, arg)
+                else:
+                    keep_tracing = stats.call_hook(hook.trace_func, frame, event, arg)
+                if not keep_tracing:
                     # sys.settrace's semantics provide that a if trace
                     # hook returns None or False, it should turn off
                     # tracing for that frame.
-                    HOOKS[i] = TraceEntry(hook.trace_func, hook.event_set, id(frame))
+                    disabled_frames[frame_id] = frame
                 pass
             pass
         pass
 
+    if event == "call":
+        # Prune local tracing for this frame down to what the
+        # registered hooks need. Returning None means CPython won't
+        # call us for "line" and other local events of this frame.
+        for hook in tables.local_hooks:
+            if hook.disabled_frames.get(frame_id) is not frame:
+                break
+        else:
+            # No hook wants local events from this frame, so we won't
+            # see its "return" either.
+            _enable_frame(registry.hooks, frame_id)
+            return None
+        if "line" not in tables.local_event_set:
+            frame.f_trace_lines = False
+    elif event == "return":
+        _enable_frame(registry.hooks, frame_id)
+
     # From sys.settrace info: The local trace function
     # should return a reference to itself (or to another function
     # for further tracing in that scope), or None to turn off
@@ -150,11 +422,28 @@ def _tracer_func(frame, event, arg):
     return _tracer_func
 
 
+# The compiled version of _tracer_func(), if it is available. It reads
+# the same module globals and has the same semantics.
+NATIVE_DISPATCHER = (
+    None if _NativeDispatcher is None else _NativeDispatcher(globals(), _tracer_func)
+)
+
+# The function we give to sys.settrace() and set in frame.f_trace.
+TRACE_DISPATCHER = _tracer_func if NATIVE_DISPATCHER is None else NATIVE_DISPATCHER
+
+
 DEFAULT_ADD_HOOK_OPTS = {
     "position": -1,  # Which really means "back of list"
     "start": False,
     "event_set": ALL_EVENTS,
     "backlevel": 0,
+    "thread": None,  # Which really means "all threads"
+    "sample_every": None,
+    "sample_interval": None,
+    "filter": None,
+    "lines": None,
+    "conditions": None,
+    "scope": None,
 }
 
 
@@ -172,7 +461,8 @@ def add_hook(trace_func, options=None):
     sometimes arg is _None_.
 
     _options_ is a dictionary having potential keys: _position_, _start_,
-    _event_set_, and _backlevel_.
+    _event_set_, _backlevel_, _thread_, _sample_every_,
+    _sample_interval_, _filter_, _lines_, _conditions_ and _scope_.
 
     If the event_set option-key is included, it should be is an event
     set that trace_func will get run on. Use _set()_ or _frozenset()_ to
@@ -194,111 +484,321 @@ def add_hook(trace_func, options=None):
     means that all the caller of _add_hook()_ is ignored but prior
     parent frames are traced, and None means that no previous parent
     frames should be traced.
+
+    _thread_ is a threading.Thread or a thread id as returned by
+    threading.get_ident(). If given, trace_func is run only on events
+    in that thread. The default, None, runs it in all traced threads.
+
+    _sample_every_ and _sample_interval_ turn on statistical
+    sampling: trace_func is run only on every _sample_every_th event of
+    each event type, and at most once every _sample_interval_
+    microseconds in each thread. If both are given, both have to
+    accept an event. The decision is made in the dispatcher before
+    trace_func is called.
+
+    _filter_, if not None, is a tracefilter.TraceFilter. trace_func is
+    not run for frames that it excludes. The dispatcher runs each
+    distinct filter once on the "call" event of a frame, however many
+    hooks share it, and then skips the hooks it excludes for the rest
+    of that frame.
+
+    _lines_, if not None, is a breakpoints.BreakpointIndex. trace_func
+    is run only for frames whose code object has a line in it; other
+    frames are handled as if a _filter_ excluded them, so a debugger's
+    "line" hook doesn't keep frames without breakpoints line-traced.
+
+    _conditions_, if not None, is a conditions.Conditions of Python
+    expressions for lines of code. On a "line" event for a line with a
+    condition, the dispatcher evaluates it in the frame and runs
+    trace_func only if it is true.
+
+    _scope_, if not None, is a taskscope.TraceScope. trace_func is run
+    only for frames that run while that scope is current in their
+    contextvars context, for example in one asyncio Task. Like
+    _filter_, this is decided on the "call" event of each frame, and
+    for coroutines again each time they resume.
     """
 
-    if options is None:
-        options = DEFAULT_ADD_HOOK_OPTS.copy()
+    with REGISTRY_UPDATE:
+        if options is None:
+            options = DEFAULT_ADD_HOOK_OPTS.copy()
 
-    # Parameter checking:
-    if inspect.ismethod(trace_func):
-        argcount = 4
-    elif inspect.isfunction(trace_func):
-        argcount = 3
-    else:
-        raise TypeError(
-            "trace_func should be something isfunction() or ismethod() blesses"
-        )
-    try:
-        if hasattr(trace_func, "func_code"):
-            code = trace_func.func_code
-        elif hasattr(trace_func, "__code__"):
-            code = trace_func.__code__
+        # Parameter checking:
+        if inspect.ismethod(trace_func):
+            argcount = 4
+        elif inspect.isfunction(trace_func):
+            argcount = 3
         else:
             raise TypeError(
-                f"trace {repr(trace_func)} should should have a func_code or __code__ attribute"
+                "trace_func should be something isfunction() or ismethod() blesses"
             )
-        pass
+        try:
+            if hasattr(trace_func, "func_code"):
+                code = trace_func.func_code
+            elif hasattr(trace_func, "__code__"):
+                code = trace_func.__code__
+            else:
+                raise TypeError(
+                    f"trace {repr(trace_func)} should should have a func_code or __code__ attribute"
+                )
+            pass
 
-        if argcount != code.co_argcount:
-            raise TypeError(
-                "trace fn %s should take exactly %d arguments (takes %d)"
-                % (
-                    repr(trace_func),
-                    argcount,
-                    trace_func.__code__.co_argcount,
+            if argcount != code.co_argcount:
+                raise TypeError(
+                    "trace fn %s should take exactly %d arguments (takes %d)"
+                    % (
+                        repr(trace_func),
+                        argcount,
+                        trace_func.__code__.co_argcount,
+                    )
                 )
+        except Exception:
+            raise TypeError
+
+        event_set = get_option(options, "event_set")
+        check_event_set(event_set)
+
+        thread = get_option(options, "thread")
+        thread_id = None if thread is None else get_thread_id(thread)
+
+        sample_every = get_option(options, "sample_every")
+        sample_interval = get_option(options, "sample_interval")
+        sampler = None
+        if sample_every is not None or sample_interval is not None:
+            from tracer.sampling import make_sampler
+
+            sampler = make_sampler(sample_every, sample_interval)
+
+        # Setup so we don't trace into this routine.
+        ignore_frame = inspect.currentframe()
+
+        # If the global tracer hook has been registered, the below will
+        # trigger the hook to get called after the assignment.
+        # That's why we set the hook for this frame to ignore tracing.
+        # If this frame isn't locally traced we will never see its
+        # "return" to clean up, but then there is nothing to ignore either.
+        disabled_frames = {}
+        if ignore_frame.f_trace is not None:
+            disabled_frames[id(ignore_frame)] = ignore_frame
+        hook_filters = [
+            hook_filter
+            for hook_filter in (
+                get_option(options, "filter"),
+                get_option(options, "lines"),
+                get_option(options, "scope"),
             )
-    except Exception:
-        raise TypeError
-
-    event_set = get_option(options, "event_set")
-    check_event_set(event_set)
-
-    # Setup so we don't trace into this routine.
-    ignore_frame = inspect.currentframe()
-
-    # Should we trace frames below the one that we issued this
-    # call?
-    backlevel = get_option(options, "backlevel")
-    if backlevel is not None:
-        if not isinstance(backlevel, int):
-            raise TypeError(f"backlevel should be an integer type, is {backlevel}")
-        frame = ignore_frame
-        while frame and backlevel >= 0:
-            backlevel -= 1
-            frame = frame.f_back
-            pass
+            if hook_filter is not None
+        ]
+
+        # Should we trace frames below the one that we issued this
+        # call?
+        backlevel = get_option(options, "backlevel")
+        if backlevel is not None:
+            if not isinstance(backlevel, int):
+                raise TypeError(f"backlevel should be an integer type, is {backlevel}")
+            frame = ignore_frame
+            while frame and backlevel >= 0:
+                backlevel -= 1
+                frame = frame.f_back
+                pass
+
+            # Set to trace all frames below this
+            while frame:
+                frame.f_trace = TRACE_DISPATCHER
+                frame.f_trace_lines = True
+                # These frames have had their "call" event, so apply the
+                # hook's filters here.
+                for hook_filter in hook_filters:
+                    if hook_filter.is_excluded(frame):
+                        disabled_frames[id(frame)] = frame
+                frame = frame.f_back
+                pass
 
-        # Set to trace all frames below this
-        while frame:
-            frame.f_trace = _tracer_func
-            frame = frame.f_back
             pass
+        entry = TraceEntry(
+            trace_func,
+            event_set,
+            disabled_frames,
+            thread_id,
+            sampler,
+            get_option(options, "filter"),
+            get_option(options, "lines"),
+            get_option(options, "conditions"),
+            get_option(options, "scope"),
+        )
 
-        pass
-    # If the global tracer hook has been registered, the below will
-    # trigger the hook to get called after the assignment.
-    # That's why we set the hook for this frame to ignore tracing.
-    entry = TraceEntry(trace_func, event_set, id(ignore_frame))
-
-    # based on position, figure out where to put the hook.
-    position = get_option(options, "position")
-    if position == -1:
-        HOOKS.append(entry)
-    else:
-        if position < -1:
-            # Recall we need -1 for _after_ the end so -2 is normally what is
-            # called -1.
-            position += 1
+        # based on position, figure out where to put the hook.
+        position = get_option(options, "position")
+        hooks = list(REGISTRY.hooks)
+        if position == -1:
+            hooks.append(entry)
+        else:
+            if position < -1:
+                # Recall we need -1 for _after_ the end so -2 is normally what is
+                # called -1.
+                position += 1
+                pass
+            hooks[position:position] = [entry]
             pass
-        HOOKS[position:position] = [entry]
-        pass
+        _set_hooks(tuple(hooks))
 
-    if get_option(options, "start"):
-        start()
-    return len(HOOKS)
+        if get_option(options, "start"):
+            start()
+        return len(hooks)
+
+
+def _make_hook_tables(hooks) -> HookTables:
+    """Arrange the TraceEntry list `hooks` for the dispatcher."""
+    dispatch_table = {}
+    for event in ALL_EVENT_NAMES:
+        event_hooks = tuple(
+            hook for hook in hooks if hook.event_set is None or event in hook.event_set
+        )
+        if event_hooks:
+            dispatch_table[event] = event_hooks
+    local_hooks = tuple(
+        hook
+        for hook in hooks
+        if hook.event_set is None or not LOCAL_EVENTS.isdisjoint(hook.event_set)
+    )
+    # Group the hooks by filter. TraceFilters, BreakpointIndexes and
+    # TraceScopes compare by identity.
+    filter2hooks = {}
+    for hook in hooks:
+        for hook_filter in (hook.trace_filter, hook.line_interest, hook.scope):
+            if hook_filter is not None:
+                filter2hooks.setdefault(hook_filter, []).append(hook)
+    filtered_hooks = tuple(
+        (trace_filter, tuple(filter_hooks))
+        for trace_filter, filter_hooks in filter2hooks.items()
+    )
+    return HookTables(
+        dispatch_table,
+        local_hooks,
+        LOCAL_EVENTS.intersection(dispatch_table),
+        filtered_hooks,
+    )
+
+
+def _publish(registry: HookRegistry):
+    """Make `registry` the registry the dispatcher uses. Call this with
+    REGISTRY_LOCK held."""
+    global REGISTRY
+    thread_scoped = bool(registry.thread_tables) or registry.traced_threads is not None
+    REGISTRY = registry._replace(thread_scoped=thread_scoped)
+    HOOKS[:] = registry.hooks
+
+    if STARTED_BACKEND == "monitoring":
+        from tracer.monitoring import update_events
+
+        update_events()
+    return
+
+
+def _set_hooks(hooks: Tuple[TraceEntry, ...]):
+    """Publish a registry whose registered hooks are `hooks`. Call this
+    with REGISTRY_LOCK held."""
+    thread_ids = {hook.thread_id for hook in hooks if hook.thread_id is not None}
+    thread_tables = {
+        thread_id: _make_hook_tables(
+            [hook for hook in hooks if hook.thread_id in (None, thread_id)]
+        )
+        for thread_id in thread_ids
+    }
+    tables = _make_hook_tables([hook for hook in hooks if hook.thread_id is None])
+    _publish(REGISTRY._replace(hooks=hooks, tables=tables, thread_tables=thread_tables))
+    return
+
+
+def _set_traced_threads(traced_threads: Optional[frozenset]):
+    """Publish a registry which traces only the threads in
+    `traced_threads`, or all threads if that is None."""
+    with REGISTRY_LOCK:
+        _publish(REGISTRY._replace(traced_threads=traced_threads))
+    return
+
+
+def _set_trace_filter(trace_filter):
+    """Publish a registry whose frames are filtered by `trace_filter`."""
+    with REGISTRY_LOCK:
+        _publish(REGISTRY._replace(trace_filter=trace_filter))
+    return
+
+
+def _untrace_excluded_frames(trace_filter: "TraceFilter"):
+    """Stop tracing the frames of the current thread that `trace_filter`
+    excludes. add_hook() may have set these up to be traced before
+    `trace_filter` was in place."""
+    frame = sys._getframe(1)
+    while frame:
+        trace_func = frame.f_trace
+        if trace_func is _tracer_func or (
+            trace_func is not None and trace_func is NATIVE_DISPATCHER
+        ):
+            if trace_filter.is_excluded(frame):
+                frame.f_trace = None
+        frame = frame.f_back
+    return
+
+
+# The DispatchStats that disable_stats() turned off.
+_LAST_STATS: Optional["DispatchStats"] = None
+
+
+def enable_stats():
+    """Start counting the events the dispatcher gets, and the calls of
+    and time spent in each hook, forgetting any earlier counts. This
+    makes dispatching slower; see stats()."""
+    with REGISTRY_UPDATE:
+        from tracer.dispatchstats import DispatchStats
+
+        _publish(REGISTRY._replace(stats=DispatchStats()))
+    return
+
+
+def disable_stats():
+    """Stop counting. stats() still returns the last counts."""
+    global _LAST_STATS
+    with REGISTRY_UPDATE:
+        if REGISTRY.stats is not None:
+            _LAST_STATS = REGISTRY.stats
+            _publish(REGISTRY._replace(stats=None))
+    return
+
+
+def stats() -> Optional[dict]:
+    """Return the counts since enable_stats() was called, adding up
+    those of each thread, or None if it hasn't been. The result is a
+    dict with "events", a map from an event name to the number of those
+    events that the dispatcher got, and "hooks", a map from a trace
+    function to a dict of its number of "calls" and the "time_ns" spent
+    in it."""
+    dispatch_stats = REGISTRY.stats or _LAST_STATS
+    if dispatch_stats is None:
+        return None
+    return dispatch_stats.summary()
 
 
 def clear_hooks():
     "Clear all trace hooks."
-    global HOOKS
-    HOOKS = []
+    with REGISTRY_UPDATE:
+        _set_hooks(())
     return
 
 
 def clear_hooks_and_stop():
     "clear all trace hooks and stop tracing"
     global STARTED_STATE
-    if STARTED_STATE:
-        stop()
-    clear_hooks()
+    with REGISTRY_UPDATE:
+        if STARTED_STATE:
+            stop()
+        clear_hooks()
     return
 
 
 def size():
     """Returns the number of trace hooks installed, an integer."""
-    global HOOKS
-    return len(HOOKS)
+    return len(REGISTRY.hooks)
 
 
 def is_started():
@@ -316,59 +816,260 @@ def remove_hook(trace_func, stop_if_empty=False):
     callback functions, None is returned. On successful
     removal, the number of callback functions remaining is
     returned."""
-    global HOOKS
-    i = find_hook(trace_func)
-    if i is not None:
-        del HOOKS[i]
-        if 0 == len(HOOKS) and stop_if_empty:
+    with REGISTRY_UPDATE:
+        i = find_hook(trace_func)
+        if i is None:
+            return None
+        hooks = REGISTRY.hooks[:i] + REGISTRY.hooks[i + 1 :]
+        _set_hooks(hooks)
+        if 0 == len(hooks) and stop_if_empty:
             stop()
             return 0
-        return len(HOOKS)
-    return None
+        return len(hooks)
 
 
 DEFAULT_START_OPTS = {
     "trace_func": None,
     "add_hook_opts": DEFAULT_ADD_HOOK_OPTS,
     "include_threads": False,
+    # "settrace" uses sys.settrace(). "monitoring" uses sys.monitoring
+    # (PEP 669) in Python 3.12 and later, and asks the interpreter only
+    # for the events in the union of the registered hooks' event sets.
+    "backend": "settrace",
+    # Use the compiled dispatcher in tracer._dispatch if it has been
+    # built; otherwise _tracer_func() is used.
+    "native": True,
+    # If not None, a list of threading.Thread objects or thread ids:
+    # only these threads are traced.
+    "threads": None,
+    # If not None, a tracefilter.TraceFilter. Frames that it excludes
+    # are not traced.
+    "trace_filter": None,
+    # For the "sample" backend: the number of microseconds between
+    # samples, what times them, "thread" or "signal", and the
+    # tracefilter.TraceFilter for frames to skip over.
+    "sample_interval": 10000,
+    "sample_timer": "thread",
+    "sample_filter": None,
 }
 
 
 def start(options=None):
     """Start using all previously-registered trace hooks. If
     _options[trace_func]_ is not None, we'll search for that and add it, if it's
-    not already added."""
+    not already added.
+
+    _options[backend]_ selects how events are gathered: "settrace"
+    (the default), "monitoring" which uses sys.monitoring in Python
+    3.12 and later, or "sample" which periodically gives the innermost
+    frame of each thread to the hooks as a "sample" event. See
+    tracer.stacksampler and the _sample_interval_, _sample_timer_ and
+    _sample_filter_ options.
+
+    _options[native]_ set False forces the pure-Python dispatcher even
+    when the compiled one is available.
+
+    _options[threads]_, if not None, is a list of threading.Thread
+    objects or thread ids to trace; other threads are not traced. If
+    tracing is already limited to some threads, these are added to
+    them. Threads that are already running are attached to by setting
+    the trace function of their frames; before Python 3.12 that only
+    takes effect in the current thread and in threads started later.
+
+    _options[trace_filter]_, if not None, is a tracefilter.TraceFilter.
+    Frames it excludes are not traced: the dispatcher turns off tracing
+    for them when they are called, so no hook sees any of their
+    events. With an "include"-mode TraceFilter, only the code it lists
+    is traced. Functions added to it with subtree=True are not traced
+    and neither is anything they call."""
+
+    global STARTED_STATE, STARTED_BACKEND, TRACE_DISPATCHER
+    with REGISTRY_UPDATE:
+        if options is None:
+            options = DEFAULT_START_OPTS.copy()
+        backend = option_set(options, "backend", DEFAULT_START_OPTS)
+        if backend not in ("settrace", "monitoring", "sample"):
+            raise ValueError(
+                f"backend should be 'settrace', 'monitoring' or 'sample', is {backend}"
+            )
+        threads = option_set(options, "threads", DEFAULT_START_OPTS)
+        thread_ids = None
+        if threads is not None:
+            thread_ids = frozenset(get_thread_id(thread) for thread in threads)
+        if STARTED_STATE and STARTED_BACKEND != backend:
+            stop()
 
-    if options is None:
-        options = DEFAULT_START_OPTS.copy()
-    trace_func = get_option(options, "trace_func")
-    if trace_func is not None:
-        add_hook(trace_func, get_option(options, "add_hook_opts"))
-        pass
+        traced_threads = REGISTRY.traced_threads
+        if thread_ids is not None and STARTED_STATE and traced_threads is not None:
+            thread_ids |= traced_threads
+        _set_traced_threads(thread_ids)
+        trace_filter = option_set(options, "trace_filter", DEFAULT_START_OPTS)
+        _set_trace_filter(trace_filter)
+        if trace_filter is not None:
+            _untrace_excluded_frames(trace_filter)
+
+        trace_func = get_option(options, "trace_func")
+        if trace_func is not None:
+            add_hook(trace_func, get_option(options, "add_hook_opts"))
+            pass
 
-    if get_option(options, "include_threads"):
-        threading.settrace(_tracer_func)
-        pass
+        if backend == "monitoring":
+            from tracer.monitoring import start_monitoring
+
+            try:
+                start_monitoring()
+            except Exception:
+                if trace_func is not None:
+                    remove_hook(trace_func)
+                raise
+            STARTED_STATE = True
+            STARTED_BACKEND = backend
+            return len(REGISTRY.hooks)
+
+        if backend == "sample":
+            from tracer.stacksampler import start_sampling
+
+            try:
+                start_sampling(
+                    option_set(options, "sample_interval", DEFAULT_START_OPTS),
+                    option_set(options, "sample_timer", DEFAULT_START_OPTS),
+                    option_set(options, "sample_filter", DEFAULT_START_OPTS),
+                )
+            except Exception:
+                if trace_func is not None:
+                    remove_hook(trace_func)
+                raise
+            STARTED_STATE = True
+            STARTED_BACKEND = backend
+            return len(REGISTRY.hooks)
+
+        if option_set(options, "native", DEFAULT_START_OPTS) and NATIVE_DISPATCHER:
+            TRACE_DISPATCHER = NATIVE_DISPATCHER
+        else:
+            TRACE_DISPATCHER = _tracer_func
 
-    # FIXME: in 2.6, there is the possibility for chaining
-    # existing hooks by using sys.gettrace().
+        if get_option(options, "include_threads"):
+            threading.settrace(TRACE_DISPATCHER)
+            pass
 
-    if sys.settrace(_tracer_func) is None:
-        global STARTED_STATE, HOOKS
-        STARTED_STATE = True
-        return len(HOOKS)
-    if trace_func is not None:
-        remove_hook(trace_func)
-    raise NotImplementedError("sys.settrace() doesn't seem to be implemented")
+        if thread_ids is not None:
+            _attach_threads(thread_ids)
+            if threading.get_ident() not in thread_ids:
+                STARTED_STATE = True
+                STARTED_BACKEND = backend
+                return len(REGISTRY.hooks)
+
+        # FIXME: in 2.6, there is the possibility for chaining
+        # existing hooks by using sys.gettrace().
+
+        if sys.settrace(TRACE_DISPATCHER) is None:
+            STARTED_STATE = True
+            STARTED_BACKEND = backend
+            return len(REGISTRY.hooks)
+        if trace_func is not None:
+            remove_hook(trace_func)
+        raise NotImplementedError("sys.settrace() doesn't seem to be implemented")
+
+
+def _set_threads_f_trace(thread_ids: frozenset, trace_func: Optional[Callable]):
+    """Set the trace function of all of the frames of the running
+    threads in `thread_ids` other than the current thread."""
+    current_thread_id = threading.get_ident()
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id in thread_ids and thread_id != current_thread_id:
+            while frame:
+                frame.f_trace = trace_func
+                frame = frame.f_back
+    return
 
 
-def stop():
-    """Stop all trace hooks"""
-    if sys.settrace(None) is None:
-        global HOOKS, STARTED_STATE
+def _attach_threads(thread_ids: frozenset):
+    """Start tracing the already-running threads in `thread_ids`."""
+    if hasattr(threading, "settrace_all_threads"):
+        # Threads not in REGISTRY.traced_threads turn tracing off for
+        # themselves on their first event.
+        threading.settrace_all_threads(TRACE_DISPATCHER)
+    _set_threads_f_trace(thread_ids, TRACE_DISPATCHER)
+    return
+
+
+def _detach_threads(thread_ids: frozenset):
+    """Stop tracing the threads in `thread_ids`. Other threads that are
+    traced remain traced."""
+    traced_threads = REGISTRY.traced_threads
+    if traced_threads is None:
+        traced_threads = frozenset(thread.ident for thread in threading.enumerate())
+    traced_threads -= thread_ids
+    if not traced_threads:
+        return stop()
+
+    _set_traced_threads(traced_threads)
+    _set_threads_f_trace(thread_ids, None)
+    if threading.get_ident() in thread_ids:
+        sys.settrace(None)
+    return len(REGISTRY.hooks)
+
+
+def stop(options=None):
+    """Stop all trace hooks.
+
+    If _options[threads]_ is given, it is a list of threading.Thread
+    objects or thread ids, and tracing is stopped only in those
+    threads. If tracing was not limited to some threads before, it
+    then is limited to the other threads currently running."""
+    global STARTED_STATE, STARTED_BACKEND
+
+    with REGISTRY_UPDATE:
+        if options and options.get("threads") is not None:
+            if not STARTED_STATE:
+                return len(REGISTRY.hooks)
+            return _detach_threads(
+                frozenset(get_thread_id(thread) for thread in options["threads"])
+            )
+
+        if STARTED_BACKEND == "monitoring":
+            from tracer.monitoring import stop_monitoring
+
+            stop_monitoring()
+        elif STARTED_BACKEND == "sample":
+            from tracer.stacksampler import stop_sampling
+
+            stop_sampling()
+        elif sys.settrace(None) is not None:
+            raise NotImplementedError("sys.settrace() doesn't seem to be implemented")
         STARTED_STATE = False
-        return len(HOOKS)
-    raise NotImplementedError("sys.settrace() doesn't seem to be implemented")
+        STARTED_BACKEND = None
+
+        registry = REGISTRY
+        if registry.traced_threads:
+            # Have the other threads we were tracing turn tracing off for
+            # themselves on their next event.
+            _set_threads_f_trace(registry.traced_threads, None)
+            _set_traced_threads(frozenset())
+
+        # We won't see "return" events for frames while we are stopped.
+        for hook in registry.hooks:
+            hook.disabled_frames.clear()
+        EXCLUDED_SUBTREE_ROOTS.clear()
+        return len(REGISTRY.hooks)
+
+
+# The id()s of the code of the functions that enter REGISTRY_UPDATE. The
+# dispatcher doesn't trace their frames.
+REGISTRY_UPDATE_CODES = frozenset(
+    id(func.__code__)
+    for func in (
+        _RegistryUpdate.__enter__,
+        add_hook,
+        clear_hooks,
+        clear_hooks_and_stop,
+        disable_stats,
+        enable_stats,
+        remove_hook,
+        start,
+        stop,
+    )
+)
 
 
 # Demo it
@@ -379,15 +1080,17 @@ if __name__ == "__main__":
     print("EVENT2SHORT.keys() == ALL_EVENT_NAMES: %s" % (tuple(t) == ALL_EVENT_NAMES))
     trace_count = 10
 
-    import tracefilter
+    try:
+        from tracer.tracefilter import TraceFilter
+    except ImportError:
+        # This file was run as "python tracer/tracer.py".
+        from tracefilter import TraceFilter
 
-    ignore_filter = tracefilter.TraceFilter([find_hook, stop, remove_hook])
+    ignore_filter = TraceFilter([find_hook, stop, remove_hook])
 
     def my_trace_dispatch(frame, event, arg):
-        global trace_count, ignore_filter
+        global trace_count
         "A sample trace function"
-        if ignore_filter.is_excluded(frame):
-            return None
         lineno = frame.f_lineno
         filename = frame.f_code.co_filename
         s = "%s - %s:%d" % (event, filename, lineno)
@@ -416,7 +1119,8 @@ if __name__ == "__main__":
     start()  # tracer.start() outside of this file
 
     print(f"** Tracing started after start(): {is_started()}")
-    add_hook(my_trace_dispatch)  # tracer.add_hook(...) outside
+    # tracer.add_hook(...) outside
+    add_hook(my_trace_dispatch, {"filter": ignore_filter})
     eval("1+2")
     stop()
     y = 5
@@ -430,7 +1134,10 @@ if __name__ == "__main__":
     print(f"** Tracing started: {is_started()}")
 
     print("** Tracing only 'call' now...")
-    add_hook(my_trace_dispatch, {"start": True, "event_set": frozenset(("call",))})
+    add_hook(
+        my_trace_dispatch,
+        {"start": True, "event_set": frozenset(("call",)), "filter": ignore_filter},
+    )
     foo()
     stop()
     exit(0)
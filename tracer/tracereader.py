@@ -0,0 +1,394 @@
+#   Copyright (C) 2024 Rocky Bernstein <rocky@gnu.org>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Read and query trace files written by tracer.recorder and
+tracer.flightrecorder.
+
+The trace file is memory-mapped, so only the parts a query looks at are
+read. The first time a trace is opened, an index of its chunks is
+built: for each CHUNK_RECORDS chunk, its record count, time range,
+threads and code indexes. The index is saved next to the trace as
+`path`.idx and reused while the trace's size and modification time are
+unchanged. Queries use it to skip chunks that can't match, and yield
+matching events one at a time. For example:
+
+    with TraceReader("trace.bin") as reader:
+        for event in reader.events(thread_id=..., code="work"):
+            print(reader.format_event(event))
+
+There is also a command-line tool:
+
+    $ python -m tracer.tracereader info trace.bin
+    $ python -m tracer.tracereader events trace.bin --code work --limit 20
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+from tracer.recorder import (
+    CHUNK_CODE,
+    CHUNK_EVENTS,
+    CHUNK_RECORDS,
+    RECORD,
+    read_chunks,
+    unpack_code,
+    unpack_events,
+)
+
+INDEX_MAGIC = b"PYTRIDX\0"
+INDEX_VERSION = 1
+
+# Magic, version, trace file size, trace modification time in
+# nanoseconds, offset of the CHUNK_EVENTS payload, number of code chunks
+# and number of record chunks.
+INDEX_HEADER = struct.Struct("<8sHQQQII")
+
+# Payload offset, record count, first and last timestamp, number of
+# threads and number of code indexes of a CHUNK_RECORDS chunk. The
+# thread ids (u64) and code indexes (u32) follow.
+INDEX_ENTRY = struct.Struct("<QIQQHI")
+
+# The fields of RECORD, as 64-bit words: timestamp, thread id, code
+# index and line number, event index.
+_WORDS_PER_RECORD = RECORD.size // 8
+
+
+class CodeInfo(NamedTuple):
+    firstlineno: int
+    filename: str
+    name: str
+
+
+class ChunkInfo(NamedTuple):
+    offset: int
+    count: int
+    first_ns: int
+    last_ns: int
+    thread_ids: frozenset
+    code_indexes: frozenset
+
+
+class Event(NamedTuple):
+    timestamp: int
+    thread_id: int
+    code_index: int
+    lineno: int
+    event: str
+
+
+def _words(data) -> array:
+    """Return the RECORDs in `data` as an array of 64-bit words."""
+    words = array("Q")
+    words.frombytes(data)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+
+def _scan_chunk(data, offset: int, length: int) -> ChunkInfo:
+    words = _words(data[offset : offset + length])
+    timestamps = words[0::_WORDS_PER_RECORD]
+    code_lines = words[2::_WORDS_PER_RECORD]
+    return ChunkInfo(
+        offset,
+        len(timestamps),
+        min(timestamps),
+        max(timestamps),
+        frozenset(words[1::_WORDS_PER_RECORD]),
+        frozenset(code_line & 0xFFFFFFFF for code_line in code_lines),
+    )
+
+
+class TraceReader:
+    """Read the trace file `path`. With `use_index` false, the index
+    is built in memory but not saved or loaded."""
+
+    def __init__(self, path: str, use_index: bool = True):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stat = os.stat(path)
+        self._stamp = (stat.st_size, stat.st_mtime_ns)
+        self.index_path = path + ".idx"
+        self.event_names: List[str] = []
+        self.codes: List[Optional[CodeInfo]] = []
+        self.chunks: List[ChunkInfo] = []
+        if not (use_index and self._load_index()):
+            self._build_index()
+            if use_index:
+                self._save_index()
+        return
+
+    def close(self):
+        self.data.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return
+
+    def _add_code(self, offset: int):
+        index, firstlineno, filename, name = unpack_code(self.data, offset)
+        if index >= len(self.codes):
+            self.codes.extend([None] * (index + 1 - len(self.codes)))
+        self.codes[index] = CodeInfo(firstlineno, filename, name)
+        return
+
+    def _build_index(self):
+        """Scan the whole trace, building the index in memory."""
+        self._events_offset = 0
+        self._code_offsets: List[int] = []
+        for kind, offset, length in read_chunks(self.data):
+            if kind == CHUNK_EVENTS:
+                self._events_offset = offset
+                self.event_names = unpack_events(self.data, offset)
+            elif kind == CHUNK_CODE:
+                self._code_offsets.append(offset)
+                self._add_code(offset)
+            elif kind == CHUNK_RECORDS and length >= RECORD.size:
+                length -= length % RECORD.size
+                self.chunks.append(_scan_chunk(self.data, offset, length))
+        return
+
+    def _save_index(self):
+        parts = [
+            INDEX_HEADER.pack(
+                INDEX_MAGIC,
+                INDEX_VERSION,
+                self._stamp[0],
+                self._stamp[1],
+                self._events_offset,
+                len(self._code_offsets),
+                len(self.chunks),
+            ),
+            array("Q", self._code_offsets).tobytes(),
+        ]
+        for chunk in self.chunks:
+            parts.append(
+                INDEX_ENTRY.pack(
+                    chunk.offset,
+                    chunk.count,
+                    chunk.first_ns,
+                    chunk.last_ns,
+                    len(chunk.thread_ids),
+                    len(chunk.code_indexes),
+                )
+            )
+            parts.append(array("Q", sorted(chunk.thread_ids)).tobytes())
+            parts.append(array("I", sorted(chunk.code_indexes)).tobytes())
+        try:
+            with open(self.index_path, "wb") as f:
+                f.write(b"".join(parts))
+        except OSError:
+            # The index is only a cache, so not being able to write it,
+            # say in a read-only directory, isn't an error.
+            pass
+        return
+
+    def _load_index(self) -> bool:
+        """Load the index saved for this trace, returning False if there
+        isn't an up-to-date one."""
+        try:
+            with open(self.index_path, "rb") as f:
+                index = f.read()
+        except OSError:
+            return False
+        if len(index) < INDEX_HEADER.size:
+            return False
+        magic, version, size, mtime_ns, events_offset, code_count, chunk_count = (
+            INDEX_HEADER.unpack_from(index, 0)
+        )
+        if (magic, version, (size, mtime_ns)) != (
+            INDEX_MAGIC,
+            INDEX_VERSION,
+            self._stamp,
+        ):
+            return False
+        offset = INDEX_HEADER.size
+        self._events_offset = events_offset
+        self.event_names = unpack_events(self.data, events_offset)
+        code_offsets = array("Q")
+        code_offsets.frombytes(index[offset : offset + 8 * code_count])
+        self._code_offsets = code_offsets.tolist()
+        offset += 8 * code_count
+        for code_offset in self._code_offsets:
+            self._add_code(code_offset)
+        for _ in range(chunk_count):
+            chunk_offset, count, first_ns, last_ns, thread_count, code_count = (
+                INDEX_ENTRY.unpack_from(index, offset)
+            )
+            offset += INDEX_ENTRY.size
+            thread_ids = array("Q")
+            thread_ids.frombytes(index[offset : offset + 8 * thread_count])
+            offset += 8 * thread_count
+            code_indexes = array("I")
+            code_indexes.frombytes(index[offset : offset + 4 * code_count])
+            offset += 4 * code_count
+            self.chunks.append(
+                ChunkInfo(
+                    chunk_offset,
+                    count,
+                    first_ns,
+                    last_ns,
+                    frozenset(thread_ids),
+                    frozenset(code_indexes),
+                )
+            )
+        return True
+
+    def thread_ids(self) -> Set[int]:
+        """Return the ids of the threads with recorded events."""
+        result: Set[int] = set()
+        for chunk in self.chunks:
+            result |= chunk.thread_ids
+        return result
+
+    def time_range(self) -> Optional[Tuple[int, int]]:
+        """Return the first and last timestamps in the trace, or None if
+        it has no events."""
+        if not self.chunks:
+            return None
+        return (
+            min(chunk.first_ns for chunk in self.chunks),
+            max(chunk.last_ns for chunk in self.chunks),
+        )
+
+    def record_count(self) -> int:
+        return sum(chunk.count for chunk in self.chunks)
+
+    def code_indexes(self, code: Union[int, str]) -> Set[int]:
+        """Return the code indexes that `code` refers to: a code index,
+        or a name or "filename:name" of a code object."""
+        if isinstance(code, int):
+            return {code}
+        return {
+            index
+            for index, info in enumerate(self.codes)
+            if info is not None
+            and (code == info.name or code == f"{info.filename}:{info.name}")
+        }
+
+    def events(
+        self,
+        thread_id: Optional[int] = None,
+        code: Optional[Union[int, str]] = None,
+        start_ns: Optional[int] = None,
+        end_ns: Optional[int] = None,
+    ) -> Iterator[Event]:
+        """Generate the events in file order, that is in order within
+        each thread, of thread `thread_id`, in `code` (see
+        code_indexes()), and with timestamps from `start_ns` to
+        `end_ns`, inclusive. None matches anything."""
+        indexes = None if code is None else self.code_indexes(code)
+        if indexes is not None and not indexes:
+            return
+        event_names = self.event_names
+        for chunk in self.chunks:
+            if thread_id is not None and thread_id not in chunk.thread_ids:
+                continue
+            if indexes is not None and indexes.isdisjoint(chunk.code_indexes):
+                continue
+            if start_ns is not None and chunk.last_ns < start_ns:
+                continue
+            if end_ns is not None and chunk.first_ns > end_ns:
+                continue
+            end = chunk.offset + chunk.count * RECORD.size
+            for fields in RECORD.iter_unpack(self.data[chunk.offset : end]):
+                timestamp, thread, index, lineno, event = fields
+                if thread_id is not None and thread != thread_id:
+                    continue
+                if indexes is not None and index not in indexes:
+                    continue
+                if start_ns is not None and timestamp < start_ns:
+                    continue
+                if end_ns is not None and timestamp > end_ns:
+                    continue
+                yield Event(timestamp, thread, index, lineno, event_names[event])
+        return
+
+    def format_event(self, event: Event) -> str:
+        info = self.codes[event.code_index]
+        where = "?" if info is None else f"{info.filename}:{event.lineno} {info.name}"
+        return f"{event.timestamp} {event.thread_id} {event.event} {where}"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="tracer", description="Read trace files written by tracer.recorder."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = subparsers.add_parser(
+        "info", help="show the threads, time range and size of a trace"
+    )
+    info_parser.add_argument("path")
+
+    index_parser = subparsers.add_parser(
+        "index", help="build the index of a trace, replacing any old one"
+    )
+    index_parser.add_argument("path")
+
+    events_parser = subparsers.add_parser("events", help="list events of a trace")
+    events_parser.add_argument("path")
+    events_parser.add_argument("--thread", type=int, help="only this thread id")
+    events_parser.add_argument(
+        "--code", help='only this code index, name or "filename:name"'
+    )
+    events_parser.add_argument(
+        "--start", type=int, help="only events at or after this timestamp"
+    )
+    events_parser.add_argument(
+        "--end", type=int, help="only events at or before this timestamp"
+    )
+    events_parser.add_argument("--limit", type=int, help="list at most this many")
+
+    args = parser.parse_args(argv)
+    if args.command == "index":
+        try:
+            os.remove(args.path + ".idx")
+        except FileNotFoundError:
+            pass
+
+    with TraceReader(args.path) as reader:
+        if args.command == "info":
+            time_range = reader.time_range()
+            print(f"events: {reader.record_count()}")
+            print(f"chunks: {len(reader.chunks)}")
+            print(f"code objects: {len(reader.codes)}")
+            if time_range is not None:
+                first, last = time_range
+                print(f"time range: {first} .. {last} ({(last - first) / 1e9:.6f}s)")
+            print(f"threads: {' '.join(map(str, sorted(reader.thread_ids())))}")
+        elif args.command == "events":
+            code = args.code
+            if code is not None and code.isdigit():
+                code = int(code)
+            events = reader.events(args.thread, code, args.start, args.end)
+            for count, event in enumerate(events):
+                if args.limit is not None and count >= args.limit:
+                    break
+                print(reader.format_event(event))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())